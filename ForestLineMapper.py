@@ -136,13 +136,10 @@ def main():
 			print("")
 		
 if __name__ != '__main__':
-	#If script is one of the child processes (multiprocessing) load associated scripts (otherwise parallel processing is avoided)
-	import Scripts.FLM_CenterLine
-	import Scripts.FLM_LineFootprint
-	import Scripts.FLM_Corridor
-	import Scripts.FLM_CorridorFootprint
-	import Scripts.FLM_ZonalThreshold
-	import Scripts.FLM_ForestLineAttributes
+	#If script is one of the child processes (multiprocessing) load only the script of the tool being run (otherwise parallel processing is avoided)
+	import os, importlib
+	if(os.environ.get("FLM_TOOL","") != ""):
+		importlib.import_module(os.environ["FLM_TOOL"])
 else:
 	#If script is main process, load and show GUI
 	import os
@@ -0,0 +1,215 @@
+#
+#    Copyright (C) 2020  Applied Geospatial Research Group
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, version 3.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <https://gnu.org/licenses/gpl-3.0>.
+#
+# ---------------------------------------------------------------------------
+#
+# FLM_Batch.py
+# Script Author: Gustavo Lopes Queiroz
+# Date: 2020-Jan-22
+#
+# This script is part of the Forest Line Mapper (FLM) toolset
+# Webpage: https://github.com/appliedgrg/flm
+#
+# Purpose: Runs FLM tools without the GUI from JSON job specifications.
+# Several jobs (e.g. one per AOI tile) run at the same time within a global
+# core budget. Each job runs in its own process with its own folder holding
+# its parameter file, cores file, scratch workspace and log, so concurrent
+# jobs do not overwrite each other's files.
+#
+# Usage (from the FLM folder):
+#     python -m Scripts.FLM_Batch jobs.json [total cores]
+#
+# Job file example:
+#     {
+#         "cores": 16,
+#         "jobs": [
+#             {
+#                 "name": "tile_001",
+#                 "tool": "Center Line",
+#                 "cores": 4,
+#                 "parameters": {
+#                     "Forest Lines Feature Class": "D:\\tiles\\001\\lines.shp",
+#                     "Cost Raster": "D:\\tiles\\001\\cost.tif",
+#                     "Output Center-Line": "D:\\tiles\\001\\centerline.shp"
+#                 }
+#             }
+#         ]
+#     }
+# Tools are referenced by their name or script file in flm_tools.json.
+# Parameters that are not given take the default value of the tool.
+# Job names are the names of the job folders and must be unique in the batch.
+#
+# ---------------------------------------------------------------------------
+
+import os, re, sys, time, json, traceback, subprocess, multiprocessing
+from . import FLM_Common as flmc
+
+def LoadTools():
+	"""Returns the tool definitions of flm_tools.json indexed by tool name and script file."""
+	with open(os.path.join(flmc.scriptPath,"flm_tools.json")) as json_file:
+		tools_json = json.load(json_file)
+	tools = {}
+	for tbx in tools_json["toolbox"]:
+		for tool in tbx["tools"]:
+			tools[tool["name"]] = tool
+			tools[tool["scriptFile"]] = tool
+			tools[tool["scriptFile"].split(".")[-1]] = tool
+	return tools
+
+def ParamFileName(tool):
+	return tool["paramFile"].replace("/","\\").split("\\")[-1]
+
+def BuildParams(tool, parameters):
+	"""Returns the list of tool arguments in parameter file order, using the tool defaults
+	for parameters that are not given. Raises ValueError for unknown or missing parameters."""
+	names = [param["parameter"] for param in tool["parameters"]]
+	for name in parameters:
+		if(name not in names):
+			raise ValueError("Unknown parameter '"+name+"' for tool "+tool["name"])
+	args = []
+	for param in tool["parameters"]:
+		value = str(parameters.get(param["parameter"], param["default"]))
+		if(value == ""):
+			raise ValueError("Missing parameter '"+param["parameter"]+"' for tool "+tool["name"])
+		args.append(value)
+	return args
+
+class BatchTool:
+	"""Minimal tool description used for logging, with the same members as the GUI tools."""
+	def __init__(self, tool, args):
+		self.title = tool["name"]
+		self.fields = [param["parameter"] for param in tool["parameters"]]
+		self.input = args
+	def GetParams(self):
+		return self.input
+
+def CheckJobName(name, names):
+	"""Checks that a job name can be used as the name of its folder and is not used by another job of
+	the batch (names, lower case as folders on Windows), then adds it to names."""
+	if(type(name) != str or re.match(r"^[A-Za-z0-9_\-][A-Za-z0-9_\-\. ]*$", name) == None or name.strip(". ") != name):
+		raise ValueError("Invalid job name '"+str(name)+"', use letters, digits, '_', '-', '.' and spaces")
+	if(name.lower() in names):
+		raise ValueError("Duplicate job name '"+name+"'")
+	names.add(name.lower())
+
+def PrepareJob(job, tools, batchPath, cores):
+	"""Creates the job folder with the parameter and cores files and returns the job process settings."""
+	if(job.get("tool") not in tools):
+		raise ValueError("Unknown tool '"+str(job.get("tool"))+"'")
+	tool = tools[job["tool"]]
+	args = BuildParams(tool, job.get("parameters", {}))
+	jobPath = os.path.join(batchPath, job["name"])
+	if(os.path.isdir(jobPath) == False):
+		os.makedirs(jobPath)
+	pfile = open(os.path.join(jobPath, ParamFileName(tool)),"w")
+	for arg in args:
+		pfile.write(arg+"\n")
+	pfile.close()
+	jobCores = max(1, min(int(job.get("cores", cores)), cores))
+	cfile = open(os.path.join(jobPath, flmc.coresFile),"w")
+	cfile.write(str(jobCores))
+	cfile.close()
+	return {"name":job["name"], "tool":tool["scriptFile"], "path":jobPath, "cores":jobCores}
+
+def StartJob(jobRun):
+	env = dict(os.environ)
+	env["FLM_WORKDIR"] = jobRun["path"]
+	env["FLM_TOOL"] = jobRun["tool"]
+	cwd = os.path.dirname(flmc.scriptPath)
+	return subprocess.Popen([sys.executable, "-m", "Scripts.FLM_Batch", "--job", jobRun["tool"]], cwd=cwd, env=env)
+
+def RunBatch(jobsFile, cores = None):
+	"""Runs all jobs of the job file, starting jobs while their cores fit in the core budget.
+	Returns the list of jobs with their status and execution time."""
+	with open(jobsFile) as json_file:
+		spec = json.load(json_file)
+	if(type(spec) == list):
+		spec = {"jobs":spec}
+	if(cores == None):
+		cores = int(spec.get("cores", multiprocessing.cpu_count()))
+	batchPath = flmc.GetSetting("batch_path", os.path.join(os.path.dirname(os.path.realpath(jobsFile)), "FLM_batch"))
+	tools = LoadTools()
+
+	pending = []
+	finished = []
+	names = set()
+	for i, job in enumerate(spec["jobs"]):
+		job.setdefault("name", "job_"+str(i+1))
+		try:
+			# Each job has its own folder
+			CheckJobName(job["name"], names)
+			pending.append(PrepareJob(job, tools, batchPath, cores))
+		except ValueError as e:
+			flmc.log("Job "+str(job["name"])+" skipped: "+str(e))
+			finished.append({"name":job["name"], "status":"invalid", "error":str(e)})
+
+	flmc.log("Running "+str(len(pending))+" jobs with "+str(cores)+" cores...")
+	running = []
+	while len(pending)>0 or len(running)>0:
+		# Start jobs in order while they fit in the core budget
+		usedCores = sum([jobRun["cores"] for jobRun in running])
+		while len(pending)>0 and usedCores+pending[0]["cores"] <= cores:
+			jobRun = pending.pop(0)
+			jobRun["start"] = time.time()
+			jobRun["process"] = StartJob(jobRun)
+			running.append(jobRun)
+			usedCores += jobRun["cores"]
+			flmc.log("Job "+jobRun["name"]+" started ("+jobRun["tool"]+", "+str(jobRun["cores"])+" cores).")
+		time.sleep(1)
+		for jobRun in running[:]:
+			if(jobRun["process"].poll() == None):
+				continue
+			running.remove(jobRun)
+			seconds = time.time()-jobRun["start"]
+			status = "ok" if jobRun["process"].returncode == 0 else "failed"
+			flmc.log("Job "+jobRun["name"]+" "+status+" in "+"{:.2f}".format(seconds)+" seconds. Log: "+os.path.join(jobRun["path"],"log.txt"))
+			finished.append({"name":jobRun["name"], "tool":jobRun["tool"], "status":status, "seconds":seconds, "cores":jobRun["cores"]})
+
+	summary = open(os.path.join(batchPath,"batch_summary.json"),"w")
+	json.dump(finished, summary, indent=4)
+	summary.close()
+	return finished
+
+def RunJobProcess(module):
+	"""Runs a tool inside a job process, using the job folder set in FLM_WORKDIR."""
+	import importlib
+	tool = LoadTools()[module]
+	vfile = open(os.path.join(flmc.scriptPath,"FLM_VERSION"),"r")
+	flmc.newLog(vfile.readline())
+	vfile.close()
+	scriptTool = importlib.import_module(module)
+	flmc.logStart(BatchTool(tool, [arg.rstrip("\n") for arg in flmc.GetArgs(ParamFileName(tool))]))
+	flmc.StartTrace(tool["name"])
+	try:
+		r = scriptTool.main()
+	except Exception:
+		flmc.log(traceback.format_exc())
+		return 1
+	finally:
+		flmc.WriteTrace()
+		flmc.RemoveScratch()
+	if(r == False):
+		return 1
+	flmc.logEnd(BatchTool(tool, []))
+	return 0
+
+if __name__ == '__main__':
+	if(len(sys.argv)>2 and sys.argv[1] == "--job"):
+		sys.exit(RunJobProcess(sys.argv[2]))
+	elif(len(sys.argv)>1):
+		results = RunBatch(sys.argv[1], int(sys.argv[2]) if len(sys.argv)>2 else None)
+		sys.exit(0 if all([result["status"] == "ok" for result in results]) else 1)
+	else:
+		print("Usage: python -m Scripts.FLM_Batch jobs.json [total cores]")
@@ -0,0 +1,557 @@
+#
+#    Copyright (C) 2020  Applied Geospatial Research Group
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, version 3.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <https://gnu.org/licenses/gpl-3.0>.
+#
+# ---------------------------------------------------------------------------
+#
+# FLM_Benchmark.py
+# Script Author: Gustavo Lopes Queiroz
+# Date: 2020-Jan-22
+#
+# This script is part of the Forest Line Mapper (FLM) toolset
+# Webpage: https://github.com/appliedgrg/flm
+#
+# Purpose: Benchmark of the FLM tool engines (see FLM_Engine) on synthetic
+# data. A synthetic CHM with tree crowns and canopy gaps is crossed by a grid
+# of seismic lines, at any scale from 1 km2 to 1000 km2 and from 100 to 100k
+# lines. CHM cells are generated on demand for each window, so large scenes
+# are never stored. Each tool is run with each number of cores, and lines per
+# second, peak memory of the workers and the speedup over the first number of
+# cores are appended to a JSON-lines results file, so runs on different
+# computers or versions can be compared. arcpy is not needed.
+# Tasks are dispatched in input, random or spatial order (see
+# FLM_Common.TaskOrder). CHM windows are assembled from the block cache of
+# each worker (see FLM_RasterCache.BlockCache), and the hit rate of the cache
+# and the blocks read and evicted with each order are reported.
+#
+# Usage (from the FLM folder):
+#     python -m Scripts.FLM_Benchmark --area 1 --lines 100 --cores 1,2,4
+#     python -m Scripts.FLM_Benchmark --area 1000 --lines 100000 --sample 2000
+#     python -m Scripts.FLM_Benchmark --area 25 --lines 2000 --order random,hilbert --chunk 4
+#     python -m Scripts.FLM_Benchmark --check-pyramid --chm Examples/Inputs/Example_CHM_Raster.tif
+#         --input-lines Examples/Inputs/Example_Input_Lines.shp
+# Use --help for all options.
+#
+# ---------------------------------------------------------------------------
+
+import os, sys, math, time, json, platform, argparse, multiprocessing
+import numpy as np
+from . import FLM_Common as flmc
+from . import FLM_Engine as flme
+from . import FLM_LineTable as flmlt
+from . import FLM_RasterCache as flmrc
+
+tools = ["canopycost", "centerline", "linefootprint", "zonalthreshold", "attributes"]
+
+# Tool parameters, using the defaults of flm_tools.json
+defaults = {
+	"min_height":1.0, "tree_search_radius":3.0, "max_line_distance":10.0, "avoidance":0.3, "exponent":1.5,
+	"line_processing_radius":35.0, "corridor_threshold":3.0, "max_line_width":32.0, "expand_shrink":0,
+	"zonal_search_radius":20.0, "zonal_min":4.0, "zonal_max":20.0, "attribute_line_width":25.0,
+	"tile_size":1000,
+}
+
+def Random(seed, *key):
+	"""Random generator for one element of the scene, so every element is the same whichever window reads it."""
+	value = seed
+	for k in key:
+		value = (value*1000003+int(k)+7919) % 4294967291
+	return np.random.RandomState(value)
+
+class SyntheticScene:
+	"""Synthetic forest crossed by a grid of seismic lines. Lines are the segments between the
+	nodes of a jittered square grid, split in vertices every vertexSpacing metres with a small
+	meander. The CHM has parabolic tree crowns, canopy gaps and the lines cleared to low regrowth."""
+	def __init__(self, area = 1.0, lines = 100, cellSize = 1.0, seed = 1, treeDensity = 0.05, gapsPerHa = 0.5, lineWidth = 6.0, vertexSpacing = 25.0):
+		self.area = area
+		self.cellSize = cellSize
+		self.seed = seed
+		self.treeDensity = treeDensity
+		self.gapsPerHa = gapsPerHa
+		self.lineWidth = lineWidth
+		self.vertexSpacing = vertexSpacing
+		self.side = math.sqrt(area)*1000.0
+		# A grid of n x n cells has 2n(n+1) segments
+		self.nodes = max(1, int(round((-1+math.sqrt(1+2.0*lines))/2.0)))
+		self.spacing = self.side/self.nodes
+		self.jitter = self.spacing*0.1
+		self.tileCells = 128
+
+	def Extent(self):
+		return (0.0, 0.0, self.side, self.side)
+
+	def Config(self):
+		return {"area":self.area, "lines":len(self.Lines()), "cellSize":self.cellSize, "seed":self.seed, "treeDensity":self.treeDensity,
+			"gapsPerHa":self.gapsPerHa, "lineWidth":self.lineWidth, "vertexSpacing":self.vertexSpacing, "spacing":self.spacing}
+
+	def Node(self, i, j):
+		offset = Random(self.seed, 1, i, j).uniform(-self.jitter, self.jitter, 2)
+		return (i*self.spacing+offset[0], j*self.spacing+offset[1])
+
+	def Lines(self):
+		"""Returns the keys of all lines: (0, i, j) goes north from node (i, j), (1, i, j) goes east."""
+		keys = []
+		for i in range(0, self.nodes+1):
+			for j in range(0, self.nodes):
+				keys.append((0, i, j))
+				keys.append((1, j, i))
+		return keys
+
+	def LineVertices(self, key, noise = 0.0):
+		"""Vertices of a line. With noise, inner vertices are moved randomly by up to noise metres,
+		as in lines digitized from imagery, which the Center Line tool corrects."""
+		kind, i, j = key
+		x1, y1 = self.Node(i, j)
+		x2, y2 = self.Node(i, j+1) if kind == 0 else self.Node(i+1, j)
+		length = math.hypot(x2-x1, y2-y1)
+		parts = max(1, int(round(length/self.vertexSpacing)))
+		rng = Random(self.seed, 2, kind, i, j)
+		meander = rng.uniform(-1, 1, parts+1)*self.vertexSpacing*0.1
+		meander[0] = meander[-1] = 0
+		digitizing = Random(self.seed, 3, kind, i, j).uniform(-noise, noise, parts+1)
+		digitizing[0] = digitizing[-1] = 0
+		nx, ny = (y1-y2)/length, (x2-x1)/length
+		vertices = []
+		for k in range(0, parts+1):
+			t = float(k)/parts
+			offset = meander[k]+digitizing[k]
+			vertices.append((x1+(x2-x1)*t+nx*offset, y1+(y2-y1)*t+ny*offset))
+		return vertices
+
+	def Window(self, extent):
+		"""Returns the CHM cells within extent as a Grid aligned to the scene cells. Cells are generated
+		by blocks kept in the block cache of the process, as the blocks of a raster file are read."""
+		xMin, yMin, xMax, yMax = extent
+		cs = self.cellSize
+		col0, col1 = int(math.floor(xMin/cs)), int(math.ceil(xMax/cs))
+		row0, row1 = int(math.floor(-yMax/cs)), int(math.ceil(-yMin/cs))
+		chm = flmrc.ReadWindow(("synthetic", self.area, self.nodes, cs, self.seed), 1, row0, col0, row1, col1, lambda r0, c0, r1, c1: self.Cells(r0, c0, r1, c1).array)
+		if(chm is None):
+			return self.Cells(row0, col0, row1, col1)
+		return flme.Grid(chm, col0*cs, -row0*cs, cs)
+
+	def Cells(self, row0, col0, row1, col1):
+		"""Generates the CHM cells [row0:row1, col0:col1], with row 0 and column 0 at the origin of the scene."""
+		cs = self.cellSize
+		extent = (col0*cs, -row1*cs, col1*cs, -row0*cs)
+		chm = np.zeros((row1-row0, col1-col0), dtype=flme.FloatType())
+		grid = flme.Grid(chm, col0*cs, -row0*cs, cs)
+
+		# Tree crowns of the tiles overlapping the window, and of their neighbours for crowns crossing tile edges
+		tile = self.tileCells*cs
+		for ti in range(int(math.floor(col0*cs/tile))-1, int(math.floor(col1*cs/tile))+2):
+			for tj in range(int(math.floor(-row1*cs/tile))-1, int(math.floor(-row0*cs/tile))+2):
+				self.DrawTile(grid, ti, tj, tile)
+
+		# Cleared lines with low regrowth
+		for key in self.LinesNear(extent):
+			vertices = self.LineVertices(key)
+			window = grid.Clip(*flme.LineExtent(vertices, self.lineWidth))
+			if(window.rows == 0 or window.cols == 0):
+				continue
+			cleared = flme.LineMask(window, vertices, self.lineWidth/2.0)
+			window.array[cleared] = np.minimum(window.array[cleared], 0.5)
+		return grid
+
+	def DrawTile(self, grid, ti, tj, tile):
+		rng = Random(self.seed, 4, ti, tj)
+		trees = rng.poisson(self.treeDensity*tile*tile)
+		xs = rng.uniform(ti*tile, (ti+1)*tile, trees)
+		ys = rng.uniform(tj*tile, (tj+1)*tile, trees)
+		heights = rng.uniform(3, 25, trees)
+		radii = rng.uniform(1, 4, trees)
+		gaps = rng.poisson(self.gapsPerHa*tile*tile/10000.0)
+		keep = np.ones(trees, dtype=bool)
+		for g in range(0, gaps):
+			gx, gy, gr = rng.uniform(ti*tile, (ti+1)*tile), rng.uniform(tj*tile, (tj+1)*tile), rng.uniform(10, 40)
+			keep &= (xs-gx)**2+(ys-gy)**2 > gr*gr
+		xMin, yMin, xMax, yMax = grid.Extent()
+		keep &= (xs+radii > xMin) & (xs-radii < xMax) & (ys+radii > yMin) & (ys-radii < yMax)
+		cs = grid.cellSize
+		for x, y, h, r in zip(xs[keep], ys[keep], heights[keep], radii[keep]):
+			row0, col0 = grid.CellOf(x-r, y+r)
+			row1, col1 = min(row0+int(2*r/cs)+2, grid.rows), min(col0+int(2*r/cs)+2, grid.cols)
+			row0, col0 = max(row0, 0), max(col0, 0)
+			if(row1 <= row0 or col1 <= col0):
+				continue
+			cx = grid.xMin+(np.arange(col0, col1)+0.5)*cs-x
+			cy = grid.yMax-(np.arange(row0, row1)+0.5)*cs-y
+			d2 = cy[:,None]**2+cx[None,:]**2
+			crown = h*np.maximum(1-d2/(r*r), 0)
+			patch = grid.array[row0:row1, col0:col1]
+			np.maximum(patch, crown, out=patch)
+
+	def LinesNear(self, extent):
+		"""Keys of the lines that may cross extent, found from the grid position of the extent."""
+		xMin, yMin, xMax, yMax = extent
+		margin = self.jitter+self.vertexSpacing+self.lineWidth
+		i0 = max(0, int(math.floor((xMin-margin)/self.spacing)))
+		i1 = min(self.nodes, int(math.ceil((xMax+margin)/self.spacing)))
+		j0 = max(0, int(math.floor((yMin-margin)/self.spacing)))
+		j1 = min(self.nodes, int(math.ceil((yMax+margin)/self.spacing)))
+		keys = []
+		for i in range(i0, i1+1):
+			for j in range(j0, j1+1):
+				if(j < self.nodes):
+					keys.append((0, i, j))
+				if(i < self.nodes):
+					keys.append((1, i, j))
+		return keys
+
+class InputScene:
+	"""Scene of a CHM raster and a line feature class, such as the example data of FLM, used in place
+	of a synthetic scene. Lines are read with arcpy when available, otherwise GDAL, and CHM windows
+	are read from the raster (see FLM_Engine.ReadRaster)."""
+	def __init__(self, chm, inputLines):
+		self.chm = chm
+		self.inputLines = inputLines
+		self.table = ReadLines(inputLines)
+		whole = flme.ReadRaster(chm)
+		self.cellSize = whole.cellSize
+		self.extent = whole.Extent()
+		self.lineWidth = 0.0
+		del whole
+
+	def Extent(self):
+		return self.extent
+
+	def Config(self):
+		return {"chm":self.chm, "inputLines":self.inputLines, "lines":len(self.table), "cellSize":self.cellSize}
+
+	def Lines(self):
+		return [line for line in range(0, len(self.table)) if len(self.table.Vertices(line)) > 1]
+
+	def LineVertices(self, key, noise = 0.0):
+		return [(float(x), float(y)) for x, y in self.table.Vertices(key)]
+
+	def Window(self, extent):
+		return flme.ReadRaster(self.chm, extent)
+
+def ReadLines(path):
+	"""Line table (see FLM_LineTable) of a line feature class."""
+	try:
+		import arcpy
+	except ImportError:
+		arcpy = None
+	if(arcpy != None):
+		return flmlt.FromFeatureClass(path)
+	from osgeo import ogr
+	dataset = ogr.Open(path)
+	lineParts = []
+	for feature in dataset.GetLayer(0):
+		parts = []
+		geometry = feature.GetGeometryRef()
+		if(geometry != None):
+			flmlt.ReadWkbParts(bytes(geometry.ExportToWkb()), 0, parts)
+		lineParts.append(parts)
+	dataset = None
+	return flmlt.FromParts(lineParts)
+
+def MakeScene(sceneConfig):
+	if("chm" in sceneConfig):
+		return InputScene(**sceneConfig)
+	return SyntheticScene(**sceneConfig)
+
+# Scene and parameters of the worker processes
+scene = None
+params = None
+
+def InitWorker(sceneConfig, toolParams):
+	global scene, params
+	scene = MakeScene(sceneConfig)
+	params = toolParams
+
+def PyramidSettings():
+	"""Aggregation factor, band width in metres and aggregation method of the pyramid mode of the
+	engine (see FLM_Engine.PyramidWindow), from the pyramid_factor, pyramid_band and pyramid_method settings."""
+	return flmc.GetSetting("pyramid_factor", 1), flmc.GetSetting("pyramid_band", 10.0), flmc.GetSetting("pyramid_method", "mean")
+
+def CanopyCostWindow(extent):
+	"""Canopy and cost rasters of extent, computed from a CHM window with a halo wide enough
+	for the focal statistics and Euclidean distances to match those of the whole raster."""
+	halo = params["tree_search_radius"]+params["max_line_distance"]
+	chm = scene.Window((extent[0]-halo, extent[1]-halo, extent[2]+halo, extent[3]+halo))
+	canopy, cost = flme.CanopyCost(chm, params["min_height"], params["tree_search_radius"], params["max_line_distance"], params["avoidance"], params["exponent"])
+	return chm, canopy, cost
+
+def TaskCanopyCost(tile):
+	x, y = tile
+	size = params["tile_size"]*scene.cellSize
+	chm, canopy, cost = CanopyCostWindow((x, y, x+size, y+size))
+	return float(np.nanmean(cost.array))
+
+def TaskCenterLine(key):
+	vertices = scene.LineVertices(key, scene.lineWidth)
+	chm, canopy, cost = CanopyCostWindow(flme.LineExtent(vertices, params["line_processing_radius"]))
+	path = flme.CenterLine(cost, vertices, params["line_processing_radius"], flmc.GetSetting("adaptive_window_start", 0.0), flmc.GetSetting("adaptive_window_growth", 2.0), *PyramidSettings())
+	return 0 if path == None else len(path)
+
+def TaskLineFootprint(key):
+	vertices = scene.LineVertices(key)
+	distance = params["max_line_width"]/2.0
+	chm, canopy, cost = CanopyCostWindow(flme.LineExtent(vertices, distance))
+	footprint = flme.LineFootprint(cost, canopy, vertices, distance, params["corridor_threshold"], params["expand_shrink"], *PyramidSettings())
+	return int(np.count_nonzero(footprint.array))
+
+def TaskZonalThreshold(key):
+	vertices = scene.LineVertices(key)
+	chm, canopy, cost = CanopyCostWindow(flme.LineExtent(vertices, params["zonal_search_radius"]))
+	return flme.ZonalThreshold(canopy, vertices, params["zonal_search_radius"], params["zonal_min"], params["zonal_max"])
+
+def TaskAttributes(key):
+	vertices = scene.LineVertices(key)
+	distance = params["max_line_width"]/2.0
+	chm, canopy, cost = CanopyCostWindow(flme.LineExtent(vertices, distance))
+	footprint = flme.LineFootprint(cost, canopy, vertices, distance, params["corridor_threshold"], params["expand_shrink"], *PyramidSettings())
+	return flme.LineAttributes(vertices, footprint, chm, params["attribute_line_width"]/2.0)
+
+taskFunctions = {"canopycost":TaskCanopyCost, "centerline":TaskCenterLine, "linefootprint":TaskLineFootprint,
+	"zonalthreshold":TaskZonalThreshold, "attributes":TaskAttributes}
+
+def RunTask(toolTask):
+	"""Runs one task in a worker and returns its execution time, the peak memory of the worker during
+	the task and the change of the counters of the block cache of the worker (see FLM_RasterCache.BlockCache)."""
+	tool, task = toolTask
+	flmc.ResetPeakMemory()
+	cache = flmrc.Blocks()
+	counts = cache.Counters() if cache != None else None
+	start = time.time()
+	taskFunctions[tool](task)
+	seconds = time.time()-start
+	blocks = dict([(name, cache.Counters()[name]-counts[name]) for name in ["hits", "misses", "evictions", "read_mb"]]) if cache != None else None
+	return (seconds, flmc.PeakMemory(), blocks)
+
+def Tasks(tool, sceneObj, toolParams, sample, seed):
+	"""Tasks of a tool: CHM tiles for Canopy Cost, lines for the other tools."""
+	if(tool == "canopycost"):
+		size = toolParams["tile_size"]*sceneObj.cellSize
+		xMin, yMin, xMax, yMax = sceneObj.Extent()
+		tasks = [(x, y) for x in np.arange(xMin, xMax, size) for y in np.arange(yMin, yMax, size)]
+	else:
+		tasks = sceneObj.Lines()
+	if(sample > 0 and sample < len(tasks)):
+		rng = np.random.RandomState(seed)
+		tasks = [tasks[k] for k in sorted(rng.choice(len(tasks), sample, replace=False))]
+	return tasks
+
+def OrderTasks(tool, tasks, sceneObj, toolParams, order, seed):
+	"""Tasks in dispatch order: input order, a random order as that of lines listed by licence or date,
+	or along the Hilbert or Z-order curve of the centres of the tiles or lines (see FLM_Common.SpatialOrder)."""
+	if(order == "input"):
+		return list(tasks)
+	if(order == "random"):
+		return [tasks[k] for k in np.random.RandomState(seed).permutation(len(tasks))]
+	if(tool == "canopycost"):
+		half = toolParams["tile_size"]*sceneObj.cellSize/2.0
+		centres = [(x+half, y+half) for x, y in tasks]
+	else:
+		extents = [flme.LineExtent(sceneObj.LineVertices(task), 0.0) for task in tasks]
+		centres = [((e[0]+e[2])/2.0, (e[1]+e[3])/2.0) for e in extents]
+	return [tasks[k] for k in flmc.SpatialOrder(centres, order)]
+
+def RunBenchmark(tool, sceneConfig, toolParams, cores, tasks, chunk = 1):
+	"""Runs the tasks of a tool with a pool of cores processes, sent in chunks of consecutive tasks, and returns the measurements."""
+	timeStart = time.time()
+	pool = multiprocessing.Pool(processes=cores, initializer=InitWorker, initargs=(sceneConfig, toolParams))
+	timeReady = time.time()
+	results = pool.map(RunTask, [(tool, task) for task in tasks], chunksize=chunk)
+	pool.close()
+	pool.join()
+	seconds = time.time()-timeStart
+	taskSeconds = [r[0] for r in results]
+	peaks = [r[1] for r in results if r[1] != None]
+	record = {"tool":tool, "cores":cores, "tasks":len(tasks), "seconds":seconds, "pool_seconds":timeReady-timeStart,
+		"task_seconds_mean":float(np.mean(taskSeconds)), "task_seconds_max":float(np.max(taskSeconds)),
+		"worker_peak_rss_mb":max(peaks) if len(peaks)>0 else None, "task_peak_rss_mb_mean":float(np.mean(peaks)) if len(peaks)>0 else None, "chunk":chunk}
+	blocks = [r[2] for r in results if r[2] != None]
+	for name in ["hits", "misses", "evictions", "read_mb"]:
+		record["block_"+name] = sum([b[name] for b in blocks]) if len(blocks) > 0 else None
+	record["block_hit_rate"] = record["block_hits"]/float(max(record["block_hits"]+record["block_misses"], 1)) if len(blocks) > 0 else None
+	if(tool == "canopycost"):
+		tileArea = (toolParams["tile_size"]*sceneConfig["cellSize"])**2/1000000.0
+		record["km2_per_second"] = len(tasks)*tileArea/seconds
+	else:
+		record["lines_per_second"] = len(tasks)/seconds
+	return record
+
+def PathCost(window, path):
+	"""Accumulated cost of a path of cell centres over a cost window, as computed by FLM_Engine.CostDistance."""
+	cells = [window.CellOf(x, y) for x, y in path]
+	total = 0.0
+	for (r1, c1), (r2, c2) in zip(cells[:-1], cells[1:]):
+		total += (window.array[r1, c1]+window.array[r2, c2])*0.5*math.hypot(r2-r1, c2-c1)*window.cellSize
+	return total
+
+def PyramidCheck(sceneObj, toolParams, tasks, factor, band, method):
+	"""Accuracy of the pyramid mode (see FLM_Engine.PyramidWindow) against the full resolution result,
+	run in this process. For center lines, the extra cost of the pyramid path over the least cost path
+	and its distance to it. For line footprints, the intersection over union of both footprints."""
+	global scene, params
+	scene = sceneObj
+	params = toolParams
+	radius = toolParams["line_processing_radius"]
+	distance = toolParams["max_line_width"]/2.0
+	excess, offsets, identical, missing, iou = [], [], 0, 0, []
+	seconds = {"centerline":[0.0, 0.0], "linefootprint":[0.0, 0.0]}
+	for key in tasks:
+		vertices = scene.LineVertices(key, scene.lineWidth)
+		chm, canopy, cost = CanopyCostWindow(flme.LineExtent(vertices, radius))
+		start = time.time()
+		full = flme.CenterLine(cost, vertices, radius)
+		middle = time.time()
+		coarse = flme.CenterLine(cost, vertices, radius, factor=factor, band=band, method=method)
+		seconds["centerline"][0] += middle-start
+		seconds["centerline"][1] += time.time()-middle
+		if(full != None and coarse == None):
+			missing += 1
+		elif(full != None):
+			window = flme.LineWindow(cost, vertices, radius)
+			fullCost = PathCost(window, full)
+			excess.append(PathCost(window, coarse)/fullCost-1.0 if fullCost > 0 else 0.0)
+			a, b = np.array(coarse), np.array(full)
+			nearest = np.sqrt(((a[:,None,:]-b[None,:,:])**2).sum(axis=2)).min(axis=1)
+			offsets.append((float(nearest.mean()), float(nearest.max())))
+			identical += int(coarse == full)
+
+		vertices = scene.LineVertices(key)
+		chm, canopy, cost = CanopyCostWindow(flme.LineExtent(vertices, distance))
+		start = time.time()
+		full = flme.LineFootprint(cost, canopy, vertices, distance, toolParams["corridor_threshold"], toolParams["expand_shrink"])
+		middle = time.time()
+		coarse = flme.LineFootprint(cost, canopy, vertices, distance, toolParams["corridor_threshold"], toolParams["expand_shrink"], factor, band, method)
+		seconds["linefootprint"][0] += middle-start
+		seconds["linefootprint"][1] += time.time()-middle
+		union = np.count_nonzero(full.array | coarse.array)
+		iou.append(float(np.count_nonzero(full.array & coarse.array))/union if union > 0 else 1.0)
+
+	record = {"tool":"pyramid_check", "factor":factor, "band":band, "method":method, "tasks":len(tasks),
+		"centerline_cost_excess_mean":float(np.mean(excess)) if len(excess)>0 else None, "centerline_cost_excess_max":float(np.max(excess)) if len(excess)>0 else None,
+		"centerline_offset_mean":float(np.mean([o[0] for o in offsets])) if len(offsets)>0 else None, "centerline_offset_max":float(np.max([o[1] for o in offsets])) if len(offsets)>0 else None,
+		"centerline_identical":identical, "centerline_missing":missing,
+		"footprint_iou_mean":float(np.mean(iou)) if len(iou)>0 else None, "footprint_iou_min":float(np.min(iou)) if len(iou)>0 else None}
+	for tool, (fullSeconds, coarseSeconds) in seconds.items():
+		record[tool+"_speedup"] = fullSeconds/coarseSeconds if coarseSeconds > 0 else None
+	return record
+
+def MachineInfo():
+	return {"host":platform.node(), "platform":platform.platform(), "python":platform.python_version(), "numpy":np.__version__,
+		"backend":flme.Backend(), "cpus":multiprocessing.cpu_count()}
+
+def main(argv = None):
+	parser = argparse.ArgumentParser(description="Benchmark of the FLM tool engines on synthetic data.")
+	parser.add_argument("--area", type=float, default=1.0, help="scene area in km2 (default 1)")
+	parser.add_argument("--lines", type=int, default=100, help="approximate number of lines (default 100)")
+	parser.add_argument("--cell-size", type=float, default=1.0, help="CHM cell size in metres (default 1)")
+	parser.add_argument("--seed", type=int, default=1, help="seed of the synthetic scene (default 1)")
+	parser.add_argument("--tools", default=",".join(tools), help="comma separated tools (default all): "+", ".join(tools))
+	parser.add_argument("--cores", default=None, help="comma separated numbers of cores (default 1, 2, 4... up to the CPU count)")
+	parser.add_argument("--sample", type=int, default=0, help="run only a random sample of this number of tasks of each tool")
+	parser.add_argument("--param", action="append", default=[], help="tool parameter as name=value, e.g. max_line_width=40")
+	parser.add_argument("--chm", default=None, help="CHM raster used in place of the synthetic scene, with --input-lines")
+	parser.add_argument("--input-lines", default=None, help="line feature class used in place of the synthetic scene, with --chm")
+	parser.add_argument("--check-pyramid", action="store_true", help="compare the pyramid mode with the full resolution results instead of timing the tools "+
+		"(pyramid_factor, pyramid_band and pyramid_method settings, factor 4 if not set)")
+	parser.add_argument("--order", default=flmc.GetSetting("task_order", "hilbert"), help="comma separated dispatch orders of the tasks: input, random, hilbert, zorder "+
+		"(default the task_order setting); the I/O reduction is reported relative to the first order")
+	parser.add_argument("--chunk", type=int, default=flmc.TaskChunk(), help="consecutive tasks sent to a worker at a time (default the task_chunk setting)")
+	parser.add_argument("--cache-mb", type=float, default=None, help="size of the block cache of each worker in MB, 0 to disable it (default the block_cache_size setting)")
+	parser.add_argument("--block-cells", type=int, default=None, help="side of the blocks of the block cache in cells (default the block_cache_cells setting)")
+	parser.add_argument("--out", default=os.path.join(flmc.workPath, "FLM_benchmark.jsonl"), help="results file, records are appended")
+	args = parser.parse_args(argv)
+
+	toolParams = dict(defaults)
+	for param in args.param:
+		name, value = param.split("=", 1)
+		if(name not in toolParams):
+			parser.error("unknown parameter "+name)
+		toolParams[name] = type(toolParams[name])(value)
+	if(args.cores == None):
+		cores = [1]
+		while cores[-1]*2 <= multiprocessing.cpu_count():
+			cores.append(cores[-1]*2)
+		if(cores[-1] != multiprocessing.cpu_count()):
+			cores.append(multiprocessing.cpu_count())
+	else:
+		cores = [int(c) for c in args.cores.split(",")]
+	orders = args.order.split(",")
+	for order in orders:
+		if(order not in ["input", "random", "hilbert", "zorder"]):
+			parser.error("unknown order "+order)
+	# Settings of the block cache, passed to the workers through the environment
+	if(args.cache_mb != None):
+		os.environ["FLM_BLOCK_CACHE_SIZE"] = str(args.cache_mb)
+	if(args.block_cells != None):
+		os.environ["FLM_BLOCK_CACHE_CELLS"] = str(args.block_cells)
+
+	if((args.chm == None) != (args.input_lines == None)):
+		parser.error("--chm and --input-lines are used together")
+	if(args.chm != None):
+		sceneConfig = {"chm":args.chm, "inputLines":args.input_lines}
+	else:
+		sceneConfig = {"area":args.area, "lines":args.lines, "cellSize":args.cell_size, "seed":args.seed}
+	sceneObj = MakeScene(sceneConfig)
+	run = {"time":time.strftime("%Y-%m-%d %H:%M:%S"), "version":open(os.path.join(flmc.scriptPath,"FLM_VERSION")).readline().strip(),
+		"machine":MachineInfo(), "scene":sceneObj.Config(), "params":toolParams, "sample":args.sample,
+		"block_cache_mb":flmc.GetSetting("block_cache_size", 256.0), "block_cells":flmc.GetSetting("block_cache_cells", 256)}
+	if(args.chm != None):
+		flmc.log("Benchmark scene: "+args.chm+", "+str(run["scene"]["lines"])+" lines of "+args.input_lines+", backend "+flme.Backend()+".")
+	else:
+		flmc.log("Benchmark scene: "+"{:g}".format(args.area)+" km2, "+str(run["scene"]["lines"])+" lines, line spacing "+"{:.1f}".format(sceneObj.spacing)+" m, backend "+flme.Backend()+".")
+
+	records = []
+	if(args.check_pyramid):
+		factor, band, method = PyramidSettings()
+		record = PyramidCheck(sceneObj, toolParams, Tasks("centerline", sceneObj, toolParams, args.sample, args.seed), factor if factor > 1 else 4, band, method)
+		records.append(record)
+		flmc.log("Pyramid factor "+str(record["factor"])+", band "+"{:g}".format(band)+" m, "+method+": "+str(record["tasks"])+" lines.")
+		if(record["centerline_cost_excess_mean"] != None):
+			flmc.log("Center line: cost above the least cost path "+"{:.2%}".format(record["centerline_cost_excess_mean"])+" on average, "+"{:.2%}".format(record["centerline_cost_excess_max"])+" at most; "+
+				"distance to it "+"{:.2f}".format(record["centerline_offset_mean"])+" m on average, "+"{:.2f}".format(record["centerline_offset_max"])+" m at most; "+
+				str(record["centerline_identical"])+" paths identical, "+str(record["centerline_missing"])+" not found; speedup "+"{:.2f}".format(record["centerline_speedup"])+".")
+		flmc.log("Line footprint: intersection over union "+"{:.3f}".format(record["footprint_iou_mean"])+" on average, "+"{:.3f}".format(record["footprint_iou_min"])+" at least; speedup "+"{:.2f}".format(record["linefootprint_speedup"])+".")
+	for tool in (args.tools.split(",") if not args.check_pyramid else []):
+		if(tool not in taskFunctions):
+			parser.error("unknown tool "+tool)
+		tasks = Tasks(tool, sceneObj, toolParams, args.sample, args.seed)
+		for order in orders:
+			orderedTasks = OrderTasks(tool, tasks, sceneObj, toolParams, order, args.seed)
+			for c in cores:
+				record = RunBenchmark(tool, sceneConfig, toolParams, c, orderedTasks, args.chunk)
+				record["order"] = order
+				# Scaling relative to the first number of cores, and blocks read relative to the first order
+				base = ([r for r in records if r["tool"] == tool and r["order"] == order]+[record])[0]
+				record["speedup"] = base["seconds"]/record["seconds"]
+				record["efficiency"] = record["speedup"]*base["cores"]/c
+				baseOrder = ([r for r in records if r["tool"] == tool and r["cores"] == c]+[record])[0]
+				record["io_reduction"] = 1.0-record["block_misses"]/float(max(baseOrder["block_misses"], 1)) if record["block_misses"] != None else None
+				records.append(record)
+				rate = "{:.2f} km2/s".format(record["km2_per_second"]) if tool == "canopycost" else "{:.2f} lines/s".format(record["lines_per_second"])
+				peak = "n/a" if record["worker_peak_rss_mb"] == None else "{:.0f} MB".format(record["worker_peak_rss_mb"])
+				cache = ""
+				if(record["block_hit_rate"] != None):
+					cache = ", block cache hit rate "+"{:.1%}".format(record["block_hit_rate"])+", "+"{:.0f}".format(record["block_read_mb"])+" MB read, "+str(record["block_evictions"])+" blocks evicted"
+				if(baseOrder is not record and record["io_reduction"] != None):
+					cache += ", I/O reduction "+"{:.1%}".format(record["io_reduction"])+" over "+baseOrder["order"]+" order"
+				flmc.log(tool+" in "+order+" order with "+str(c)+" cores: "+str(len(tasks))+" tasks in "+"{:.2f}".format(record["seconds"])+" s, "+rate+", speedup "+"{:.2f}".format(record["speedup"])+", worker peak "+peak+cache)
+
+	rfile = open(args.out, "a")
+	for record in records:
+		record.update(run)
+		rfile.write(json.dumps(record)+"\n")
+	rfile.close()
+	flmc.log("Results appended to "+args.out)
+	return records
+
+if __name__ == '__main__':
+	main()
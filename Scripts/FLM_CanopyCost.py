@@ -53,6 +53,7 @@ def main():
 	Output_Cost_Raster = args[7].rstrip()
 
 	# Local variables:
+	FLM_CC_CanopyRaster = outWorkspace+"\\FLM_CC_CanopyRaster.tif"
 	FLM_CC_EucRaster = outWorkspace+"\\FLM_CC_EucRaster.tif"
 	FLM_CC_SmoothRaster = outWorkspace+"\\FLM_CC_SmoothRaster.tif"
 	FLM_CC_Mean = outWorkspace+"\\FLM_CC_Mean.tif"
@@ -61,22 +62,22 @@ def main():
 
 	# Process: Turn CHM into a Canopy Closure (CC) map
 	flmc.log("Applying height threshold to CHM...")
-	arcpy.gp.Con_sa(CHM_Raster, 1, Output_Canopy_Raster, 0, "VALUE > "+str(Min_Canopy_Height))
+	arcpy.gp.Con_sa(CHM_Raster, 1, FLM_CC_CanopyRaster, 0, "VALUE > "+str(Min_Canopy_Height))
 	flmc.logStep("Height threshold")
 	
 	# Process: CC Mean
 	flmc.log("Calculating Focal Mean...")
-	arcpy.gp.FocalStatistics_sa(Output_Canopy_Raster, FLM_CC_Mean, Tree_Search_Area, "MEAN")
+	arcpy.gp.FocalStatistics_sa(FLM_CC_CanopyRaster, FLM_CC_Mean, Tree_Search_Area, "MEAN")
 	flmc.logStep("Focal Mean")
 	
 	# Process: CC StDev
 	flmc.log("Calculating Focal StDev..")
-	arcpy.gp.FocalStatistics_sa(Output_Canopy_Raster, FLM_CC_StDev, Tree_Search_Area, "STD")
+	arcpy.gp.FocalStatistics_sa(FLM_CC_CanopyRaster, FLM_CC_StDev, Tree_Search_Area, "STD")
 	flmc.logStep("Focal StDev")
 	
 	# Process: Euclidean Distance
 	flmc.log("Calculating Euclidean Distance From Canopy...")
-	EucAllocation(Con(arcpy.Raster(Output_Canopy_Raster)>=1,1,""),"","","","",FLM_CC_EucRaster,"")
+	EucAllocation(Con(arcpy.Raster(FLM_CC_CanopyRaster)>=1,1,""),"","","","",FLM_CC_EucRaster,"")
 	smoothCost = (float(Max_Line_Distance) - arcpy.Raster(FLM_CC_EucRaster))
 	smoothCost = Con(smoothCost>0,smoothCost,0)/float(Max_Line_Distance)
 	smoothCost.save(FLM_CC_SmoothRaster)
@@ -85,7 +86,7 @@ def main():
 	# Process: Euclidean Distance
 	flmc.log("Calculating Cost Raster...")
 	arcpy.env.compression = "NONE"
-	Raster_CC = arcpy.Raster(Output_Canopy_Raster)
+	Raster_CC = arcpy.Raster(FLM_CC_CanopyRaster)
 	Raster_Mean = arcpy.Raster(FLM_CC_Mean)
 	Raster_StDev = arcpy.Raster(FLM_CC_StDev)
 	Raster_Smooth = arcpy.Raster(FLM_CC_SmoothRaster)
@@ -95,4 +96,8 @@ def main():
 	flmc.logStep("Cost Raster")
 	
 	flmc.log("Saving Outputs...")
-	arcpy.CopyRaster_management(outRas,Output_Cost_Raster,"DEFAULTS")
+	# Tiled and compressed outputs with overviews, canopy as 8 bit and cost as 32 bit float
+	with flmc.Span("Save canopy raster"):
+		flmc.SaveRaster(FLM_CC_CanopyRaster, Output_Canopy_Raster, "8_BIT_UNSIGNED", "255")
+	with flmc.Span("Save cost raster"):
+		flmc.SaveRaster(FLM_CC_CostRaster, Output_Cost_Raster, "32_BIT_FLOAT")
@@ -26,30 +26,61 @@
 #
 # ---------------------------------------------------------------------------
 
-import multiprocessing
 import arcpy
+import numpy as np
 from arcpy.sa import *
-arcpy.CheckOutExtension("Spatial")
 from . import FLM_Common as slmc
+from . import FLM_LineTable as flmlt
+from . import FLM_RasterCache as flmrc
+from . import FLM_GeoPackage as flmg
 
 # Setup script path and workspace folder
 workspaceName = "FLM_CL_output"
 outWorkspace = slmc.GetWorkspace(workspaceName)
-arcpy.env.workspace = outWorkspace
-arcpy.env.overwriteOutput = True
 
-# Load arguments from file
-args = slmc.GetArgs("FLM_CL_params.txt")
+def LoadArgs():
+	"""Loads the tool arguments from the parameter file. Arguments are not loaded when the
+	module is imported, they are loaded when the tool runs and once in each worker process."""
+	global Forest_Line_Feature_Class, Cost_Raster, Line_Processing_Radius, ProcessSegments, RouteWholeLine, Output_Centerline
+	arcpy.CheckOutExtension("Spatial")
+	arcpy.env.workspace = outWorkspace
+	arcpy.env.overwriteOutput = True
 
-# Tool arguments
-Forest_Line_Feature_Class = args[0].rstrip()
-Cost_Raster = args[1].rstrip()
-Line_Processing_Radius = args[2].rstrip()
-ProcessSegments = args[3].rstrip()=="True"
-Output_Centerline = args[4].rstrip()
+	# Load arguments from file
+	args = slmc.GetArgs("FLM_CL_params.txt")
+
+	# Tool arguments
+	Forest_Line_Feature_Class = args[0].rstrip()
+	Cost_Raster = flmrc.CachedRaster(args[1].rstrip())
+	Line_Processing_Radius = args[2].rstrip()
+	ProcessSegments = args[3].rstrip()=="True"
+	RouteWholeLine = args[4].rstrip()=="True"
+	Output_Centerline = args[5].rstrip()
 
 def PathFile(path):
 	return path[path.rfind("\\")+1:]
+
+def SearchRadii():
+	"""Search radii tried by a line task (see FLM_Common.SearchRadii)."""
+	return slmc.SearchRadii(Line_Processing_Radius)
+
+def TouchesEdge(paths, fileBuffer, cellSize):
+	"""True when one of the paths comes within a cell and a half of the boundary of the buffer window,
+	in which case a better path may run outside the window."""
+	rows = arcpy.da.SearchCursor(fileBuffer, ["SHAPE@"])
+	edges = [row[0].boundary() for row in rows]
+	del rows
+	for path in paths:
+		for edge in edges:
+			if(path.distanceTo(edge) <= 1.5*cellSize):
+				return True
+	return False
+
+def PathGeometries(fc):
+	rows = arcpy.da.SearchCursor(fc, ["SHAPE@"])
+	paths = [row[0] for row in rows if row[0] != None]
+	del rows
+	return paths
 	
 def workLines(lineNo):
 	#Temporary files
@@ -62,27 +93,14 @@ def workLines(lineNo):
 	fileCostBack = outWorkspace+"\\FLM_CL_CostBack_" + str(lineNo) +".tif"
 	fileCenterLine = outWorkspace +"\\FLM_CL_CenterLine_" + str(lineNo) +".shp"
 
-	# Load segment list
-	segment_list = []
-	rows = arcpy.SearchCursor(fileSeg)
-	shapeField = arcpy.Describe(fileSeg).ShapeFieldName
-	for row in rows:
-		feat = row.getValue(shapeField)   #creates a geometry object
-		segmentnum = 0
-		for segment in feat: #loops through every segment in a line
-			#loops through every vertex of every segment
-			for pnt in feat.getPart(segmentnum):                 #get.PArt returns an array of points for a particular part in the geometry
-				if pnt:                  #adds all the vertices to segment_list, which creates an array
-					segment_list.append(arcpy.Point(float(pnt.X), float(pnt.Y)))
-
-			segmentnum += 1
-	del rows
+	# Vertices of the line, from the line table written by SplitLines
+	vertices = flmlt.TaskVertices(outWorkspace, "CL", lineNo)
 
 	# Find origin and destination coordinates
-	x1 = segment_list[0].X
-	y1 = segment_list[0].Y
-	x2 = segment_list[-1].X
-	y2 = segment_list[-1].Y
+	x1 = vertices[0][0]
+	y1 = vertices[0][1]
+	x2 = vertices[-1][0]
+	y2 = vertices[-1][1]
 
 	# Create origin feature class
 	arcpy.CreateFeatureclass_management(outWorkspace,PathFile(fileOrigin),"POINT",Forest_Line_Feature_Class,"DISABLED","DISABLED",Forest_Line_Feature_Class)
@@ -99,20 +117,35 @@ def workLines(lineNo):
 	del cursor
 
 	try:
-		# Buffer around line
-		arcpy.Buffer_analysis(fileSeg, fileBuffer, Line_Processing_Radius, "FULL", "ROUND", "NONE", "", "PLANAR")
+		radii = SearchRadii()
+		for radius in radii:
+			# Buffer around line
+			arcpy.Buffer_analysis(fileSeg, fileBuffer, radius, "FULL", "ROUND", "NONE", "", "PLANAR")
 
-		# Clip cost raster using buffer
-		DescBuffer = arcpy.Describe(fileBuffer)
-		SearchBox = str(DescBuffer.extent.XMin)+" "+str(DescBuffer.extent.YMin)+" "+str(DescBuffer.extent.XMax)+" "+str(DescBuffer.extent.YMax)
-		arcpy.Clip_management(Cost_Raster, SearchBox, fileClip, fileBuffer, "", "ClippingGeometry", "NO_MAINTAIN_EXTENT")
-		
-		# Least cost path
-		arcpy.gp.CostDistance_sa(fileOrigin, fileClip, fileCostDist, "", fileCostBack, "", "", "", "", "TO_SOURCE")
-		arcpy.gp.CostPathAsPolyline_sa(fileDestination, fileCostDist, fileCostBack, fileCenterLine, "BEST_SINGLE", "")
+			# Clip cost raster using buffer
+			DescBuffer = arcpy.Describe(fileBuffer)
+			SearchBox = str(DescBuffer.extent.XMin)+" "+str(DescBuffer.extent.YMin)+" "+str(DescBuffer.extent.XMax)+" "+str(DescBuffer.extent.YMax)
+			arcpy.Clip_management(Cost_Raster, SearchBox, fileClip, fileBuffer, "", "ClippingGeometry", "NO_MAINTAIN_EXTENT")
+			
+			# Least cost path. In pyramid mode the band around the coarse path is searched first, then the whole clip if no path is found in it
+			rasters = slmc.PyramidRasters(fileClip, fileOrigin, fileDestination, outWorkspace, "CL", lineNo)
+			for fileSearch in rasters:
+				arcpy.gp.CostDistance_sa(fileOrigin, fileSearch, fileCostDist, "", fileCostBack, "", "", "", "", "TO_SOURCE")
+				arcpy.gp.CostPathAsPolyline_sa(fileDestination, fileCostDist, fileCostBack, fileCenterLine, "BEST_SINGLE", "")
+				if(len(PathGeometries(fileCenterLine)) > 0):
+					break
+			for fileSearch in rasters[:-1]:
+				arcpy.Delete_management(fileSearch)
+
+			# Search again in a larger window if the path was held back by the edge of this one
+			if(radius == radii[-1] or not TouchesEdge(PathGeometries(fileCenterLine), fileBuffer, float(arcpy.Describe(fileClip).meanCellWidth))):
+				break
+	
+	except Exception:
+		slmc.log("Problem with line starting at X "+str(x1)+", Y "+str(y1)+"; and ending at X "+str(x2)+", Y "+str(y2)+".")
+		raise
 	
-	except:
-		print("Problem with line starting at X "+str(x1)+", Y "+str(y1)+"; and ending at X "+str(x1)+", Y "+str(y1)+".")
+	features = flmg.TakeOutput(fileCenterLine, Output_Centerline, outWorkspace, "CL")
 	
 	#Clean temporary files
 	arcpy.Delete_management(fileSeg)
@@ -122,34 +155,165 @@ def workLines(lineNo):
 	arcpy.Delete_management(fileClip)
 	arcpy.Delete_management(fileCostDist)
 	arcpy.Delete_management(fileCostBack)
+	return features
+
+def workLinesWhole(lineNo):
+	"""Routes a line through all of its vertices in a single task. The cost raster is clipped
+	once around the whole line, one least cost path is found for each pair of vertices on that
+	window and the paths are joined into one center-line with the attributes of the input line."""
+	#Temporary files
+	fileSeg = outWorkspace +"\\FLM_CL_Segment_" + str(lineNo) +".shp"
+	fileBuffer = outWorkspace +"\\FLM_CL_Buffer_" + str(lineNo) +".shp"
+	fileClip = outWorkspace+"\\FLM_CL_Clip_" + str(lineNo) +".tif"
+	fileCostBack = outWorkspace+"\\FLM_CL_CostBack_" + str(lineNo) +".tif"
+	fileCenterLine = outWorkspace +"\\FLM_CL_CenterLine_" + str(lineNo) +".shp"
+	memOrigin = "in_memory\\FLM_CL_Origin_" + str(lineNo)
+	memDestination = "in_memory\\FLM_CL_Destination_" + str(lineNo)
+	memLeg = "in_memory\\FLM_CL_Leg_" + str(lineNo)
+
+	# Vertices of the line from the line table written by SplitLines, and attributes of the line
+	vertices = flmlt.TaskVertices(outWorkspace, "CL", lineNo)
+	fieldNames = [field.name for field in arcpy.ListFields(fileSeg) if field.type not in ("OID","Geometry")]
+	attributes = None
+	rows = arcpy.da.SearchCursor(fileSeg, fieldNames)
+	for row in rows:
+		attributes = list(row)
+	del rows
+	if(attributes == None):
+		raise RuntimeError("The segment of the line has no feature")
+	spatialReference = arcpy.Describe(fileSeg).spatialReference
+
+	try:
+		radii = SearchRadii()
+		for radius in radii:
+			# Buffer around the whole line
+			arcpy.Buffer_analysis(fileSeg, fileBuffer, radius, "FULL", "ROUND", "NONE", "", "PLANAR")
+
+			# Clip cost raster using buffer, the same window is used by all legs
+			DescBuffer = arcpy.Describe(fileBuffer)
+			SearchBox = str(DescBuffer.extent.XMin)+" "+str(DescBuffer.extent.YMin)+" "+str(DescBuffer.extent.XMax)+" "+str(DescBuffer.extent.YMax)
+			arcpy.Clip_management(Cost_Raster, SearchBox, fileClip, fileBuffer, "", "ClippingGeometry", "NO_MAINTAIN_EXTENT")
+			RasterClip = Raster(fileClip)
+
+			arcpy.CreateFeatureclass_management("in_memory",PathFile(memOrigin),"POINT","","DISABLED","DISABLED",spatialReference)
+			arcpy.CreateFeatureclass_management("in_memory",PathFile(memDestination),"POINT","","DISABLED","DISABLED",spatialReference)
+
+			path_list = []
+			for vertexID in range(0, len(vertices)-1):
+				origin = vertices[vertexID]
+				destination = vertices[vertexID+1]
+				arcpy.DeleteRows_management(memOrigin)
+				arcpy.DeleteRows_management(memDestination)
+				cursor = arcpy.da.InsertCursor(memOrigin, ["SHAPE@XY"])
+				cursor.insertRow([(float(origin[0]),float(origin[1]))])
+				del cursor
+				cursor = arcpy.da.InsertCursor(memDestination, ["SHAPE@XY"])
+				cursor.insertRow([(float(destination[0]),float(destination[1]))])
+				del cursor
+
+				# Least cost path of the leg
+				RasterCostDist = CostDistance(memOrigin, RasterClip, "", fileCostBack)
+				arcpy.gp.CostPathAsPolyline_sa(memDestination, RasterCostDist, fileCostBack, memLeg, "BEST_SINGLE", "")
+				del RasterCostDist
+
+				leg = flmlt.ReadFeatures(memLeg)
+				arcpy.Delete_management(memLeg)
+				arcpy.Delete_management(fileCostBack)
+				if(len(leg)==0):
+					# Joining the other legs would cross the gap with a straight jump
+					raise RuntimeError("No least cost path between vertices "+str(vertexID)+" and "+str(vertexID+1))
+
+				# Paths are traced from the destination, orient them from origin to destination
+				dFirst = ((leg[0]-origin)**2).sum()
+				dLast = ((leg[-1]-origin)**2).sum()
+				if(dLast < dFirst):
+					leg = leg[::-1]
+
+				# Stitch leg to the path, skipping the vertex shared with the previous leg
+				if(len(path_list)>0 and (path_list[-1][-1] == leg[0]).all()):
+					leg = leg[1:]
+				if(len(leg)>0):
+					path_list.append(leg)
+			del RasterClip
+
+			# Search again in a larger window if the path was held back by the edge of this one
+			if(radius == radii[-1] or len(path_list) == 0):
+				break
+			if(not TouchesEdge([flmlt.Polyline([np.concatenate(path_list)], spatialReference)], fileBuffer, float(arcpy.Describe(fileClip).meanCellWidth))):
+				break
+			arcpy.Delete_management(memOrigin)
+			arcpy.Delete_management(memDestination)
+
+		if(len(path_list) == 0):
+			raise RuntimeError("No least cost path was found for the line")
+
+		# Center line with the attributes of the input line
+		arcpy.CreateFeatureclass_management(outWorkspace,PathFile(fileCenterLine),"POLYLINE",fileSeg,"DISABLED","DISABLED",spatialReference)
+		cursor = arcpy.da.InsertCursor(fileCenterLine, fieldNames+["SHAPE@"])
+		cursor.insertRow(attributes+[flmlt.Polyline([np.concatenate(path_list)], spatialReference)])
+		del cursor
 
-def main():	
+	except Exception:
+		slmc.log("Problem with line starting at X "+str(vertices[0][0])+", Y "+str(vertices[0][1])+"; and ending at X "+str(vertices[-1][0])+", Y "+str(vertices[-1][1])+".")
+		raise
+
+	features = flmg.TakeOutput(fileCenterLine, Output_Centerline, outWorkspace, "CL")
+
+	#Clean temporary files
+	arcpy.Delete_management(fileSeg)
+	arcpy.Delete_management(fileBuffer)
+	arcpy.Delete_management(fileClip)
+	arcpy.Delete_management(memOrigin)
+	arcpy.Delete_management(memDestination)
+	return features
+
+def main():
+	LoadArgs()
 	global outWorkspace
 	outWorkspace = slmc.SetupWorkspace(workspaceName)
 
 	#Prepare input lines for multiprocessing
-	numLines = slmc.SplitLines(Forest_Line_Feature_Class, outWorkspace, "CL", ProcessSegments)
+	if(ProcessSegments and RouteWholeLine):
+		# One task per line keeping all its attributes, legs are routed and joined inside the task
+		# Fields maintained by the geodatabase (e.g. Shape_Length) are not copied
+		keepFields = [field.name for field in arcpy.ListFields(Forest_Line_Feature_Class) if field.type not in ("OID","Geometry","GlobalID","Blob","Raster")
+			and field.editable and field.name.lower() not in ("shape_length","shape_area")]
+		numLines = slmc.SplitLines(Forest_Line_Feature_Class, outWorkspace, "CL", False, keepFields)
+		workFunction = workLinesWhole
+	else:
+		numLines = slmc.SplitLines(Forest_Line_Feature_Class, outWorkspace, "CL", ProcessSegments)
+		workFunction = workLines
+	
+	# Center lines are written to a GeoPackage as the lines finish
+	writer = flmg.OpenOutput(outWorkspace, "CL", Output_Centerline) if flmg.UseGeoPackage(Output_Centerline) else None
 	
-	pool = multiprocessing.Pool(processes=slmc.GetCores())
 	slmc.log("Multiprocessing center lines...")
-	pool.map(workLines, range(1,numLines+1))
-	pool.close()
-	pool.join()
+	slmc.MapTasks(workFunction, range(1,numLines+1), slmc.LineTaskMemory(numLines, Line_Processing_Radius, Cost_Raster), writer.Add if writer != None else None)
 	
 	slmc.logStep("Center line multiprocessing")
+	slmc.ReportFailures(Forest_Line_Feature_Class, outWorkspace, "CL", Output_Centerline, ["Origin", "Destination", "Buffer", "Clip", "CostDist", "CostBack", "CenterLine"])
 	
 	slmc.log("Merging footprint layers...")
-	tempShapefiles = arcpy.ListFeatureClasses()
-	
-	arcpy.Merge_management(tempShapefiles,Output_Centerline)
-
-	slmc.logStep("Merging")
+	if(writer != None):
+		flmg.CloseOutput(writer, outWorkspace, "CL", Output_Centerline)
+		slmc.logStep("Merging")
+	else:
+		tempShapefiles = arcpy.ListFeatureClasses()
 		
-	for shp in tempShapefiles:
-		arcpy.Delete_management(shp)
+		arcpy.Merge_management(tempShapefiles,Output_Centerline)
+
+		slmc.logStep("Merging")
+			
+		for shp in tempShapefiles:
+			arcpy.Delete_management(shp)
 	
-	arcpy.AddField_management(Output_Centerline, "CorridorTh","DOUBLE")
-	arcpy.CalculateField_management(Output_Centerline, "CorridorTh","3")
+	# Lines routed whole may already carry a threshold from the input lines
+	if(flmg.IsGeoPackage(Output_Centerline)):
+		if(flmg.HasColumn(Output_Centerline, "CorridorTh") == False):
+			flmg.AddColumn(Output_Centerline, "CorridorTh", "DOUBLE", 3)
+	elif("CorridorTh" not in [field.name for field in arcpy.ListFields(Output_Centerline)]):
+		arcpy.AddField_management(Output_Centerline, "CorridorTh","DOUBLE")
+		arcpy.CalculateField_management(Output_Centerline, "CorridorTh","3")
 	
 if __name__ == '__main__':
 	main()
\ No newline at end of file
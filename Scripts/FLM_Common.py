@@ -30,20 +30,71 @@
 # ---------------------------------------------------------------------------
 
 import time
+import os, sys, json, math, glob, atexit, signal, traceback, threading, collections, multiprocessing, importlib
 try:
-    import tkinter as tk
+	import queue
 except ImportError:
-    import Tkinter as tk
-import os, sys, multiprocessing
-timeStart = time.clock()
+	import Queue as queue
+# High resolution timer of the log, time.clock on Python 2.7 (ArcMap)
+clock = time.perf_counter if hasattr(time, "perf_counter") else time.clock
+timeStart = clock()
 timeLast = timeStart
 scriptPath = os.path.dirname(os.path.realpath(__file__))
+# Folder for parameter files, cores file, scratch workspaces and log. Batch jobs (see FLM_Batch)
+# set FLM_WORKDIR to an isolated folder so that several jobs can run at the same time.
+workPath = os.environ.get("FLM_WORKDIR", scriptPath)
+logFile = os.path.join(workPath,"log.txt") if "FLM_WORKDIR" in os.environ else "log.txt"
 coresFile = "mpc.txt"
+settingsFile = "flm_settings.txt"
+# Parsed settings file and the path, time and size of the file it was parsed from (see ReadSettings)
+settingsCache = None
+# Measurements of previous runs used by AutoTune
+tuningFile = "flm_tuning.json"
+# Pool kept alive between tool runs by FLM_Daemon, and the job it is running
+warmPool = None
+warmJob = None
+# Job for which each tool module loaded its arguments in this process
+loadedJobs = {}
+rasterCache = {}
+# Scratch workspaces created in RAM by this process, removed at the end of the run (see RamScratch)
+scratchRuns = []
+# Extent of each line split by SplitLines, used to estimate the memory of line tasks
+lineExtents = {}
+# Home tiles of the line tasks of each tool (see LineTiles) and tile clip of each raster used by the
+# line tasks of this process in tile mode, as (tile, file) (see TileSource)
+lineTiles = {}
+tileRasters = collections.OrderedDict()
+# Number of cells of the raster read by the line tasks (see LineTaskMemory)
+taskRasterCells = None
+# Profiling spans recorded in this process (see Span and WriteTrace)
+tracing = None
+traceSpans = []
+traceName = None
+traceStart = time.time()
+traceLast = traceStart
+traceTask = None
+# Attempt of the task running in this worker, tasks that failed in the last MapTasks as (task, attempts,
+# reason), and the queue used by worker processes to report the tasks they start (see MapGoverned)
+taskAttempt = 0
+failedTasks = []
+taskStarts = None
+startsManager = None
+# Jobs of the last MapGoverned whose worker was killed or ended. A pool waits for their results
+# when it is closed, so pools with lost jobs are terminated instead
+lostJobs = 0
+# Log records waiting to be written, and the queue used by worker processes to send their records
+logSettings = None
+logBuffer = []
+logFlushed = time.time()
+logLock = threading.Lock()
+logQueue = None
 
 def logStart(tool):
+	if(GetLogSettings()["per_run"]):
+		StartRunLog(tool.title)
 	log("----------")
 	global timeStart, timeLast
-	timeStart = time.clock()
+	timeStart = clock()
 	timeLast = timeStart
 	log("Running tool: "+tool.title)
 	log("Processing initiated at: "+time.strftime("%a, %d %b %Y %H:%M:%S +0000", time.localtime()))
@@ -56,39 +107,131 @@ def logStart(tool):
 
 def logStep(stepName):
 	global timeLast
-	timeThis = time.clock()
+	timeThis = clock()
 	log(stepName+" is done! Execution time: "+"{:.2f}".format(timeThis-timeLast)+" seconds")
 	timeLast = timeThis
+	global traceLast
+	traceThis = time.time()
+	AddSpan(stepName, traceLast, traceThis, "step")
+	traceLast = traceThis
 	log("----------")
+	FlushLog()
 
 def logEnd(tool):
 	log("\nTool "+tool.title+" has executed successfully!")
-	timeEnd = time.clock()
+	timeEnd = clock()
 	global timeStart
 	log("Total Execution Time: "+"{:.2f}".format(timeEnd-timeStart)+" seconds")
+	FlushLog()
 
 def log(text, onlyFile = False):
+	"""Prints text and adds it to the log. Records are written to the log file in batches.
+	Worker processes send their records to the parent process, which writes them (see LogListener)."""
 	if(onlyFile == False):
 		print(text)
-	text_file = open(r"log.txt","a")
-	text_file.write(text+"\n")
-	text_file.close() 
-	del text_file
-	
+	record = {"time":time.time(), "pid":os.getpid(), "message":text}
+	if(traceTask != None):
+		record["task"] = traceTask
+	if(logQueue != None):
+		logQueue.put(record)
+	else:
+		WriteRecord(record)
+
+def GetLogSettings():
+	global logSettings
+	if(logSettings == None):
+		logSettings = {"format":GetSetting("log_format", "text"), "batch":GetSetting("log_batch", 100),
+			"interval":GetSetting("log_interval", 2.0), "per_run":GetSetting("log_per_run", False)}
+	return logSettings
+
+def GetLogPath():
+	if(GetLogSettings()["format"] == "json"):
+		return os.path.splitext(logFile)[0]+".jsonl"
+	return logFile
+
+def WriteRecord(record):
+	"""Adds a record to the log buffer, which is written when it is full or after the log interval."""
+	settings = GetLogSettings()
+	with logLock:
+		logBuffer.append(record)
+		full = len(logBuffer) >= settings["batch"] or time.time()-logFlushed >= settings["interval"]
+	if(full):
+		FlushLog()
+
+def FlushLog():
+	"""Writes the buffered log records to the log file with a single write."""
+	global logBuffer, logFlushed
+	with logLock:
+		records = logBuffer
+		logBuffer = []
+		logFlushed = time.time()
+		if(len(records) == 0):
+			return
+		if(GetLogSettings()["format"] == "json"):
+			lines = [json.dumps(record) for record in records]
+		else:
+			lines = [record["message"] for record in records]
+		text_file = open(GetLogPath(),"a")
+		text_file.write("\n".join(lines)+"\n")
+		text_file.close()
+
+atexit.register(FlushLog)
+
+def SetLogQueue(queue):
+	"""Sends the log records of a worker process to the parent process through queue.
+	Records copied from the parent when the worker was forked are discarded."""
+	global logQueue
+	logQueue = queue
+	if(queue != None):
+		with logLock:
+			del logBuffer[:]
+
+class LogListener(threading.Thread):
+	"""Writes the log records that worker processes send through queue, until stop is called."""
+	def __init__(self, queue):
+		threading.Thread.__init__(self)
+		self.daemon = True
+		self.queue = queue
+	def run(self):
+		while True:
+			record = self.queue.get()
+			if(record == None):
+				break
+			WriteRecord(record)
+		FlushLog()
+	def stop(self):
+		self.queue.put(None)
+		self.join()
+
+def StartRunLog(name):
+	"""Sends the log of a tool run to its own file in the logs folder of workPath."""
+	global logFile
+	logsPath = os.path.join(workPath,"logs")
+	if(os.path.isdir(logsPath) == False):
+		os.makedirs(logsPath)
+	runLog = os.path.join(logsPath, time.strftime("%Y%m%d_%H%M%S")+"_"+name.replace(" ","_")+"_"+str(os.getpid())+".txt")
+	log("Run log: "+runLog)
+	FlushLog()
+	logFile = runLog
+
 def refreshLog():
-	text_file = open(r"log.txt","w")
+	with logLock:
+		del logBuffer[:]
+	text_file = open(GetLogPath(),"w")
 	text_file.write("")
 	text_file.close() 
 	del text_file
 	
 def newLog(version):
-	text_file = open(r"log.txt","a")
-	text_file.write("\n\n###\n\n\n")
-	text_file.close() 
+	FlushLog()
+	if(GetLogSettings()["format"] != "json"):
+		text_file = open(GetLogPath(),"a")
+		text_file.write("\n\n###\n\n\n")
+		text_file.close() 
+		del text_file
 	log("Forest Line Mapper v. "+str(version))
 	log("Python "+str(sys.version))
 	log("Time: "+time.strftime("%a, %d %b %Y %H:%M:%S +0000", time.localtime()))
-	del text_file
 
 def PathFileName (path):
 	return os.path.basename(path)
@@ -99,7 +242,7 @@ def FileToField(filen):
 def GetArgs(paramFile):
 	# Load arguments from file
 	try:
-		paramFile = scriptPath+"\\"+paramFile
+		paramFile = workPath+"\\"+paramFile
 		pfile = open(paramFile,"r")
 		args = pfile.readlines()
 		pfile.close()
@@ -108,7 +251,7 @@ def GetArgs(paramFile):
 		return ["-1"]*100
 
 def SetArgs(paramFile, args):
-		paramFile = scriptPath+"\\"+paramFile
+		paramFile = workPath+"\\"+paramFile
 		pfile = open(paramFile,"w")
 		for arg in args:
 			pfile.write(str(arg)+"\n")
@@ -116,7 +259,7 @@ def SetArgs(paramFile, args):
 
 def GetCores():
 	maxCores = multiprocessing.cpu_count()
-	coresPath = scriptPath+"\\"+coresFile
+	coresPath = workPath+"\\"+coresFile
 	try:
 		cfile = open(coresPath,"r")
 		args = cfile.readlines()
@@ -136,17 +279,940 @@ def GetCores():
 		return maxCores
 
 def SetCores(cores):
-	coresPath = scriptPath+"\\"+coresFile
+	coresPath = workPath+"\\"+coresFile
 	cfile = open(coresPath,"w")
 	cfile.write(str(cores))
 	cfile.close()
 
+def ReadSettings():
+	"""Settings of the settings file as {name: value}. The file is parsed again only when its
+	modification time or size changes, as settings are read for every task."""
+	global settingsCache
+	settingsPath = os.path.join(scriptPath,settingsFile)
+	try:
+		stat = os.stat(settingsPath)
+		key = (settingsPath, stat.st_mtime, stat.st_size)
+	except OSError:
+		key = (settingsPath, None, None)
+	if(settingsCache == None or settingsCache[0] != key):
+		try:
+			sfile = open(settingsPath,"r")
+			lines = sfile.readlines()
+			sfile.close()
+		except:
+			lines = []
+		settings = {}
+		for line in lines:
+			if(line.count("=")>0):
+				settings[line.split("=")[0].strip()] = line[line.find("=")+1:].strip()
+		settingsCache = (key, settings)
+	return settingsCache[1]
+
+def GetSetting(name, default = None):
+	"""Returns an execution setting. Settings are read from environment variables named
+	FLM_<NAME> or from the settings file, which holds one name=value pair per line.
+	The value is converted to the type of the default, which is returned if the setting is missing."""
+	value = os.environ.get("FLM_"+name.upper())
+	if(value == None):
+		value = ReadSettings().get(name)
+	if(value == None or value == ""):
+		return default
+	try:
+		if(type(default)==bool):
+			return value == "True"
+		elif(default != None):
+			return type(default)(value)
+	except ValueError:
+		return default
+	return value
+
+def SetSetting(name, value):
+	global settingsCache
+	settingsPath = os.path.join(scriptPath,settingsFile)
+	try:
+		sfile = open(settingsPath,"r")
+		lines = [line for line in sfile.readlines() if line.split("=")[0].strip() != name]
+		sfile.close()
+	except:
+		lines = []
+	lines.append(name+"="+str(value)+"\n")
+	sfile = open(settingsPath,"w")
+	sfile.writelines(lines)
+	sfile.close()
+	# Read again even if the file time did not change
+	settingsCache = None
+
+def TraceEnabled():
+	global tracing
+	if(tracing == None):
+		tracing = GetSetting("trace", True)
+	return tracing
+
+def AddSpan(name, start, end, category = "flm", args = None):
+	"""Records a profiling span of the current process, with start and end given by time.time().
+	Spans recorded while a task runs are tagged with the task."""
+	if(TraceEnabled() == False):
+		return
+	event = {"name":name, "cat":category, "ph":"X", "ts":int(start*1000000), "dur":int((end-start)*1000000), "pid":os.getpid(), "tid":os.getpid()}
+	args = dict(args or {})
+	if(traceTask != None):
+		args["task"] = traceTask
+	if(len(args)>0):
+		event["args"] = args
+	traceSpans.append(event)
+
+def TakeSpans():
+	"""Returns and clears the spans recorded in this process, used to send worker spans to the parent."""
+	global traceSpans
+	spans = traceSpans
+	traceSpans = []
+	return spans
+
+class Span:
+	"""Records a profiling span around a block of code. Spans can be nested, e.g.:
+		with flmc.Span("Dissolve"):
+			arcpy.Dissolve_management(...)"""
+	def __init__(self, name, category = "flm", **args):
+		self.name = name
+		self.category = category
+		self.args = args
+	def __enter__(self):
+		self.start = time.time()
+		return self
+	def __exit__(self, excType, excValue, tb):
+		AddSpan(self.name, self.start, time.time(), self.category, self.args)
+		return False
+
+def StartTrace(name):
+	"""Clears the spans of a previous run and starts the timeline of a tool run."""
+	global traceName, traceStart, traceLast
+	TakeSpans()
+	traceName = name
+	traceStart = time.time()
+	traceLast = traceStart
+
+def WriteTrace():
+	"""Writes the spans of the tool run started with StartTrace, from the parent and the workers,
+	as a Chrome trace-event file that can be opened in chrome://tracing or Perfetto."""
+	if(TraceEnabled() == False or traceName == None):
+		return
+	AddSpan(traceName, traceStart, time.time(), "tool")
+	events = []
+	for pid in sorted(set([span["pid"] for span in traceSpans])):
+		name = "FLM main" if pid == os.getpid() else "FLM worker "+str(pid)
+		events.append({"name":"process_name", "ph":"M", "pid":pid, "tid":pid, "args":{"name":name}})
+	tracePath = GetSetting("trace_path", os.path.join(workPath,"FLM_trace.json"))
+	try:
+		tfile = open(tracePath,"w")
+		json.dump({"traceEvents":events+traceSpans, "displayTimeUnit":"ms"}, tfile)
+		tfile.close()
+		log("Profiling trace saved to "+tracePath, True)
+	except IOError as e:
+		log("Profiling trace could not be saved: "+str(e), True)
+
+def AddWorkerSpans(tracedResults):
+	"""Keeps the spans returned by RunTracedTask, logs the memory peaks of the tasks and returns the task results."""
+	results = []
+	peaks = []
+	for result, spans, peak in tracedResults:
+		traceSpans.extend(spans)
+		results.append(result)
+		if(peak != None):
+			peaks.append(peak)
+	if(len(peaks)>0):
+		log("Worker memory peak per task: "+"{:.0f}".format(sum(peaks)/len(peaks))+" MB average, "+"{:.0f}".format(max(peaks))+" MB maximum.", True)
+	return results
+
+def PeakMemory():
+	"""Peak resident memory of this process in MB, or None if it can not be measured.
+	On Linux the peak can be reset with ResetPeakMemory to measure the peak of each task."""
+	try:
+		sfile = open("/proc/self/status","r")
+		lines = sfile.readlines()
+		sfile.close()
+		for line in lines:
+			if(line.startswith("VmHWM:")):
+				return float(line.split()[1])/1024.0
+	except IOError:
+		pass
+	try:
+		import resource
+		peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+		return peak/1048576.0 if sys.platform == "darwin" else peak/1024.0
+	except ImportError:
+		pass
+	try:
+		import ctypes
+		from ctypes import wintypes
+		class MemoryCounters(ctypes.Structure):
+			_fields_ = [("cb", wintypes.DWORD), ("PageFaultCount", wintypes.DWORD)]+[(name, ctypes.c_size_t) for name in ["PeakWorkingSetSize",
+				"WorkingSetSize", "QuotaPeakPagedPoolUsage", "QuotaPagedPoolUsage", "QuotaPeakNonPagedPoolUsage", "QuotaNonPagedPoolUsage", "PagefileUsage", "PeakPagefileUsage"]]
+		counters = MemoryCounters()
+		counters.cb = ctypes.sizeof(counters)
+		ctypes.windll.psapi.GetProcessMemoryInfo(ctypes.windll.kernel32.GetCurrentProcess(), ctypes.byref(counters), counters.cb)
+		return counters.PeakWorkingSetSize/1048576.0
+	except Exception:
+		return None
+
+def ResetPeakMemory():
+	# Only possible on Linux, elsewhere the peak of a task includes the previous tasks of the worker
+	try:
+		cfile = open("/proc/self/clear_refs","w")
+		cfile.write("5")
+		cfile.close()
+	except IOError:
+		pass
+
+def AvailableMemory():
+	"""Physical memory available in MB, or None if it can not be measured."""
+	try:
+		import ctypes
+		class MemoryStatus(ctypes.Structure):
+			_fields_ = [("dwLength", ctypes.c_ulong), ("dwMemoryLoad", ctypes.c_ulong)]+[(name, ctypes.c_ulonglong) for name in ["ullTotalPhys",
+				"ullAvailPhys", "ullTotalPageFile", "ullAvailPageFile", "ullTotalVirtual", "ullAvailVirtual", "ullAvailExtendedVirtual"]]
+		status = MemoryStatus()
+		status.dwLength = ctypes.sizeof(status)
+		ctypes.windll.kernel32.GlobalMemoryStatusEx(ctypes.byref(status))
+		return status.ullAvailPhys/1048576.0
+	except Exception:
+		pass
+	try:
+		return os.sysconf("SC_AVPHYS_PAGES")*os.sysconf("SC_PAGE_SIZE")/1048576.0
+	except (ValueError, AttributeError, OSError):
+		return None
+
+def FreeSpace(path):
+	"""Free space in bytes of the file system holding path, or None if it can not be measured.
+	shutil.disk_usage does not exist on Python 2.7, where GetDiskFreeSpaceExW or statvfs is used."""
+	import shutil
+	if(hasattr(shutil, "disk_usage")):
+		try:
+			return shutil.disk_usage(path).free
+		except OSError:
+			return None
+	try:
+		import ctypes
+		free = ctypes.c_ulonglong(0)
+		if(ctypes.windll.kernel32.GetDiskFreeSpaceExW(ctypes.c_wchar_p(path), None, None, ctypes.byref(free)) == 0):
+			return None
+		return free.value
+	except Exception:
+		pass
+	try:
+		stat = os.statvfs(path)
+		return stat.f_bavail*stat.f_frsize
+	except (AttributeError, OSError):
+		return None
+
+def WindowMemory(extent, distance, cellSize, rasters = 8):
+	"""Estimated memory in MB of processing a raster window: rasters float64 arrays
+	covering extent (xMin, yMin, xMax, yMax) expanded by distance."""
+	cells = ((extent[2]-extent[0]+2*distance)/cellSize+1)*((extent[3]-extent[1]+2*distance)/cellSize+1)
+	return cells*8*rasters/1048576.0
+
+def LineTaskMemory(numLines, distance, raster):
+	"""Estimated memory in MB of each line task, from the line extents recorded by SplitLines
+	expanded by distance, at the cell size of raster. Estimates are scaled by the memory_factor setting."""
+	import arcpy
+	global taskRasterCells
+	desc = arcpy.Describe(raster)
+	cellSize = float(desc.meanCellWidth)
+	taskRasterCells = int(desc.width)*int(desc.height)
+	factor = GetSetting("memory_factor", 1.0)
+	return [WindowMemory(lineExtents[line], float(distance), cellSize)*factor for line in range(1, numLines+1)]
+
+def LineTiles(outWorkspace, toolCodename):
+	"""Home tile of each line task written by SplitLines, for the tile mode of the corridor tools. With the
+	line_tile_size setting (map units, 0 disables the mode) the area is split in square tiles and a line
+	belongs to the tile holding the centre of its extent. Returns a list with the (column, row) tile of
+	each task, which MapTasks uses to run the lines of a tile in one worker, or None when the mode is off."""
+	size = GetSetting("line_tile_size", 0.0)
+	if(size <= 0):
+		return None
+	import numpy as np
+	from . import FLM_LineTable as flmlt
+	table = flmlt.Tasks(outWorkspace, toolCodename)
+	cached = lineTiles.get((outWorkspace, toolCodename))
+	if(cached == None or cached[0] is not table or cached[1] != size):
+		bounds = table.bounds
+		centres = np.nan_to_num(np.column_stack([bounds[:,0]+bounds[:,2], bounds[:,1]+bounds[:,3]])/2.0)
+		cached = (table, size, [(int(col), int(row)) for col, row in np.floor(centres/size)])
+		lineTiles[(outWorkspace, toolCodename)] = cached
+	return cached[2]
+
+def TileSource(raster, outWorkspace, toolCodename, lineNo, distance):
+	"""Raster from which the window of a line task is clipped. In tile mode (see LineTiles) raster is clipped
+	once in each process around all the lines of the home tile of the line, with a halo of distance, and
+	the following lines of the tile are clipped from that smaller raster instead of the whole raster.
+	The clip of the previous tile is deleted. Returns raster when the mode is off."""
+	tiles = LineTiles(outWorkspace, toolCodename)
+	if(tiles == None):
+		return raster
+	import arcpy
+	import numpy as np
+	from . import FLM_LineTable as flmlt
+	tile = tiles[lineNo-1]
+	current = tileRasters.setdefault((raster, toolCodename), None)
+	if(current != None and current[0] == tile and arcpy.Exists(current[1])):
+		return current[1]
+	if(current != None):
+		# Raster objects open on the clip would lock it
+		rasterCache.pop(current[1], None)
+		arcpy.Delete_management(current[1])
+
+	# Extent of the lines of the tile, which may reach out of the tile, with the halo and a margin of two cells
+	bounds = flmlt.Tasks(outWorkspace, toolCodename).bounds
+	lines = [i for i in range(0, len(tiles)) if tiles[i] == tile and np.isfinite(bounds[i]).all()]
+	if(len(lines) == 0):
+		return raster
+	halo = float(distance)+2*float(arcpy.Describe(raster).meanCellWidth)
+	xMin, yMin = bounds[lines,0].min()-halo, bounds[lines,1].min()-halo
+	xMax, yMax = bounds[lines,2].max()+halo, bounds[lines,3].max()+halo
+	rasterNo = list(tileRasters.keys()).index((raster, toolCodename))
+	fileTile = outWorkspace+"\\FLM_"+toolCodename+"_Tile_"+str(os.getpid())+"_"+str(rasterNo)+"_"+str(tile[0])+"_"+str(tile[1])+".tif"
+	with Span("Tile clip", tile=str(tile)):
+		arcpy.Clip_management(raster, str(xMin)+" "+str(yMin)+" "+str(xMax)+" "+str(yMax), fileTile, "", "", "NONE", "NO_MAINTAIN_EXTENT")
+	tileRasters[(raster, toolCodename)] = (tile, fileTile)
+	return fileTile
+
+def OpenTileSource(raster, outWorkspace, toolCodename, lineNo, distance):
+	"""Returns an arcpy Raster object of the TileSource of a line. The whole raster is kept open for the
+	life of the process (see OpenRaster), tile clips are opened for the task only, so that no handle
+	is left on a clip when it is deleted."""
+	source = TileSource(raster, outWorkspace, toolCodename, lineNo, distance)
+	if(source == raster):
+		return OpenRaster(raster)
+	import arcpy
+	return arcpy.Raster(source)
+
+def RemoveTiles(outWorkspace, toolCodename):
+	"""Deletes the tile clips left by the line tasks of the last MapTasks (see TileSource)."""
+	import arcpy
+	for fileTile in glob.glob(os.path.join(outWorkspace, "FLM_"+toolCodename+"_Tile_*.tif")):
+		arcpy.Delete_management(fileTile)
+
+def CurveKeys(xs, ys, curve = "hilbert", bits = 16):
+	"""Position along a space filling curve of cells (xs, ys), integer arrays in [0, 2**bits). Cells that
+	are close on the Hilbert curve are close on the ground; the Z-order (Morton) curve is cheaper but
+	jumps at the edges of its quadrants."""
+	import numpy as np
+	x = np.asarray(xs, dtype=np.int64)
+	y = np.asarray(ys, dtype=np.int64)
+	keys = np.zeros(x.shape, dtype=np.int64)
+	if(curve == "zorder"):
+		for b in range(0, bits):
+			keys |= ((x >> b) & 1) << (2*b) | ((y >> b) & 1) << (2*b+1)
+		return keys
+	n = 1 << bits
+	s = n >> 1
+	while s > 0:
+		rx = (x & s) > 0
+		ry = (y & s) > 0
+		keys += s*s*((3*rx) ^ ry)
+		# Rotate the quadrant so that the curve continues from the previous one
+		flip = ~ry & rx
+		x = np.where(flip, n-1-x, x)
+		y = np.where(flip, n-1-y, y)
+		x, y = np.where(ry, x, y), np.where(ry, y, x)
+		s >>= 1
+	return keys
+
+def SpatialOrder(points, curve = "hilbert"):
+	"""Indices of points, a (n, 2) array of coordinates, sorted along a space filling curve over their extent
+	(see CurveKeys). Points that are not finite are kept at the end in their order."""
+	import numpy as np
+	points = np.asarray(points, dtype=np.float64).reshape(-1, 2)
+	known = np.isfinite(points).all(axis=1)
+	order = np.arange(len(points))
+	if(known.sum() < 2):
+		return [int(i) for i in order]
+	low = points[known].min(axis=0)
+	size = max((points[known].max(axis=0)-low).max(), 1e-9)
+	cells = np.floor((points[known]-low)/size*65535).astype(np.int64)
+	keys = CurveKeys(cells[:,0], cells[:,1], curve)
+	return [int(i) for i in order[known][np.argsort(keys, kind="stable")]]+[int(i) for i in order[~known]]
+
+def TaskOrder(tasks):
+	"""Order in which MapTasks dispatches tasks, as a list of task indices. Line tasks of the lines split by
+	SplitLines are sorted along a space filling curve of the centres of their extents (task_order setting,
+	"hilbert" by default, "zorder" or "input"), so that consecutive tasks read the same blocks of the rasters
+	and the chunks sent to a worker cover one area. Other tasks are run in input order."""
+	curve = GetSetting("task_order", "hilbert")
+	order = list(range(0, len(tasks)))
+	if(curve not in ["hilbert", "zorder"] or len(tasks) < 3):
+		return order
+	if(any([isinstance(task, bool) or not isinstance(task, int) or task not in lineExtents for task in tasks])):
+		return order
+	centres = [((lineExtents[task][0]+lineExtents[task][2])/2.0, (lineExtents[task][1]+lineExtents[task][3])/2.0) for task in tasks]
+	return SpatialOrder(centres, curve)
+
+def TaskError(e):
+	"""One line description of the error of a task, as recorded in failedTasks."""
+	return type(e).__name__+": "+" ".join(str(e).split())
+
+def KillProcess(pid):
+	try:
+		os.kill(pid, signal.SIGTERM)
+	except OSError:
+		pass
+
+def MapGoverned(pool, cores, moduleTasks, taskMemory = None, onResult = None, chunk = 1, starts = None, groups = None, order = None):
+	"""Runs the tasks on pool and returns the results of RunTracedTask in task order.
+	Tasks are started in the order of order, a list of task indices (see TaskOrder), or in task order.
+	Memory: when taskMemory is given, tasks are started in that order only while the estimated memory of
+	the running tasks stays under the memory budget. A task is always started when no other task is running.
+	Faults: a task that raises an error, runs longer than the task_timeout setting (seconds) or whose
+	worker process ends is run again up to task_retries times, with smaller windows (see RetryDistance).
+	The worker of a task that timed out is killed, the pool starts a new one. Tasks that still fail are
+	recorded in failedTasks with the reason and their result is None, the other tasks carry on.
+	Timeouts and ended workers are detected when the workers report the tasks they start through the
+	starts queue (see SetTaskQueue).
+	chunk is the number of consecutive tasks sent to a worker at a time. With groups, a list of keys
+	with one key for each task, the tasks with the same key are sent to a worker together instead, in
+	the order of their first started task, and their memory is that of the largest task as they run one at a time.
+	If onResult is given, each task result is passed to it when the task finishes and replaced by the value it returns."""
+	global lostJobs
+	budget = float("inf")
+	if(taskMemory != None):
+		budget = GetSetting("memory_budget", 0.0)
+		if(budget <= 0):
+			available = AvailableMemory()
+			budget = available*0.8 if available != None else float("inf")
+		log("Memory budget of "+"{:.0f}".format(budget)+" MB for line tasks, largest task estimated at "+"{:.0f}".format(max(taskMemory))+" MB.", True)
+	timeout = GetSetting("task_timeout", 0.0)
+	retries = GetSetting("task_retries", 1)
+	done = queue.Queue()
+	results = [None]*len(moduleTasks)
+	# Jobs waiting to start, lists of (task index, attempt)
+	order = order if order != None else list(range(0, len(moduleTasks)))
+	if(groups != None):
+		jobs = collections.OrderedDict()
+		for i in order:
+			jobs.setdefault(groups[i], []).append((i, 0))
+		waiting = collections.deque(jobs.values())
+	else:
+		waiting = collections.deque([[(i, 0) for i in order[k:k+chunk]] for k in range(0, len(order), chunk)])
+	running = {}
+	nextJob = 0
+	remaining = len(moduleTasks)
+	throttled = 0
+
+	def Fail(i, attempt, reason):
+		"""Queues a failed task again, or records it as failed. Returns 1 if the task is finished."""
+		task = moduleTasks[i][3]
+		if(attempt < retries):
+			log("Task "+str(task)+" "+reason+", running it again (attempt "+str(attempt+2)+").")
+			waiting.append([(i, attempt+1)])
+			return 0
+		log("Task "+str(task)+" failed after "+str(attempt+1)+" attempts: "+reason)
+		failedTasks.append((task, attempt+1, reason))
+		results[i] = (None, [], None)
+		return 1
+
+	while remaining > 0:
+		used = sum([job["memory"] for job in running.values()])
+		while len(waiting) > 0 and len(running) < cores:
+			items = waiting[0]
+			memory = (max if groups != None else sum)([taskMemory[i] for i, attempt in items]) if taskMemory != None else 0
+			if(len(running) > 0 and used+memory > budget):
+				throttled += 1
+				break
+			waiting.popleft()
+			job = (nextJob, [(i, moduleTasks[i], attempt) for i, attempt in items])
+			pool.apply_async(RunTaskJob, (job,), callback=done.put)
+			running[nextJob] = {"items":items, "memory":memory, "task":None, "start":None, "pid":None, "ended":None}
+			used += memory
+			nextJob += 1
+		try:
+			jobId, outcomes = done.get(timeout=1.0 if starts != None else None)
+		except queue.Empty:
+			jobId = None
+		if(jobId in running):
+			job = running.pop(jobId)
+			attempts = dict(job["items"])
+			if(isinstance(outcomes, str)):
+				outcomes = [(i, None, outcomes) for i, attempt in job["items"]]
+			for i, traced, error in outcomes:
+				if(error != None):
+					remaining -= Fail(i, attempts[i], error)
+					continue
+				if(onResult != None):
+					traced = (onResult(traced[0]),)+tuple(traced[1:])
+				results[i] = traced
+				remaining -= 1
+		if(starts == None):
+			continue
+
+		# Tasks started by the workers, and tasks that timed out or whose worker ended
+		while not starts.empty():
+			jobId, i, pid = starts.get()
+			if(jobId in running):
+				running[jobId].update({"task":i, "start":time.time(), "pid":pid})
+		now = time.time()
+		alive = None
+		for jobId in list(running.keys()):
+			job = running[jobId]
+			if(job["pid"] == None):
+				continue
+			reason = None
+			if(timeout > 0 and now-job["start"] > timeout):
+				reason = "timed out after "+"{:.0f}".format(timeout)+" seconds"
+				KillProcess(job["pid"])
+			else:
+				if(alive == None):
+					alive = set([process.pid for process in multiprocessing.active_children()])
+				if(job["pid"] not in alive):
+					# The result of a worker that exits normally may still be on its way
+					if(job["ended"] == None):
+						job["ended"] = now
+					elif(now-job["ended"] > 5):
+						reason = "stopped, the worker process ended"
+			if(reason == None):
+				continue
+			del running[jobId]
+			lostJobs += 1
+			for i, attempt in reversed(job["items"]):
+				if(i == job["task"]):
+					remaining -= Fail(i, attempt, reason)
+				else:
+					# Other tasks of the job are lost with the worker and run again as they were
+					waiting.appendleft([(i, attempt)])
+	if(throttled > 0 and taskMemory != None):
+		log("Tasks were held back "+str(throttled)+" times to stay within the memory budget.", True)
+	return results
+
+def LoadTuning():
+	try:
+		tfile = open(os.path.join(workPath,tuningFile),"r")
+		tuning = json.load(tfile)
+		tfile.close()
+		return tuning
+	except (IOError, ValueError):
+		return {}
+
+def SaveTuning(name, startup, rate):
+	"""Records the worker startup time and the seconds per task size unit measured in a pool run."""
+	tuning = LoadTuning()
+	if(startup != None):
+		tuning["startup"] = startup
+	if(rate != None):
+		tuning["rate_"+name] = rate
+	try:
+		tfile = open(os.path.join(workPath,tuningFile),"w")
+		json.dump(tuning, tfile, indent=4)
+		tfile.close()
+	except IOError:
+		pass
+
+def AutoTune(name, moduleTasks, sizes, taskMemory):
+	"""Chooses the number of processes and the chunk size for a pool run.
+	The time of each task is modelled as proportional to its size (estimated window memory, or 1 if
+	unknown). The seconds per size unit are measured by running a sample of tasks in this process
+	when the auto_tune_sample setting is above 0, or taken from previous runs of the tool, or assumed.
+	The predicted run time for n processes is the worker startup time plus the larger of the total
+	task time divided by n and the longest task. The smallest n within 3% of the best time is chosen.
+	Returns (cores, chunk size, {task index: result of the sample tasks})."""
+	tuning = LoadTuning()
+	# At most the number of cores chosen by the user
+	maxCores = GetCores()
+	done = {}
+	reasons = []
+	sample = GetSetting("auto_tune_sample", 0)
+	if(sample > 0 and len(moduleTasks) >= sample*4):
+		# Calibration: run evenly spaced tasks here, their results are kept
+		samples = [int(i*len(moduleTasks)/sample) for i in range(0, sample)]
+		timeSample = time.time()
+		for i in samples:
+			done[i] = RunTracedTask(moduleTasks[i])
+		rate = (time.time()-timeSample)/max(sum([sizes[i] for i in samples]), 1e-9)
+		reasons.append("calibration of "+str(sample)+" tasks: "+"{:.3f}".format(rate*sum(sizes)/len(sizes))+" s per task")
+	elif("rate_"+name in tuning):
+		rate = tuning["rate_"+name]
+		reasons.append("previous runs: "+"{:.3f}".format(rate*sum(sizes)/len(sizes))+" s per task")
+	else:
+		rate = GetSetting("auto_tune_task_seconds", 2.0)*len(sizes)/max(sum(sizes), 1e-9)
+		reasons.append("no measurements, assuming "+"{:.3f}".format(rate*sum(sizes)/len(sizes))+" s per task")
+	startup = tuning.get("startup", GetSetting("auto_tune_startup", 5.0))
+	remaining = [sizes[i] for i in range(0, len(sizes)) if i not in done]
+	if(len(remaining) == 0):
+		return 1, 1, done
+	total = rate*sum(remaining)
+	longest = rate*max(remaining)
+	reasons.append(str(len(moduleTasks))+" tasks, median size "+"{:.2f}".format(sorted(sizes)[len(sizes)//2])+", largest "+"{:.2f}".format(max(sizes))+
+		(", raster of "+str(taskRasterCells)+" cells" if taskRasterCells != None else "")+", worker startup "+"{:.1f}".format(startup)+" s")
+
+	# Processes that fit in the memory budget with tasks of median size
+	limit = min(maxCores, len(remaining))
+	if(taskMemory != None):
+		budget = GetSetting("memory_budget", 0.0)
+		available = AvailableMemory()
+		if(budget <= 0 and available != None):
+			budget = available*0.8
+		median = sorted(taskMemory)[len(taskMemory)//2]
+		if(budget > 0 and median > 0 and budget/median < limit):
+			limit = max(1, int(budget/median))
+			reasons.append("memory budget allows "+str(limit)+" tasks of median size at the same time")
+
+	predicted = {}
+	for n in range(1, limit+1):
+		predicted[n] = startup+max(total/n, longest)
+	best = min(predicted.values())
+	cores = min([n for n in predicted if predicted[n] <= best*1.03])
+	reasons.append("predicted time "+", ".join([str(n)+": "+"{:.0f}".format(predicted[n])+" s" for n in sorted(predicted) if n in [1, 2, 4, 8, 16, 32, 64, cores, limit]]))
+
+	# Chunks of tasks of at least half a second, keeping at least 4 chunks per process
+	meanTask = total/len(remaining)
+	chunk = 1
+	if(taskMemory == None and meanTask > 0):
+		chunk = max(1, min(int(math.ceil(0.5/meanTask)), len(remaining)//(cores*4)))
+	log("Auto tune: "+str(cores)+" processes, chunk size "+str(chunk)+" ("+"; ".join(reasons)+").")
+	return cores, chunk, done
+
+def MapTasks(workFunction, tasks, taskMemory = None, onResult = None, groups = None):
+	"""Runs workFunction for every item in tasks and waits for all of them to finish.
+	By default the tasks are run by a multiprocessing pool with GetCores() processes.
+	If the 'executor' setting is 'queue', tasks are distributed through a work queue on
+	shared storage, which can be processed by workers on several computers (see FLM_WorkQueue).
+	taskMemory optionally holds the estimated memory in MB of each task (see LineTaskMemory),
+	the pools then run only as many tasks at the same time as fit in the memory budget.
+	onResult optionally receives the result of each task in this process as soon as the task
+	finishes (e.g. FLM_GeoPackage.ResultWriter.Add), its return value replaces the task result.
+	Work queue tasks do not return results to this process.
+	groups optionally holds a key for each task, the tasks with the same key are run one after the
+	other by the same worker process (see LineTiles).
+	Line tasks are dispatched in spatial order (see TaskOrder), results are returned in task order.
+	Tasks that fail are run again and then recorded in failedTasks (see MapGoverned), which tools
+	write to a layer with ReportFailures."""
+	tasks = list(tasks)
+	global lostJobs
+	del failedTasks[:]
+	lostJobs = 0
+	# Write the parent records before starting the workers, which may be forked with a copy of the buffer
+	FlushLog()
+	executor = GetSetting("executor", "pool")
+	if(executor == "queue"):
+		from . import FLM_WorkQueue as flmq
+		with Span("Map "+workFunction.__name__, "map", tasks=len(tasks), executor=executor):
+			return flmq.RunQueue(workFunction, [tasks[i] for i in TaskOrder(tasks)])
+	module = workFunction.__module__
+	moduleTasks = [(module, workFunction.__name__, warmJob, task) for task in tasks]
+	order = TaskOrder(tasks)
+	if(warmPool != None):
+		with Span("Map "+workFunction.__name__, "map", tasks=len(tasks), executor="warm"):
+			return AddWorkerSpans(MapGoverned(warmPool, GetCores(), moduleTasks, taskMemory, onResult, TaskChunk(), taskStarts, groups, order))
+	
+	# Start the pool and measure how long the processes take to load the tool
+	cores = GetCores()
+	chunk = TaskChunk()
+	name = module.split(".")[-1]+"."+workFunction.__name__
+	sizes = taskMemory if taskMemory != None else [1.0]*len(tasks)
+	done = {}
+	if(GetSetting("auto_tune", False) and len(tasks)>0 and groups == None):
+		cores, chunk, done = AutoTune(name, moduleTasks, sizes, taskMemory)
+		if(onResult != None):
+			for i in done:
+				done[i] = (onResult(done[i][0]),)+tuple(done[i][1:])
+	# Pending tasks in dispatch order
+	pending = [i for i in order if i not in done]
+	startQueue = multiprocessing.Queue()
+	starts = StartsQueue()
+	workerLog = multiprocessing.Queue()
+	listener = LogListener(workerLog)
+	listener.start()
+	timePool = time.time()
+	with Span("Map "+workFunction.__name__, "map", tasks=len(tasks), executor=executor, cores=cores):
+		pool = multiprocessing.Pool(processes=cores, initializer=InitProcess, initargs=(module, warmJob, timePool, startQueue, workerLog, starts), maxtasksperchild=WorkerMaxTasks())
+		traced = MapGoverned(pool, cores, [moduleTasks[i] for i in pending], [taskMemory[i] for i in pending] if taskMemory != None else None, onResult, chunk, starts, [groups[i] for i in pending] if groups != None else None)
+		if(lostJobs > 0):
+			pool.terminate()
+		else:
+			pool.close()
+		pool.join()
+	seconds = time.time()-timePool
+	listener.stop()
+	for i, result in zip(pending, traced):
+		done[i] = result
+	results = AddWorkerSpans([done[i] for i in range(0, len(moduleTasks))])
+	startTimes = []
+	while len(startTimes) < cores and not startQueue.empty():
+		startTimes.append(startQueue.get())
+	startup = None
+	if(len(startTimes)>0):
+		startup = max(startTimes)
+		log("Worker processes started in "+"{:.2f}".format(min(startTimes))+" to "+"{:.2f}".format(max(startTimes))+" seconds ("+str(len(startTimes))+" processes).", True)
+	if(len(pending)>0):
+		# Measurements used by AutoTune in the next runs
+		SaveTuning(name, startup, max(seconds-(startup or 0), 0)*cores/max(sum([sizes[i] for i in pending]), 1e-9))
+	return results
+
+def TaskChunk():
+	"""Number of consecutive tasks, in dispatch order, sent to a worker at a time when AutoTune does not
+	choose it (task_chunk setting, default 1). Chunks of line tasks in spatial order cover one area."""
+	return max(1, int(GetSetting("task_chunk", 1)))
+
+def WorkerMaxTasks():
+	"""Tasks after which worker processes are replaced, which frees memory leaked by a worker
+	(worker_max_tasks setting, default 0 for workers that are never replaced)."""
+	maxTasks = GetSetting("worker_max_tasks", 0)
+	return maxTasks if maxTasks > 0 else None
+
+def StartsQueue():
+	"""Returns a queue through which worker processes report the tasks they start (see MapGoverned).
+	Reports are sent to a manager process before the task runs, so the start of a task that ends its
+	worker is not lost, as it may be in the feeder thread of a multiprocessing.Queue."""
+	global startsManager
+	if(startsManager == None):
+		startsManager = multiprocessing.Manager()
+	return startsManager.Queue()
+
+def SetTaskQueue(startsQueue):
+	"""Sets the queue through which this worker process reports the tasks it starts (see MapGoverned)."""
+	global taskStarts
+	taskStarts = startsQueue
+
+def InitProcess(module, job, timePool, startQueue, workerLog = None, starts = None):
+	"""Pool initializer. Loads only the tool being run and reports the startup time of the process.
+	Log records of the worker are sent to the parent through workerLog."""
+	SetLogQueue(workerLog)
+	SetTaskQueue(starts)
+	# Forked processes start with a copy of the parent spans
+	TakeSpans()
+	LoadTool(module, job)
+	AddSpan("Worker startup", timePool, time.time(), "startup")
+	startQueue.put(time.time()-timePool)
+
+def LoadTool(module, job):
+	"""Imports a tool module and loads its arguments, once for each job in a process."""
+	toolModule = importlib.import_module(module)
+	if(loadedJobs.get(module, -1) != job):
+		# Workers kept alive between runs use the scratch workspace of the current run
+		if(hasattr(toolModule, "workspaceName")):
+			toolModule.outWorkspace = GetWorkspace(toolModule.workspaceName)
+		if(hasattr(toolModule, "LoadArgs")):
+			with Span("Load arguments", "startup", module=module):
+				toolModule.LoadArgs()
+		loadedJobs[module] = job
+	return toolModule
+
+def RunTask(moduleTask):
+	"""Runs a task of a tool in a worker process, loading the tool arguments if needed."""
+	module, function, job, task = moduleTask[0:4]
+	global traceTask, taskAttempt
+	toolModule = LoadTool(module, job)
+	traceTask = task
+	taskAttempt = moduleTask[4] if len(moduleTask) > 4 else 0
+	ResetPeakMemory()
+	start = time.time()
+	try:
+		return getattr(toolModule, function)(task)
+	finally:
+		AddSpan(function, start, time.time(), "task", {"peak_rss_mb":PeakMemory()})
+		traceTask = None
+		taskAttempt = 0
+
+def RetryDistance(distance):
+	"""Processing distance of the current task: distance on the first attempt, reduced by the
+	retry_window_scale setting (default 0.75) on each new attempt of a task that failed or timed out."""
+	if(taskAttempt == 0):
+		return distance
+	return float(distance)*GetSetting("retry_window_scale", 0.75)**taskAttempt
+
+def SearchRadii(distance):
+	"""Search radii tried by a line task with a processing distance, a number or a numeric string as in the
+	tool arguments. By default the search uses distance. With the adaptive_window_start setting (metres, 0
+	disables it) the search starts with that radius and grows it by adaptive_window_growth each time the
+	path runs along the edge of the window, up to distance. Radii are reduced on retries (see RetryDistance)."""
+	maxRadius = float(RetryDistance(distance))
+	radius = float(RetryDistance(GetSetting("adaptive_window_start", 0.0)))
+	growth = max(float(GetSetting("adaptive_window_growth", 2.0)), 1.1)
+	radii = []
+	while(radius > 0 and radius < maxRadius):
+		radii.append(radius)
+		radius *= growth
+	radii.append(maxRadius)
+	return radii
+
+def RunTracedTask(moduleTask):
+	"""Runs a task with RunTask and returns its result with the spans recorded by the worker
+	and the peak memory of the worker during the task."""
+	result = RunTask(moduleTask)
+	return (result, TakeSpans(), PeakMemory())
+
+def RunTaskJob(job):
+	"""Runs a job of MapGoverned in a worker process: (job id, [(task index, module task, attempt)]).
+	Each task reports its start through taskStarts, and the error of a task is returned instead of
+	raised, so it does not stop the other tasks. Returns (job id, [(task index, result of RunTracedTask
+	or None, error or None)]), or (job id, error) if the job itself failed. Errors are returned instead
+	of raised as Python 2.7 pools have no error callback."""
+	jobId, items = job
+	outcomes = []
+	try:
+		for i, moduleTask, attempt in items:
+			if(taskStarts != None):
+				taskStarts.put((jobId, i, os.getpid()))
+			try:
+				outcomes.append((i, RunTracedTask(tuple(moduleTask[0:4])+(attempt,)), None))
+			except Exception as e:
+				log("Task "+str(moduleTask[3])+" failed: "+traceback.format_exc(), True)
+				outcomes.append((i, None, TaskError(e)))
+	except Exception as e:
+		log("Job "+str(jobId)+" failed: "+traceback.format_exc(), True)
+		return jobId, TaskError(e)
+	return jobId, outcomes
+
+def OpenRaster(path):
+	"""Returns an arcpy Raster object for path. Raster objects are kept open for the life of
+	the process, so that workers do not open the same input raster again for every line."""
+	import arcpy
+	try:
+		mtime = os.path.getmtime(path)
+	except OSError:
+		mtime = 0
+	if(rasterCache.get(path, (None, None))[0] != mtime):
+		rasterCache[path] = (mtime, arcpy.Raster(path))
+	return rasterCache[path][1]
+
+def PyramidRasters(fileClip, fileOrigin, fileDestination, outWorkspace, toolCodename, lineNo):
+	"""Cost rasters to search in turn for the least cost path or corridor of a line. With the
+	pyramid_factor setting above 1, the path is first found on the clipped cost raster aggregated by
+	that factor (pyramid_method, mean or min), and the first raster returned holds only the cells of
+	fileClip within pyramid_band metres of that coarse path. fileClip follows, to be searched when the
+	ends of the line are not connected within the band. Without the setting only fileClip is returned."""
+	factor = GetSetting("pyramid_factor", 1)
+	if(factor <= 1):
+		return [fileClip]
+	import arcpy
+	fileCoarse = outWorkspace+"\\FLM_"+toolCodename+"_Coarse_"+str(lineNo)+".tif"
+	fileCoarseDist = outWorkspace+"\\FLM_"+toolCodename+"_CoarseDist_"+str(lineNo)+".tif"
+	fileCoarseBack = outWorkspace+"\\FLM_"+toolCodename+"_CoarseBack_"+str(lineNo)+".tif"
+	fileCoarsePath = outWorkspace+"\\FLM_"+toolCodename+"_CoarsePath_"+str(lineNo)+".shp"
+	fileBand = outWorkspace+"\\FLM_"+toolCodename+"_Band_"+str(lineNo)+".shp"
+	fileFine = outWorkspace+"\\FLM_"+toolCodename+"_Fine_"+str(lineNo)+".tif"
+	method = "MINIMUM" if GetSetting("pyramid_method", "mean") == "min" else "MEAN"
+	arcpy.gp.Aggregate_sa(fileClip, fileCoarse, factor, method, "EXPAND", "DATA")
+	arcpy.gp.CostDistance_sa(fileOrigin, fileCoarse, fileCoarseDist, "", fileCoarseBack, "", "", "", "", "TO_SOURCE")
+	arcpy.gp.CostPathAsPolyline_sa(fileDestination, fileCoarseDist, fileCoarseBack, fileCoarsePath, "BEST_SINGLE", "")
+	rasters = [fileClip]
+	if(int(arcpy.GetCount_management(fileCoarsePath).getOutput(0)) > 0):
+		# The band is at least one coarse cell wide, so it holds both ends of the line
+		band = max(GetSetting("pyramid_band", 10.0), factor*float(arcpy.Describe(fileClip).meanCellWidth))
+		arcpy.Buffer_analysis(fileCoarsePath, fileBand, band, "FULL", "ROUND", "ALL", "", "PLANAR")
+		arcpy.sa.ExtractByMask(fileClip, fileBand).save(fileFine)
+		rasters = [fileFine, fileClip]
+	for temp in [fileCoarse, fileCoarseDist, fileCoarseBack, fileCoarsePath, fileBand]:
+		arcpy.Delete_management(temp)
+	return rasters
+
+def TiffOptions(floating):
+	"""GDAL creation options of tiled, compressed GeoTIFF outputs, from the settings raster_block_size,
+	raster_compression (arcpy compression names) and raster_predictor (auto, 1, 2 or 3).
+	The automatic predictor is floating point (3) for float rasters and horizontal (2) for integer rasters."""
+	blockSize = str(GetSetting("raster_block_size", 256))
+	compression = GetSetting("raster_compression", "LZ77").upper()
+	compression = {"LZ77":"DEFLATE", "JPEG_YCBCR":"JPEG"}.get(compression, compression)
+	options = ["TILED=YES", "BLOCKXSIZE="+blockSize, "BLOCKYSIZE="+blockSize, "COMPRESS="+compression, "BIGTIFF=IF_SAFER"]
+	predictor = GetSetting("raster_predictor", "auto")
+	if(predictor == "auto"):
+		predictor = "3" if floating else "2"
+	if(compression in ["DEFLATE", "LZW", "ZSTD"] and predictor != "1"):
+		options.append("PREDICTOR="+predictor)
+	return options
+
+def SaveRaster(source, output, pixelType, noData = ""):
+	"""Saves a raster as a tool output: tiled and compressed, with the pixel type given as in
+	arcpy.CopyRaster_management (e.g. 8_BIT_UNSIGNED, 32_BIT_FLOAT), and with overviews unless
+	raster_overviews is False. GeoTIFF outputs are written with GDAL when it is installed,
+	as arcpy does not expose the compression predictor."""
+	import arcpy
+	floating = pixelType.endswith("FLOAT")
+	overviews = GetSetting("raster_overviews", True)
+	try:
+		from osgeo import gdal
+	except ImportError:
+		gdal = None
+	if(gdal != None and output.lower().endswith((".tif", ".tiff"))):
+		types = {"8_BIT_UNSIGNED":gdal.GDT_Byte, "16_BIT_SIGNED":gdal.GDT_Int16, "32_BIT_SIGNED":gdal.GDT_Int32, "32_BIT_FLOAT":gdal.GDT_Float32}
+		options = gdal.TranslateOptions(format="GTiff", outputType=types[pixelType], noData=None if noData == "" else float(noData), creationOptions=TiffOptions(floating))
+		dataset = gdal.Translate(output, arcpy.Describe(source).catalogPath, options=options)
+		if(overviews):
+			dataset.BuildOverviews("NEAREST" if floating == False else "AVERAGE", [2, 4, 8, 16, 32])
+		dataset = None
+		return
+
+	blockSize = GetSetting("raster_block_size", 256)
+	saved = (arcpy.env.tileSize, arcpy.env.compression, arcpy.env.pyramid)
+	arcpy.env.tileSize = str(blockSize)+" "+str(blockSize)
+	arcpy.env.compression = GetSetting("raster_compression", "LZ77")
+	arcpy.env.pyramid = "PYRAMIDS -1 "+("NEAREST" if floating == False else "BILINEAR")+" DEFAULT" if overviews else "NONE"
+	try:
+		arcpy.CopyRaster_management(source, output, "", "", noData, "NONE", "NONE", pixelType)
+	finally:
+		arcpy.env.tileSize, arcpy.env.compression, arcpy.env.pyramid = saved
+
+def ScratchPointer(outWorkName):
+	"""File recording the RAM scratch workspace of the current run, read by GetWorkspace in worker processes."""
+	return os.path.join(workPath, outWorkName+".scratch")
+
+def RamScratch(outWorkName):
+	"""Creates a scratch workspace with a unique name for this run in a RAM file system, when the
+	scratch_ram setting is True. The folder is scratch_ram_path, by default /dev/shm where it exists
+	(on Windows a RAM disk folder has to be set). Returns None to use the workspace on disk if there
+	is no RAM folder, if it has less than scratch_ram_min_free GB free or if the work queue is used,
+	as workers on other computers read the scratch files."""
+	if(GetSetting("scratch_ram", False) == False):
+		return None
+	if(GetSetting("executor", "pool") == "queue"):
+		log("The work queue needs a shared scratch workspace, the scratch workspace is created on disk.")
+		return None
+	base = GetSetting("scratch_ram_path", "/dev/shm" if os.path.isdir("/dev/shm") else "")
+	if(base == "" or os.path.isdir(base) == False):
+		log("There is no RAM folder (scratch_ram_path), the scratch workspace is created on disk.")
+		return None
+	import tempfile
+	free = FreeSpace(base)
+	if(free == None):
+		log("The free space in "+base+" can not be measured, the scratch workspace is created on disk.")
+		return None
+	if(free < GetSetting("scratch_ram_min_free", 2.0)*1024**3):
+		log("Only "+"{:.1f}".format(free/1024.0**3)+" GB free in "+base+", the scratch workspace is created on disk.")
+		return None
+	outWorkspace = tempfile.mkdtemp(prefix=outWorkName+"_", dir=base)
+	scratchRuns.append((os.getpid(), outWorkName, outWorkspace))
+	return outWorkspace
+
+def RemoveScratch():
+	"""Removes the RAM scratch workspaces of this process at the end of a run, with one recursive
+	removal for each workspace instead of deleting each scratch file through arcpy."""
+	import shutil
+	while len(scratchRuns)>0:
+		pid, outWorkName, outWorkspace = scratchRuns.pop()
+		# Forked worker processes do not remove the workspaces of their parent
+		if(pid != os.getpid()):
+			continue
+		shutil.rmtree(outWorkspace, True)
+		if(os.path.exists(ScratchPointer(outWorkName))):
+			os.remove(ScratchPointer(outWorkName))
+atexit.register(RemoveScratch)
+
 def SetupWorkspace (outWorkName):
-	"""This function creates a folder outWorkName in the scriptPath folder.
-	If it already exists, all shapefiles and rasters in it are deleted."""
+	"""This function creates a folder outWorkName in the workPath folder.
+	If it already exists, all shapefiles and rasters in it are deleted.
+	With the scratch_ram setting a new empty folder is created in RAM instead (see RamScratch)."""
 	import arcpy
 	
-	outWorkspace = scriptPath + "\\" + outWorkName
+	outWorkspace = RamScratch(outWorkName)
+	if(outWorkspace != None):
+		pfile = open(ScratchPointer(outWorkName),"w")
+		pfile.write(outWorkspace)
+		pfile.close()
+		arcpy.env.workspace = outWorkspace
+		log("Scratch workspace " + str(outWorkspace) +  " created in RAM.")
+		logStep("Workspace Setup")
+		return outWorkspace
+	if(os.path.exists(ScratchPointer(outWorkName))):
+		os.remove(ScratchPointer(outWorkName))
+	
+	outWorkspace = workPath + "\\" + outWorkName
 	
 	# Setup output folder
 	try:
@@ -172,26 +1238,52 @@ def SetupWorkspace (outWorkName):
 		for ras in oldRasters:
 			arcpy.Delete_management(ras)
 	del oldRasters
-	
+
+	# Scratch GeoPackages of an interrupted run (see FLM_GeoPackage)
+	import glob
+	for gpkg in glob.glob(os.path.join(outWorkspace, "FLM_*.gpkg")):
+		os.remove(gpkg)
+
 	logStep("Workspace Setup")
 	
 	return outWorkspace
 
 def GetWorkspace(outWorkName):
-	outWorkspace = scriptPath + "\\" + outWorkName
+	"""Returns the scratch workspace of a tool, the RAM workspace of the current run if there is one."""
+	try:
+		pfile = open(ScratchPointer(outWorkName),"r")
+		outWorkspace = pfile.readline().strip()
+		pfile.close()
+		if(os.path.isdir(outWorkspace)):
+			return outWorkspace
+	except IOError:
+		pass
+	outWorkspace = workPath + "\\" + outWorkName
 	return outWorkspace
 	
+def SegmentField(name, fieldNames):
+	"""Name of the field of a line segment shapefile (with fields fieldNames) holding the input field
+	name, as shapefiles cut field names to 10 characters. Returns None if there is no such field."""
+	for fieldName in fieldNames:
+		if(fieldName.lower() == name.lower()):
+			return fieldName
+	for fieldName in fieldNames:
+		if(fieldName.lower() == name[:10].lower()):
+			return fieldName
+	return None
+
 def SplitLines(linesFc, outWorkspace, toolCodename, ProcessSegments, KeepFieldName = []):
 	"""This function splits the input polyline shapefile (linesFc) into several shapefiles.
 	If ProcessSegments is False one shapefile will be created for each feature.
 	Otherwise, one shapefile will be created for each pair of vertices in the input lines.
 	Files are placed in outWorkspace, named using toolCodename as a base name.
-	It is possible to transfer one field (KeepFieldName) from the inputs to the outputs."""
+	It is possible to transfer one field (KeepFieldName) from the inputs to the outputs.
+	The lines are also saved as a line table (see FLM_LineTable), from which the tasks read their
+	vertices and attributes instead of reading their shapefile."""
 	import arcpy
+	from . import FLM_LineTable as flmlt
 	
-	# Create search cursor on input center lines file
-	line = 0
-	rows = arcpy.SearchCursor(linesFc)
+	lineExtents.clear()
 	
 	if(type(KeepFieldName)==str):
 		KeepFieldName = [KeepFieldName]
@@ -203,65 +1295,84 @@ def SplitLines(linesFc, outWorkspace, toolCodename, ProcessSegments, KeepFieldNa
 	fieldDict = {}
 	for field in desc.fields:
 		fieldDict[field.name] = field.type
-
-	shapeField = desc.ShapeFieldName
+	spatialReference = desc.spatialReference
 	del desc
+	KeepFieldName = [fieldName for fieldName in KeepFieldName if fieldName in fieldDict]
 	
-	for row in rows:
-		feat = row.getValue(shapeField)   #creates a geometry object
+	# One line task for each part of the input lines, or for each pair of vertices
+	with Span("Line table"):
+		tasks = flmlt.Split(flmlt.FromFeatureClass(linesFc, KeepFieldName), ProcessSegments)
+		tasks.Save(flmlt.TaskFolder(outWorkspace, toolCodename))
+	
+	segmentFields = None
+	for line in range(1, len(tasks)+1):
+		segment_fname = "FLM_"+toolCodename +"_Segment_"+ str(line) +".shp"
+		segment_fpath = outWorkspace +"\\"+ segment_fname
+		if arcpy.Exists(segment_fpath):
+			arcpy.Delete_management(segment_fpath)
 		
-		KeepField = []
+		segmentFC = arcpy.CreateFeatureclass_management(outWorkspace,segment_fname,"POLYLINE","","DISABLED","DISABLED",linesFc)
+		
+		# Kept fields may already be in the segment, copied from the fields of linesFc
+		fieldNames = [field.name for field in arcpy.ListFields(segment_fpath)]
 		for fieldName in KeepFieldName:
-			KeepField.append(row.getValue(fieldName))
-			
-		segmentnum = 0
-		for segment in feat: #loops through every segment in a line
-			segment_list = []
-			#loops through every vertex of every segment
-			for pnt in feat.getPart(segmentnum):				 #get.PArt returns an array of points for a particular part in the geometry
-				if pnt:				  #adds all the vertices to segment_list, which creates an array
-					segment_list.append(arcpy.Point(float(pnt.X), float(pnt.Y)))
-
-			segmentnum += 1
+			if(SegmentField(fieldName, fieldNames) == None):
+				arcpy.AddField_management(segment_fpath,fieldName,fieldDict[fieldName])
+		if(segmentFields == None):
+			fieldNames = [field.name for field in arcpy.ListFields(segment_fpath)]
+			segmentFields = [SegmentField(fieldName, fieldNames) for fieldName in KeepFieldName]
 		
-			for vertexID in range(0, len(segment_list)-1):   #loops through every vertex in the list   #-1 is done so the second last vertex is the start of a segment and the code is within range...
-				line += 1
-				segment_fname = "FLM_"+toolCodename +"_Segment_"+ str(line) +".shp"
-				segment_fpath = outWorkspace +"\\"+ segment_fname
-				if arcpy.Exists(segment_fpath):
-					arcpy.Delete_management(segment_fpath)
-				
-				segmentFC = arcpy.CreateFeatureclass_management(outWorkspace,segment_fname,"POLYLINE","","DISABLED","DISABLED",linesFc)
-				
-				
-				for fieldName in KeepFieldName:
-					if(fieldName in fieldDict):
-						arcpy.AddField_management(outWorkspace+"\\"+segment_fname,fieldName,fieldDict[fieldName])
-				
-				
-				cursor = arcpy.da.InsertCursor(segment_fpath, KeepFieldName+["SHAPE@"])
-					
-				if(ProcessSegments == False):
-					array = arcpy.Array(segment_list)
-				else:
-					array = arcpy.Array()
-					array.add(segment_list[vertexID])
-					array.add(segment_list[vertexID+1])
-				polyline = arcpy.Polyline(array, arcpy.Describe(segment_fpath).spatialReference)
-				
-				cursor.insertRow(KeepField+[polyline])
-					
-				del cursor, segmentFC
-				
-				if(ProcessSegments == False):
-					break
-			
-	del rows
+		cursor = arcpy.da.InsertCursor(segment_fpath, segmentFields+["SHAPE@"])
+		cursor.insertRow(tasks.Values(line-1, KeepFieldName)+[flmlt.Polyline(tasks.Parts(line-1), spatialReference)])
+		del cursor, segmentFC
+		
+		lineExtents[line] = tuple(tasks.bounds[line-1])
+	
 	# At this point all lines have been separated into different feature classes located at the scratch workspace
-	numLines = line
+	numLines = len(tasks)
 	log("There are " + str(numLines) + " lines to process.")  
 	logStep("Line Setup")
 	return numLines
+
+def ReportFailures(linesFc, outWorkspace, toolCodename, output, taskFiles = []):
+	"""Writes the line tasks that failed in the last MapTasks (see failedTasks) to a layer named as
+	output with _failed added, with the number of the line task, its attempts and the reason of the
+	failure. The files left in outWorkspace by the failed tasks, FLM_<toolCodename>_<name>_<task>.*
+	for the segment written by SplitLines and each name in taskFiles, are deleted so they are not
+	merged with the output. Returns the number of failed lines."""
+	if(len(failedTasks) == 0):
+		return 0
+	import arcpy
+	from . import FLM_LineTable as flmlt
+	for task, attempts, reason in failedTasks:
+		paths = []
+		for name in ["Segment"]+list(taskFiles):
+			paths += glob.glob(os.path.join(outWorkspace, "FLM_"+toolCodename+"_"+name+"_"+str(task)+".*"))
+		for path in paths:
+			try:
+				os.remove(path)
+			except OSError:
+				pass
+
+	base, ext = os.path.splitext(output)
+	if(ext == "" and os.path.dirname(output).lower().endswith(".gdb")):
+		failedFc = output+"_failed"
+	else:
+		failedFc = base+"_failed.shp"
+	if arcpy.Exists(failedFc):
+		arcpy.Delete_management(failedFc)
+	spatialReference = arcpy.Describe(linesFc).spatialReference
+	arcpy.CreateFeatureclass_management(os.path.dirname(failedFc),os.path.basename(failedFc),"POLYLINE","","DISABLED","DISABLED",spatialReference)
+	arcpy.AddField_management(failedFc,"LineNo","LONG")
+	arcpy.AddField_management(failedFc,"Attempts","SHORT")
+	arcpy.AddField_management(failedFc,"Reason","TEXT","","",254)
+	tasks = flmlt.Tasks(outWorkspace, toolCodename)
+	cursor = arcpy.da.InsertCursor(failedFc, ["LineNo","Attempts","Reason","SHAPE@"])
+	for task, attempts, reason in failedTasks:
+		cursor.insertRow([task, attempts, reason[:254], flmlt.Polyline(tasks.Parts(task-1), spatialReference)])
+	del cursor
+	log(str(len(failedTasks))+" lines failed and were written to "+failedFc+" with the reason of each failure.")
+	return len(failedTasks)
 	
 def SplitFeature (fc, idField, outWorkspace, toolCodename):
 	import arcpy
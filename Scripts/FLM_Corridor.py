@@ -28,29 +28,36 @@
 # ---------------------------------------------------------------------------
 
 import os
-import multiprocessing
 import arcpy
 from arcpy.sa import *
-arcpy.CheckOutExtension("Spatial")
 from . import FLM_Common as flmc
+from . import FLM_LineTable as flmlt
+from . import FLM_RasterCache as flmrc
 import math
 
 # Setup script path and workspace folder
 workspaceName = "FLM_CO_output"
 outWorkspace = flmc.GetWorkspace(workspaceName)
-arcpy.env.workspace = outWorkspace
-arcpy.env.overwriteOutput = True
 
-# Load arguments from file
-args = flmc.GetArgs("FLM_CO_params.txt")
+def LoadArgs():
+	"""Loads the tool arguments from the parameter file. Arguments are not loaded when the
+	module is imported, they are loaded when the tool runs and once in each worker process."""
+	global Centerline_Feature_Class, Canopy_Raster, Cost_Raster, Maximum_distance_from_centerline, ProcessSegments, ShareVertexCostDistance, Output_Corridor
+	arcpy.CheckOutExtension("Spatial")
+	arcpy.env.workspace = outWorkspace
+	arcpy.env.overwriteOutput = True
 
-# Tool arguments
-Centerline_Feature_Class = args[0].rstrip()
-Canopy_Raster = args[1].rstrip()
-Cost_Raster = args[2].rstrip()
-Maximum_distance_from_centerline = float(args[3].rstrip()) / 2.0
-ProcessSegments = args[4].rstrip()=="True"
-Output_Corridor = args[5].rstrip()
+	# Load arguments from file
+	args = flmc.GetArgs("FLM_CO_params.txt")
+
+	# Tool arguments
+	Centerline_Feature_Class = args[0].rstrip()
+	Canopy_Raster = flmrc.CachedRaster(args[1].rstrip())
+	Cost_Raster = flmrc.CachedRaster(args[2].rstrip())
+	Maximum_distance_from_centerline = float(args[3].rstrip()) / 2.0
+	ProcessSegments = args[4].rstrip()=="True"
+	ShareVertexCostDistance = args[5].rstrip()=="True"
+	Output_Corridor = args[6].rstrip()
 
 def PathFile(path):
 	return path[path.rfind("\\")+1:]
@@ -68,27 +75,14 @@ def workLines(lineNo):
 	fileCorridorMin = outWorkspace+"\\FLM_CO_CorridorMin_" + str(lineNo) +".tif"
 	
 	
-	# Load segment list
-	segment_list = []
-	rows = arcpy.SearchCursor(fileSeg)
-	shapeField = arcpy.Describe(fileSeg).ShapeFieldName
-	for row in rows:
-		feat = row.getValue(shapeField)   #creates a geometry object
-		segmentnum = 0
-		for segment in feat: #loops through every segment in a line
-			#loops through every vertex of every segment
-			for pnt in feat.getPart(segmentnum):                 #get.PArt returns an array of points for a particular part in the geometry
-				if pnt:                  #adds all the vertices to segment_list, which creates an array
-					segment_list.append(arcpy.Point(float(pnt.X), float(pnt.Y)))
-
-			segmentnum += 1
-	del rows
+	# Vertices of the line, from the line table written by SplitLines
+	vertices = flmlt.TaskVertices(outWorkspace, "CO", lineNo)
 
 	# Find origin and destination coordinates
-	x1 = segment_list[0].X
-	y1 = segment_list[0].Y
-	x2 = segment_list[-1].X
-	y2 = segment_list[-1].Y
+	x1 = vertices[0][0]
+	y1 = vertices[0][1]
+	x2 = vertices[-1][0]
+	y2 = vertices[-1][1]
 
 	# Create origin feature class
 	arcpy.CreateFeatureclass_management(outWorkspace,PathFile(fileOrigin),"POINT",Centerline_Feature_Class,"DISABLED","DISABLED",Centerline_Feature_Class)
@@ -105,23 +99,30 @@ def workLines(lineNo):
 	del cursor
 	
 	# Buffer around line
-	arcpy.Buffer_analysis(fileSeg, fileBuffer, Maximum_distance_from_centerline, "FULL", "ROUND", "NONE", "", "PLANAR")
+	arcpy.Buffer_analysis(fileSeg, fileBuffer, flmc.RetryDistance(Maximum_distance_from_centerline), "FULL", "ROUND", "NONE", "", "PLANAR")
 
 	# Clip cost raster using buffer
 	DescBuffer = arcpy.Describe(fileBuffer)
 	SearchBox = str(DescBuffer.extent.XMin)+" "+str(DescBuffer.extent.YMin)+" "+str(DescBuffer.extent.XMax)+" "+str(DescBuffer.extent.YMax)
-	arcpy.Clip_management(Cost_Raster, SearchBox, fileClip, fileBuffer, "", "ClippingGeometry", "NO_MAINTAIN_EXTENT")
+	arcpy.Clip_management(flmc.TileSource(Cost_Raster, outWorkspace, "CO", lineNo, Maximum_distance_from_centerline), SearchBox, fileClip, fileBuffer, "", "ClippingGeometry", "NO_MAINTAIN_EXTENT")
 
-	# Process: Cost Distance
-	arcpy.gp.CostDistance_sa(fileOrigin, fileClip, fileCostDa, "", "", "", "", "", "", "TO_SOURCE")
-	arcpy.gp.CostDistance_sa(fileDestination, fileClip, fileCostDb, "", "", "", "", "", "", "TO_SOURCE")
-	
-	# Process: Corridor
-	arcpy.gp.Corridor_sa(fileCostDa, fileCostDb, fileCorridor)
-	
-	# Calculate minimum value of corridor raster
-	RasterCorridor = arcpy.Raster(fileCorridor)
+	# In pyramid mode the band around the coarse path is searched first, then the whole clip if the ends are not connected in it
+	rasters = flmc.PyramidRasters(fileClip, fileOrigin, fileDestination, outWorkspace, "CO", lineNo)
+	for fileSearch in rasters:
+		# Process: Cost Distance
+		arcpy.gp.CostDistance_sa(fileOrigin, fileSearch, fileCostDa, "", "", "", "", "", "", "TO_SOURCE")
+		arcpy.gp.CostDistance_sa(fileDestination, fileSearch, fileCostDb, "", "", "", "", "", "", "TO_SOURCE")
+		
+		# Process: Corridor
+		arcpy.gp.Corridor_sa(fileCostDa, fileCostDb, fileCorridor)
+		
+		# Calculate minimum value of corridor raster
+		RasterCorridor = arcpy.Raster(fileCorridor)
+		if(RasterCorridor.minimum != None):
+			break
 	CorrMin = float(RasterCorridor.minimum)
+	for fileSearch in rasters[:-1]:
+		arcpy.Delete_management(fileSearch)
 	
 	# Set minimum as zero and save minimum file
 	RasterCorridor = (RasterCorridor-CorrMin)
@@ -137,6 +138,87 @@ def workLines(lineNo):
 	arcpy.Delete_management(fileCostDa)
 	arcpy.Delete_management(fileCostDb)
 	arcpy.Delete_management(fileCorridor)
+
+def workLinesShared(lineNo):
+	"""Processes every segment of a line in a single task. The cost distance from each
+	vertex is calculated once over the area of the whole line and reused by the corridors
+	of both segments that share the vertex."""
+	#Temporary files
+	fileSeg = outWorkspace +"\\FLM_CO_Segment_" + str(lineNo) +".shp"
+	fileBuffer = outWorkspace +"\\FLM_CO_Buffer_" + str(lineNo) +".shp"
+	fileClip = outWorkspace+"\\FLM_CO_Clip_" + str(lineNo) +".tif"
+	fileCorridorMin = outWorkspace+"\\FLM_CO_CorridorMin_" + str(lineNo) +".tif"
+	tempFiles = [fileSeg, fileBuffer, fileClip]
+	
+	# Vertices of the line, from the line table written by SplitLines
+	vertices = flmlt.TaskVertices(outWorkspace, "CO", lineNo)
+	spatialReference = arcpy.Describe(fileSeg).spatialReference
+	
+	# Buffer around the whole line, which is the union of the areas of its segments
+	arcpy.Buffer_analysis(fileSeg, fileBuffer, flmc.RetryDistance(Maximum_distance_from_centerline), "FULL", "ROUND", "NONE", "", "PLANAR")
+
+	# Clip cost raster using buffer
+	DescBuffer = arcpy.Describe(fileBuffer)
+	SearchBox = str(DescBuffer.extent.XMin)+" "+str(DescBuffer.extent.YMin)+" "+str(DescBuffer.extent.XMax)+" "+str(DescBuffer.extent.YMax)
+	arcpy.Clip_management(flmc.TileSource(Cost_Raster, outWorkspace, "CO", lineNo, Maximum_distance_from_centerline), SearchBox, fileClip, fileBuffer, "", "ClippingGeometry", "NO_MAINTAIN_EXTENT")
+	
+	# Process: Cost Distance, once for each vertex
+	fileCostD = []
+	for vertexID in range(0, len(vertices)):
+		fileVertex = outWorkspace +"\\FLM_CO_Vertex_" + str(lineNo) +"_"+ str(vertexID) +".shp"
+		fileCostD.append(outWorkspace+"\\FLM_CO_CostD_" + str(lineNo) +"_"+ str(vertexID) +".tif")
+		arcpy.CreateFeatureclass_management(outWorkspace,PathFile(fileVertex),"POINT",Centerline_Feature_Class,"DISABLED","DISABLED",Centerline_Feature_Class)
+		cursor = arcpy.da.InsertCursor(fileVertex, ["SHAPE@XY"])
+		xy = (float(vertices[vertexID][0]),float(vertices[vertexID][1]))
+		cursor.insertRow([xy])
+		del cursor
+		arcpy.gp.CostDistance_sa(fileVertex, fileClip, fileCostD[-1], "", "", "", "", "", "", "TO_SOURCE")
+		tempFiles += [fileVertex, fileCostD[-1]]
+	
+	# Process: Corridor of each segment, from the cost distances of its two vertices
+	fileSegmentCorridors = []
+	for vertexID in range(0, len(vertices)-1):
+		suffix = str(lineNo) +"_"+ str(vertexID)
+		fileLeg = outWorkspace +"\\FLM_CO_Leg_" + suffix +".shp"
+		fileLegBuffer = outWorkspace +"\\FLM_CO_LegBuffer_" + suffix +".shp"
+		fileLegCorridor = outWorkspace+"\\FLM_CO_LegCorridor_" + suffix +".tif"
+		fileLegMask = outWorkspace+"\\FLM_CO_LegMask_" + suffix +".tif"
+		fileLegMin = outWorkspace+"\\FLM_CO_LegMin_" + suffix +".tif"
+		tempFiles += [fileLeg, fileLegBuffer, fileLegCorridor, fileLegMask, fileLegMin]
+		
+		# Buffer around segment, so each corridor keeps the extent it has when processed on its own
+		arcpy.CreateFeatureclass_management(outWorkspace,PathFile(fileLeg),"POLYLINE","","DISABLED","DISABLED",Centerline_Feature_Class)
+		cursor = arcpy.da.InsertCursor(fileLeg, ["SHAPE@"])
+		cursor.insertRow([flmlt.Polyline([vertices[vertexID:vertexID+2]], spatialReference)])
+		del cursor
+		arcpy.Buffer_analysis(fileLeg, fileLegBuffer, flmc.RetryDistance(Maximum_distance_from_centerline), "FULL", "ROUND", "NONE", "", "PLANAR")
+		
+		arcpy.gp.Corridor_sa(fileCostD[vertexID], fileCostD[vertexID+1], fileLegCorridor)
+		RasterCorridor = ExtractByMask(fileLegCorridor, fileLegBuffer)
+		RasterCorridor.save(fileLegMask)
+		
+		# Calculate minimum value of corridor raster
+		RasterCorridor = arcpy.Raster(fileLegMask)
+		CorrMin = float(RasterCorridor.minimum)
+		
+		# Set minimum as zero and save minimum file
+		RasterCorridor = (RasterCorridor-CorrMin)
+		RasterCorridor.save(fileLegMin)
+		del RasterCorridor
+		fileSegmentCorridors.append(fileLegMin)
+	
+	# Line corridor is the minimum of the segment corridors, as done when merging lines
+	# The union extent is set only for this step, later steps and tasks of the worker use the default
+	saved = arcpy.env.extent
+	arcpy.env.extent = "MAXOF"
+	try:
+		arcpy.gp.CellStatistics_sa(fileSegmentCorridors, fileCorridorMin, "MINIMUM", "DATA")
+	finally:
+		arcpy.env.extent = saved
+	
+	#Clean temporary files
+	for tempFile in tempFiles:
+		arcpy.Delete_management(tempFile)
 	
 def workMerge(workerNo):
 	# Worker 1 will merge files 1 and 2; worker 2 will merge files 3 and 4; and so on...
@@ -160,19 +242,25 @@ def renameMergedFiles(fileWorkspace):
 	del rasters
 
 def main():
+	LoadArgs()
 	global outWorkspace
 	outWorkspace = flmc.SetupWorkspace(workspaceName)
 
 	# Prepare input lines for multiprocessing
-	numLines = flmc.SplitLines(Centerline_Feature_Class, outWorkspace, "CO", ProcessSegments)
+	if(ProcessSegments and ShareVertexCostDistance):
+		# One task per line, segments are processed inside the task sharing vertex cost distances
+		numLines = flmc.SplitLines(Centerline_Feature_Class, outWorkspace, "CO", False)
+		workFunction = workLinesShared
+	else:
+		numLines = flmc.SplitLines(Centerline_Feature_Class, outWorkspace, "CO", ProcessSegments)
+		workFunction = workLines
 	
-	pool = multiprocessing.Pool(processes=flmc.GetCores())
 	flmc.log("Multiprocessing line corridors...")
-	pool.map(workLines, range(1,numLines+1))
-	pool.close()
-	pool.join()
+	flmc.MapTasks(workFunction, range(1,numLines+1), flmc.LineTaskMemory(numLines, Maximum_distance_from_centerline, Cost_Raster), None, flmc.LineTiles(outWorkspace, "CO"))
+	flmc.RemoveTiles(outWorkspace, "CO")
 	
 	flmc.logStep("Corridor multiprocessing")
+	flmc.ReportFailures(Centerline_Feature_Class, outWorkspace, "CO", Output_Corridor, ["Origin", "Destination", "Buffer", "Clip", "CostDa", "CostDb", "Corridor", "CorridorMin"])
 	
 	nRasters = len(arcpy.ListRasters())
 	
@@ -184,12 +272,8 @@ def main():
 		while nRasters>1:
 			flmc.log("Multiprocessing line corridors... Round "+str(mergeLoops+1)+"; "+str(nRasters)+" rasters in output folder to process...")
 			# Multiprocessing merge, so that every process merges two files at a time
-			pool = multiprocessing.Pool(processes=flmc.GetCores())
-			
 			# Create a number of workers equal to half the number of rasters, rounded up
-			pool.map(workMerge, range(1,int(math.ceil(nRasters/2.0)+1)))
-			pool.close()
-			pool.join()
+			flmc.MapTasks(workMerge, range(1,int(math.ceil(nRasters/2.0)+1)))
 			
 			renameMergedFiles(outWorkspace)
 			nRasters = len(arcpy.ListRasters())
@@ -28,30 +28,36 @@
 #
 # ---------------------------------------------------------------------------
 
-import multiprocessing
 import arcpy
 from arcpy.sa import *
-arcpy.CheckOutExtension("Spatial")
-import arcpy
 from . import FLM_Common as flmc
+from . import FLM_LineTable as flmlt
+from . import FLM_RasterCache as flmrc
+from . import FLM_GeoPackage as flmg
 
 # Setup script path and workspace folder
 workspaceName = "FLM_CFP_output"
 outWorkspace = flmc.GetWorkspace(workspaceName)
-arcpy.env.workspace = outWorkspace
-arcpy.env.overwriteOutput = True
 
-# Load arguments from file
-args = flmc.GetArgs("FLM_CFP_params.txt")
+def LoadArgs():
+	"""Loads the tool arguments from the parameter file. Arguments are not loaded when the
+	module is imported, they are loaded when the tool runs and once in each worker process."""
+	global Centerline_Feature_Class, Canopy_Raster, Corridor_Raster, Corridor_Threshold_Field, Maximum_distance_from_centerline, Expand_And_Shrink_Cell_Range, Output_Footprint
+	arcpy.CheckOutExtension("Spatial")
+	arcpy.env.workspace = outWorkspace
+	arcpy.env.overwriteOutput = True
+
+	# Load arguments from file
+	args = flmc.GetArgs("FLM_CFP_params.txt")
 
-# Tool arguments
-Centerline_Feature_Class = args[0].rstrip()
-Canopy_Raster = args[1].rstrip()
-Corridor_Raster = args[2].rstrip()
-Corridor_Threshold_Field = args[3].rstrip()
-Maximum_distance_from_centerline = args[4].rstrip()
-Expand_And_Shrink_Cell_Range = args[5].rstrip()
-Output_Footprint = args[6].rstrip()
+	# Tool arguments
+	Centerline_Feature_Class = args[0].rstrip()
+	Canopy_Raster = flmrc.CachedRaster(args[1].rstrip())
+	Corridor_Raster = flmrc.CachedRaster(args[2].rstrip())
+	Corridor_Threshold_Field = args[3].rstrip()
+	Maximum_distance_from_centerline = args[4].rstrip()
+	Expand_And_Shrink_Cell_Range = args[5].rstrip()
+	Output_Footprint = args[6].rstrip()
 
 def PathFile(path):
 	return path[path.rfind("\\")+1:]
@@ -71,28 +77,15 @@ def workLines(lineNo):
 	fileNull = outWorkspace+"\\FLM_CFP_Null_" + str(lineNo) +".tif"
 	fileFootprint = outWorkspace +"\\FLM_CFP_Footprint_" + str(lineNo) +".shp"
 	
-	# Load segment list
-	segment_list = []
-	rows = arcpy.SearchCursor(fileSeg)
-	shapeField = arcpy.Describe(fileSeg).ShapeFieldName
-	for row in rows:
-		feat = row.getValue(shapeField)   #creates a geometry object
-		Corridor_Threshold = float(row.getValue(Corridor_Threshold_Field))
-		segmentnum = 0
-		for segment in feat: #loops through every segment in a line
-			#loops through every vertex of every segment
-			for pnt in feat.getPart(segmentnum):                 #get.PArt returns an array of points for a particular part in the geometry
-				if pnt:                  #adds all the vertices to segment_list, which creates an array
-					segment_list.append(arcpy.Point(float(pnt.X), float(pnt.Y)))
-
-			segmentnum += 1
-	del rows
+	# Vertices of the line, from the line table written by SplitLines
+	vertices = flmlt.TaskVertices(outWorkspace, "CFP", lineNo)
+	Corridor_Threshold = float(flmlt.TaskValue(outWorkspace, "CFP", lineNo, Corridor_Threshold_Field))
 
 	# Find origin and destination coordinates
-	x1 = segment_list[0].X
-	y1 = segment_list[0].Y
-	x2 = segment_list[-1].X
-	y2 = segment_list[-1].Y
+	x1 = vertices[0][0]
+	y1 = vertices[0][1]
+	x2 = vertices[-1][0]
+	y2 = vertices[-1][1]
 
 	# Create origin feature class
 	arcpy.CreateFeatureclass_management(outWorkspace,PathFile(fileOrigin),"POINT",Centerline_Feature_Class,"DISABLED","DISABLED",Centerline_Feature_Class)
@@ -109,19 +102,19 @@ def workLines(lineNo):
 	del cursor
 	
 	# Buffer around line
-	arcpy.Buffer_analysis(fileSeg, fileBuffer, Maximum_distance_from_centerline, "FULL", "ROUND", "NONE", "", "PLANAR")
+	arcpy.Buffer_analysis(fileSeg, fileBuffer, flmc.RetryDistance(Maximum_distance_from_centerline), "FULL", "ROUND", "NONE", "", "PLANAR")
 
 	# Clip cost raster using buffer
 	DescBuffer = arcpy.Describe(fileBuffer)
 	SearchBox = str(DescBuffer.extent.XMin)+" "+str(DescBuffer.extent.YMin)+" "+str(DescBuffer.extent.XMax)+" "+str(DescBuffer.extent.YMax)
-	arcpy.Clip_management(Corridor_Raster, SearchBox, fileClip, fileBuffer, "", "ClippingGeometry", "NO_MAINTAIN_EXTENT")
+	arcpy.Clip_management(flmc.TileSource(Corridor_Raster, outWorkspace, "CFP", lineNo, Maximum_distance_from_centerline), SearchBox, fileClip, fileBuffer, "", "ClippingGeometry", "NO_MAINTAIN_EXTENT")
 
 	#Threshold for the corridor raster
 	RasterCorridor = (Raster(fileClip)> Corridor_Threshold)
 	RasterCorridor.save(fileCorridor)
 	
 	# Process: Stamp CC and Max Line Width
-	RasterClass = SetNull(IsNull(Raster(fileCorridor)),(Raster(fileCorridor)+(Raster(Canopy_Raster)>=1))>0)
+	RasterClass = SetNull(IsNull(Raster(fileCorridor)),(Raster(fileCorridor)+(flmc.OpenTileSource(Canopy_Raster, outWorkspace, "CFP", lineNo, Maximum_distance_from_centerline)>=1))>0)
 	RasterClass.save(fileThreshold)
 	del RasterCorridor, RasterClass
 	
@@ -142,6 +135,7 @@ def workLines(lineNo):
 	
 	# Process: Raster to Polygon
 	arcpy.RasterToPolygon_conversion(fileNull, fileFootprint, "SIMPLIFY", "VALUE", "SINGLE_OUTER_PART", "")
+	features = flmg.TakeOutput(fileFootprint, Output_Footprint, outWorkspace, "CFP")
 	
 	#Clean temporary files
 	arcpy.Delete_management(fileSeg)
@@ -155,6 +149,7 @@ def workLines(lineNo):
 	arcpy.Delete_management(fileShrink)
 	arcpy.Delete_management(fileClean)
 	arcpy.Delete_management(fileNull)
+	return features
 
 def HasField(fc, fi):
   fieldnames = [field.name for field in arcpy.ListFields(fc)]
@@ -164,6 +159,7 @@ def HasField(fc, fi):
     return False
 	
 def main():
+	LoadArgs()
 	global outWorkspace
 	outWorkspace = flmc.SetupWorkspace(workspaceName)
 	
@@ -174,22 +170,34 @@ def main():
 	# Prepare input lines for multiprocessing
 	numLines = flmc.SplitLines(Centerline_Feature_Class, outWorkspace, "CFP", False, Corridor_Threshold_Field)
 	
-	pool = multiprocessing.Pool(processes=flmc.GetCores())
+	# Footprints are written to a GeoPackage as the lines finish
+	writer = flmg.ResultWriter(outWorkspace +"\\FLM_CFP_Merge.gpkg", "merge") if flmg.UseGeoPackage(Output_Footprint) else None
+	
 	flmc.log("Multiprocessing line corridors...")
-	pool.map(workLines, range(1,numLines+1))
-	pool.close()
-	pool.join()
+	flmc.MapTasks(workLines, range(1,numLines+1), flmc.LineTaskMemory(numLines, Maximum_distance_from_centerline, Corridor_Raster), writer.Add if writer != None else None, flmc.LineTiles(outWorkspace, "CFP"))
+	flmc.RemoveTiles(outWorkspace, "CFP")
 	
 	flmc.logStep("Corridor footprint multiprocessing")
+	flmc.ReportFailures(Centerline_Feature_Class, outWorkspace, "CFP", Output_Footprint, ["Origin", "Destination", "Buffer", "Clip", "Threshold", "Corridor", "Expand", "Shrink", "Clean", "Null", "Footprint"])
 	
 	flmc.log("Merging footprint layers...")
-	tempShapefiles = arcpy.ListFeatureClasses()
-	fileMerge = outWorkspace +"\\FLM_CFP_Merge.shp"
-	arcpy.Merge_management(tempShapefiles,fileMerge)
-	arcpy.Dissolve_management(fileMerge,Output_Footprint)
-	for shp in tempShapefiles:
-		arcpy.Delete_management(shp)
-	arcpy.Delete_management(fileMerge)
+	if(writer != None):
+		# Footprints were written to one GeoPackage as the lines finished and are dissolved from there
+		with flmc.Span("Merge"):
+			writer.Close(flmg.ScratchFiles(outWorkspace, "CFP"))
+		with flmc.Span("Dissolve"):
+			arcpy.Dissolve_management(flmg.ArcpyTable(writer.path, writer.table),flmg.OutputTable(Output_Footprint))
+		arcpy.Delete_management(writer.path)
+	else:
+		tempShapefiles = arcpy.ListFeatureClasses()
+		fileMerge = outWorkspace +"\\FLM_CFP_Merge.shp"
+		with flmc.Span("Merge"):
+			arcpy.Merge_management(tempShapefiles,fileMerge)
+		with flmc.Span("Dissolve"):
+			arcpy.Dissolve_management(fileMerge,Output_Footprint)
+		for shp in tempShapefiles:
+			arcpy.Delete_management(shp)
+		arcpy.Delete_management(fileMerge)
 	
 	flmc.logStep("Merging")
 	
@@ -0,0 +1,191 @@
+#
+#    Copyright (C) 2020  Applied Geospatial Research Group
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, version 3.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <https://gnu.org/licenses/gpl-3.0>.
+#
+# ---------------------------------------------------------------------------
+#
+# FLM_Daemon.py
+# Script Author: Gustavo Lopes Queiroz
+# Date: 2020-Jan-22
+#
+# This script is part of the Forest Line Mapper (FLM) toolset
+# Webpage: https://github.com/appliedgrg/flm
+#
+# Purpose: Long-lived worker service that keeps arcpy, the Spatial Analyst
+# extension, open input rasters and a pool of worker processes alive between
+# consecutive tool runs. Tools started from the GUI or from the command line
+# are sent to the service when it is running, so back-to-back runs do not pay
+# for importing arcpy and starting the worker processes again.
+#
+# Usage (from the FLM folder):
+#     python -m Scripts.FLM_Daemon                 start the service
+#     python -m Scripts.FLM_Daemon run <tool>      run a tool, e.g. FLM_CenterLine
+#     python -m Scripts.FLM_Daemon stop            stop the service
+# Tool parameters are read from the tool parameter files, as saved by the GUI.
+# Settings used (see FLM_Common.GetSetting): daemon_port, daemon_key.
+# Without daemon_key, a random key is created on the first start in flm_daemon.key,
+# next to the settings file and readable only by the user.
+#
+# ---------------------------------------------------------------------------
+
+import os, sys, time, errno, binascii, traceback, importlib, multiprocessing
+from multiprocessing.connection import Listener, Client
+from . import FLM_Common as flmc
+
+def GetAddress():
+	return ("localhost", flmc.GetSetting("daemon_port", 47800))
+
+keyFile = "flm_daemon.key"
+
+def GetKey():
+	"""Authentication key of the service: the daemon_key setting if it is set, otherwise a random key
+	created on first use in keyFile, so that other users of the computer can not send jobs to the service."""
+	key = str(flmc.GetSetting("daemon_key", ""))
+	if(key != ""):
+		return key.encode()
+	path = os.path.join(flmc.scriptPath, keyFile)
+	try:
+		# Created with the key already private, as O_EXCL fails if another process created it first
+		fd = os.open(path, os.O_WRONLY|os.O_CREAT|os.O_EXCL, 0o600)
+		try:
+			os.write(fd, binascii.hexlify(os.urandom(32)))
+		finally:
+			os.close(fd)
+	except OSError as e:
+		if(e.errno != errno.EEXIST):
+			raise
+	kfile = open(path, "rb")
+	key = kfile.read().strip()
+	kfile.close()
+	return key
+
+def InitWorker(workerLog = None, taskStarts = None):
+	# Load arcpy and check out the extension once for the life of the worker
+	flmc.SetLogQueue(workerLog)
+	flmc.SetTaskQueue(taskStarts)
+	import arcpy
+	arcpy.CheckOutExtension("Spatial")
+
+def ToolModule(tool):
+	if(tool.startswith("Scripts.") == False):
+		tool = "Scripts."+tool
+	return tool
+
+def Request(request):
+	"""Sends a request to the service and returns its reply, or None if the service is not running."""
+	try:
+		conn = Client(GetAddress(), authkey=GetKey())
+	except Exception:
+		return None
+	conn.send(request)
+	reply = conn.recv()
+	conn.close()
+	return reply
+
+def IsRunning():
+	return Request({"command":"ping"}) != None
+
+def RunJob(tool):
+	"""Sends a tool run to the service and waits for it to finish.
+	Returns None if the service is not running, otherwise the reply of the service."""
+	return Request({"command":"run", "tool":ToolModule(tool)})
+
+def StopService():
+	return Request({"command":"stop"}) != None
+
+def RunTool(module, job):
+	"""Runs the main function of a tool in the service process using the warm pool.
+	Workers load the tool arguments again when they receive the first task of a new job."""
+	toolModule = importlib.import_module(module)
+	flmc.warmJob = job
+	flmc.StartTrace(module)
+	try:
+		return toolModule.main()
+	finally:
+		flmc.WriteTrace()
+		flmc.RemoveScratch()
+
+def Serve():
+	InitWorker()
+	cores = flmc.GetCores()
+	workerLog = multiprocessing.Queue()
+	logListener = flmc.LogListener(workerLog)
+	logListener.start()
+	# Queue through which the warm workers report the tasks they start, read by FLM_Common.MapGoverned
+	flmc.taskStarts = flmc.StartsQueue()
+	flmc.warmPool = multiprocessing.Pool(processes=cores, initializer=InitWorker, initargs=(workerLog, flmc.taskStarts), maxtasksperchild=flmc.WorkerMaxTasks())
+	listener = Listener(GetAddress(), authkey=GetKey())
+	flmc.log("FLM service listening on port "+str(GetAddress()[1])+" with "+str(cores)+" warm workers.")
+	job = 0
+	while True:
+		conn = listener.accept()
+		try:
+			request = conn.recv()
+		except EOFError:
+			conn.close()
+			continue
+		if(request["command"] == "ping"):
+			conn.send({"status":"ok"})
+			conn.close()
+			continue
+		if(request["command"] == "stop"):
+			conn.send({"status":"stopped"})
+			conn.close()
+			break
+
+		# Restart the pool if the number of cores was changed
+		if(flmc.GetCores() != cores):
+			# Pools are idle between runs, terminate does not wait for jobs lost by killed workers
+			flmc.warmPool.terminate()
+			flmc.warmPool.join()
+			cores = flmc.GetCores()
+			flmc.warmPool = multiprocessing.Pool(processes=cores, initializer=InitWorker, initargs=(workerLog, flmc.taskStarts), maxtasksperchild=flmc.WorkerMaxTasks())
+
+		job += 1
+		flmc.log("Running "+request["tool"]+" (job "+str(job)+")...")
+		timeStart = time.time()
+		try:
+			r = RunTool(request["tool"], job)
+			reply = {"status":"ok", "result":r != False}
+		except Exception as e:
+			flmc.log(traceback.format_exc())
+			reply = {"status":"error", "result":False, "error":str(e)}
+		reply["seconds"] = time.time()-timeStart
+		flmc.log(request["tool"]+" finished in "+"{:.2f}".format(reply["seconds"])+" seconds.")
+		flmc.FlushLog()
+		try:
+			conn.send(reply)
+		except IOError:
+			pass
+		conn.close()
+
+	listener.close()
+	flmc.warmPool.terminate()
+	flmc.warmPool.join()
+	flmc.warmPool = None
+	logListener.stop()
+
+if __name__ == '__main__':
+	if(len(sys.argv)>2 and sys.argv[1] == "run"):
+		reply = RunJob(sys.argv[2])
+		if(reply == None):
+			print("FLM service is not running.")
+			sys.exit(1)
+		print(reply)
+		sys.exit(0 if reply["status"] == "ok" else 1)
+	elif(len(sys.argv)>1 and sys.argv[1] == "stop"):
+		if(StopService() == False):
+			print("FLM service is not running.")
+	else:
+		Serve()
@@ -0,0 +1,637 @@
+#
+#    Copyright (C) 2020  Applied Geospatial Research Group
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, version 3.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <https://gnu.org/licenses/gpl-3.0>.
+#
+# ---------------------------------------------------------------------------
+#
+# FLM_Engine.py
+# Script Author: Gustavo Lopes Queiroz
+# Date: 2020-Jan-22
+#
+# This script is part of the Forest Line Mapper (FLM) toolset
+# Webpage: https://github.com/appliedgrg/flm
+#
+# Purpose: In-memory raster engine with the processing steps of the FLM
+# tools implemented on NumPy arrays: canopy and cost rasters, cost distance,
+# least cost paths, corridors, footprints, zonal thresholds and line
+# attributes. It runs without arcpy, so tools can be benchmarked and tested
+# on any computer. SciPy is used when installed for Euclidean distances and
+# cost distances, otherwise pure Python and NumPy fallbacks are used.
+# Rasters are read and written with arcpy when available, otherwise GDAL.
+# Windows are assembled from the raster blocks cached in memory by each process
+# (see FLM_RasterCache.BlockCache).
+# Windows are held in compact types: the canopy as a uint8 mask, cost and
+# accumulated cost as float32 and cell labels (e.g. least cost path
+# predecessors) as int32, which is a quarter to an eighth of the memory of
+# float64 and int64 arrays. Least cost paths and corridors can be solved
+# coarse to fine: on the cost aggregated by a factor, then at full resolution
+# within a band around the coarse path (see PyramidWindow).
+# Settings used (see FLM_Common.GetSetting):
+#     engine_precision  float type of the raster windows, float32 (default) or float64
+#
+# ---------------------------------------------------------------------------
+
+import os, math, heapq
+import numpy as np
+from . import FLM_Common as flmc
+from . import FLM_RasterCache as flmrc
+try:
+	from scipy import ndimage
+	from scipy.sparse import csr_matrix
+	from scipy.sparse import csgraph
+except ImportError:
+	ndimage = None
+	csgraph = None
+
+# Value of the NoData cells of uint8 canopy masks
+canopyNoData = 255
+
+def FloatType():
+	"""NumPy float type of raster windows, from the engine_precision setting."""
+	return np.float64 if flmc.GetSetting("engine_precision", "float32") == "float64" else np.float32
+
+def Valid(array):
+	"""Boolean array of the cells that are not NoData: NaN in float arrays, canopyNoData in uint8 masks."""
+	if(array.dtype.kind == "f"):
+		return np.isfinite(array)
+	if(array.dtype == np.uint8):
+		return array != canopyNoData
+	return np.ones(array.shape, dtype=bool)
+
+def Backend():
+	"""Returns the name of the backend used for distances, reported by the benchmark."""
+	return "scipy" if csgraph != None else "numpy"
+
+class Grid:
+	"""A raster window held in memory: a 2D array, the map coordinates of its upper left
+	corner and its cell size. Rows go from north to south, as in arcpy and GDAL arrays."""
+	def __init__(self, array, xMin, yMax, cellSize):
+		self.array = array
+		self.xMin = float(xMin)
+		self.yMax = float(yMax)
+		self.cellSize = float(cellSize)
+
+	@property
+	def rows(self):
+		return self.array.shape[0]
+
+	@property
+	def cols(self):
+		return self.array.shape[1]
+
+	def Extent(self):
+		return (self.xMin, self.yMax-self.rows*self.cellSize, self.xMin+self.cols*self.cellSize, self.yMax)
+
+	def CellOf(self, x, y):
+		return (int(math.floor((self.yMax-y)/self.cellSize)), int(math.floor((x-self.xMin)/self.cellSize)))
+
+	def CenterOf(self, row, col):
+		return (self.xMin+(col+0.5)*self.cellSize, self.yMax-(row+0.5)*self.cellSize)
+
+	def Contains(self, row, col):
+		return row >= 0 and col >= 0 and row < self.rows and col < self.cols
+
+	def Like(self, array):
+		return Grid(array, self.xMin, self.yMax, self.cellSize)
+
+	def Clip(self, xMin, yMin, xMax, yMax):
+		"""Returns the cells of the grid within the extent, aligned to the grid cells."""
+		row0, col0 = self.CellOf(xMin, yMax)
+		row1, col1 = self.CellOf(xMax, yMin)
+		row0, col0 = max(row0, 0), max(col0, 0)
+		row1, col1 = min(row1+1, self.rows), min(col1+1, self.cols)
+		# Extents outside the grid give empty windows
+		row1, col1 = max(row1, row0), max(col1, col0)
+		return Grid(self.array[row0:row1, col0:col1], self.xMin+col0*self.cellSize, self.yMax-row0*self.cellSize, self.cellSize)
+
+def LineExtent(vertices, distance):
+	"""Returns the extent of a polyline given as a list of (x, y) vertices, expanded by distance."""
+	xs = [v[0] for v in vertices]
+	ys = [v[1] for v in vertices]
+	return (min(xs)-distance, min(ys)-distance, max(xs)+distance, max(ys)+distance)
+
+def ReadRaster(path, extent = None):
+	"""Reads a raster, or the cells of the raster within extent, as a Grid of FloatType with NaN for NoData.
+	Windows are sliced from the memory mapped copy of the raster when the raster cache is enabled,
+	otherwise they are assembled from the blocks of the block cache of the process (see FLM_RasterCache)."""
+	cached = flmrc.CachedArray(path, ReadSource) if extent != None else None
+	if(cached == None):
+		return ReadSource(path, extent, extent != None)
+	array, meta = cached
+	window = Grid(array, meta["xMin"], meta["yMax"], meta["cellSize"]).Clip(*extent)
+	return Grid(window.array.astype(FloatType()), window.xMin, window.yMax, window.cellSize)
+
+def SourceInfo(path):
+	"""Size and geotransform of a raster file, as a Grid of the raster size whose cells are not read."""
+	try:
+		import arcpy
+	except ImportError:
+		arcpy = None
+	if(arcpy != None):
+		desc = arcpy.Describe(path)
+		return Grid(np.broadcast_to(np.float32(0), (desc.height, desc.width)), desc.extent.XMin, desc.extent.YMax, float(desc.meanCellWidth))
+	from osgeo import gdal
+	dataset = gdal.Open(path)
+	transform = dataset.GetGeoTransform()
+	return Grid(np.broadcast_to(np.float32(0), (dataset.RasterYSize, dataset.RasterXSize)), transform[0], transform[3], transform[1])
+
+def ReadCells(path, full, row0, col0, row1, col1):
+	"""Reads the cells [row0:row1, col0:col1] of a raster file, given its SourceInfo full, as an array of FloatType."""
+	try:
+		import arcpy
+	except ImportError:
+		arcpy = None
+	if(arcpy != None):
+		# Read with the NoData value of the raster, as NaN can not be stored in integer rasters
+		lowerLeft = arcpy.Point(full.xMin+col0*full.cellSize, full.yMax-row1*full.cellSize)
+		cells = arcpy.RasterToNumPyArray(path, lowerLeft, col1-col0, row1-row0)
+		noData = arcpy.Raster(path).noDataValue
+	else:
+		from osgeo import gdal
+		band = gdal.Open(path).GetRasterBand(1)
+		cells = band.ReadAsArray(col0, row0, col1-col0, row1-row0)
+		noData = band.GetNoDataValue()
+	array = cells.astype(FloatType())
+	if(noData != None):
+		array[cells == noData] = np.nan
+	return array
+
+def ReadSource(path, extent = None, blocks = False):
+	"""Reads a raster from its source file. arcpy is used when available, otherwise GDAL.
+	With blocks, the window is assembled from the block cache of the process when it is enabled."""
+	full = SourceInfo(path)
+	window = full if extent == None else full.Clip(*extent)
+	row0 = int(round((full.yMax-window.yMax)/full.cellSize))
+	col0 = int(round((window.xMin-full.xMin)/full.cellSize))
+	row1, col1 = row0+window.rows, col0+window.cols
+	if(window.rows == 0 or window.cols == 0):
+		# Windows outside the raster are not read
+		return Grid(np.empty((window.rows, window.cols), dtype=FloatType()), window.xMin, window.yMax, full.cellSize)
+	array = None
+	if(blocks):
+		# Blocks of a raster that changed are not used again
+		try:
+			stat = os.stat(path)
+			raster = (os.path.realpath(path), stat.st_mtime, stat.st_size)
+		except OSError:
+			raster = (path,)
+		array = flmrc.ReadWindow(raster, 1, row0, col0, row1, col1, lambda r0, c0, r1, c1: ReadCells(path, full, r0, c0, r1, c1), (full.rows, full.cols))
+	if(array is None):
+		array = ReadCells(path, full, row0, col0, row1, col1)
+	return Grid(array.astype(FloatType(), copy=False), window.xMin, window.yMax, full.cellSize)
+
+def WriteRaster(grid, path, spatialReference = None):
+	"""Writes a Grid to a tiled, compressed GeoTIFF file with GDAL, with overviews unless the
+	raster_overviews setting is False (see FLM_Common.TiffOptions). NaN cells are written as NoData,
+	as are canopyNoData cells of uint8 masks."""
+	from osgeo import gdal
+	array = grid.array
+	types = {np.dtype(np.uint8):gdal.GDT_Byte, np.dtype(np.int32):gdal.GDT_Int32, np.dtype(np.float32):gdal.GDT_Float32}
+	dataset = gdal.GetDriverByName("GTiff").Create(path, grid.cols, grid.rows, 1, types.get(array.dtype, gdal.GDT_Float64), flmc.TiffOptions(array.dtype.kind == "f"))
+	dataset.SetGeoTransform((grid.xMin, grid.cellSize, 0, grid.yMax, 0, -grid.cellSize))
+	if(spatialReference != None):
+		dataset.SetProjection(spatialReference)
+	band = dataset.GetRasterBand(1)
+	if(array.dtype.kind == "f"):
+		band.SetNoDataValue(-9999)
+		array = np.where(np.isnan(array), -9999, array)
+	elif(array.dtype == np.uint8):
+		band.SetNoDataValue(canopyNoData)
+	band.WriteArray(array)
+	if(flmc.GetSetting("raster_overviews", True)):
+		dataset.BuildOverviews("AVERAGE" if array.dtype.kind == "f" else "NEAREST", [2, 4, 8, 16, 32])
+	dataset = None
+
+def CircleOffsets(radiusCells):
+	"""Returns the (row, col) offsets of the cells whose centre is within a circle of radiusCells."""
+	r = int(math.floor(radiusCells))
+	return [(dr, dc) for dr in range(-r, r+1) for dc in range(-r, r+1) if dr*dr+dc*dc <= radiusCells*radiusCells]
+
+def FocalMeanStd(array, radiusCells):
+	"""Focal mean and standard deviation in a circle, as FocalStatistics with a circle
+	neighbourhood. Cells outside the array and NoData cells (see Valid) are ignored."""
+	floatType = FloatType()
+	valid = Valid(array)
+	values = np.where(valid, array, 0).astype(floatType)
+	r = int(math.floor(radiusCells))
+	rows, cols = array.shape
+	values = np.pad(values, r, mode="constant")
+	counts = np.pad(valid.astype(floatType), r, mode="constant")
+	total = np.zeros((rows, cols), dtype=floatType)
+	total2 = np.zeros((rows, cols), dtype=floatType)
+	count = np.zeros((rows, cols), dtype=floatType)
+	for dr, dc in CircleOffsets(radiusCells):
+		window = values[r+dr:r+dr+rows, r+dc:r+dc+cols]
+		total += window
+		total2 += window*window
+		count += counts[r+dr:r+dr+rows, r+dc:r+dc+cols]
+	count[count == 0] = np.nan
+	mean = total/count
+	std = np.sqrt(np.maximum(total2/count-mean*mean, 0))
+	return mean, std
+
+def Expand(mask, cells):
+	"""Grows True zones of a boolean array by a number of cells (8 neighbours), as Expand."""
+	for i in range(0, cells):
+		grown = mask.copy()
+		grown[1:,:] |= mask[:-1,:]
+		grown[:-1,:] |= mask[1:,:]
+		grown[:,1:] |= mask[:,:-1]
+		grown[:,:-1] |= mask[:,1:]
+		grown[1:,1:] |= mask[:-1,:-1]
+		grown[:-1,:-1] |= mask[1:,1:]
+		grown[1:,:-1] |= mask[:-1,1:]
+		grown[:-1,1:] |= mask[1:,:-1]
+		mask = grown
+	return mask
+
+def Shrink(mask, cells):
+	"""Shrinks True zones of a boolean array by a number of cells (8 neighbours), as Shrink."""
+	return ~Expand(~mask, cells)
+
+def EuclideanDistance(mask, cellSize, maxDistance = None):
+	"""Distance from every cell to the nearest True cell of mask, infinity if there is none.
+	Without SciPy an 8 neighbour chamfer distance is used, computed up to maxDistance,
+	which is within 8% of the Euclidean distance."""
+	floatType = FloatType()
+	if(mask.any() == False):
+		return np.full(mask.shape, np.inf, dtype=floatType)
+	if(ndimage != None):
+		return (ndimage.distance_transform_edt(~mask)*cellSize).astype(floatType)
+	distance = np.where(mask, 0.0, np.inf).astype(floatType)
+	cellSize = floatType(cellSize)
+	diagonal = floatType(cellSize*math.sqrt(2))
+	steps = mask.shape[0]+mask.shape[1] if maxDistance == None else int(math.ceil(maxDistance/cellSize))+1
+	for i in range(0, steps):
+		last = distance.copy()
+		distance[1:,:] = np.minimum(distance[1:,:], last[:-1,:]+cellSize)
+		distance[:-1,:] = np.minimum(distance[:-1,:], last[1:,:]+cellSize)
+		distance[:,1:] = np.minimum(distance[:,1:], last[:,:-1]+cellSize)
+		distance[:,:-1] = np.minimum(distance[:,:-1], last[:,1:]+cellSize)
+		distance[1:,1:] = np.minimum(distance[1:,1:], last[:-1,:-1]+diagonal)
+		distance[:-1,:-1] = np.minimum(distance[:-1,:-1], last[1:,1:]+diagonal)
+		distance[1:,:-1] = np.minimum(distance[1:,:-1], last[:-1,1:]+diagonal)
+		distance[:-1,1:] = np.minimum(distance[:-1,1:], last[1:,:-1]+diagonal)
+		if(np.array_equal(last, distance)):
+			break
+	return distance
+
+def CanopyCost(chm, minHeight, searchRadius, maxLineDistance, avoidance, exponent):
+	"""Canopy and cost rasters of a CHM Grid, as the Canopy Cost Raster tool.
+	Returns the canopy Grid, a uint8 mask with 1 for canopy, 0 otherwise and canopyNoData where the
+	CHM is NoData, and the cost Grid of FloatType."""
+	floatType = FloatType()
+	noData = ~Valid(chm.array)
+	canopy = (chm.array > minHeight).view(np.uint8)
+	canopy[noData] = canopyNoData
+	mean, std = FocalMeanStd(canopy, searchRadius/chm.cellSize)
+	distance = EuclideanDistance(canopy == 1, chm.cellSize, maxLineDistance)
+	smooth = np.maximum(maxLineDistance-distance, 0)/floatType(maxLineDistance)
+	avoidance = floatType(max(min(float(avoidance), 1), 0))
+	with np.errstate(invalid="ignore", divide="ignore"):
+		closure = np.where(mean+std <= 0, 0, (1+(mean-std)/(mean+std))/2).astype(floatType)
+	cost = np.power(np.exp(np.where(canopy == 1, floatType(1), closure*(1-avoidance)+smooth*avoidance)), floatType(exponent))
+	cost[noData] = np.nan
+	return chm.Like(canopy), chm.Like(cost)
+
+def LineMask(grid, vertices, distance):
+	"""Returns a boolean array with the cells of grid whose centre is within distance of the polyline.
+	Coordinates are taken from the upper left corner of grid, so they keep their precision in FloatType."""
+	floatType = FloatType()
+	rows, cols = grid.rows, grid.cols
+	xs = ((np.arange(cols)+0.5)*grid.cellSize).astype(floatType)
+	ys = (-(np.arange(rows)+0.5)*grid.cellSize).astype(floatType)
+	px, py = np.meshgrid(xs, ys)
+	nearest = np.full((rows, cols), np.inf, dtype=floatType)
+	local = [(x-grid.xMin, y-grid.yMax) for x, y in vertices]
+	for (x1, y1), (x2, y2) in zip(local[:-1], local[1:]):
+		dx, dy = x2-x1, y2-y1
+		length2 = dx*dx+dy*dy
+		if(length2 == 0):
+			t = 0
+		else:
+			t = np.clip(((px-x1)*dx+(py-y1)*dy)/length2, 0, 1)
+		nearest = np.minimum(nearest, np.hypot(px-(x1+t*dx), py-(y1+t*dy)))
+	return nearest <= distance
+
+neighbours = [(-1,-1,math.sqrt(2)), (-1,0,1.0), (-1,1,math.sqrt(2)), (0,-1,1.0), (0,1,1.0), (1,-1,math.sqrt(2)), (1,0,1.0), (1,1,math.sqrt(2))]
+
+def CostGraph(cost, cellSize):
+	"""Sparse graph of the moves between adjacent valid cells. The cost of a move is the mean
+	cost of both cells times the distance between their centres, as in CostDistance."""
+	rows, cols = cost.shape
+	index = np.arange(rows*cols, dtype=np.int32).reshape(rows, cols)
+	heads = []
+	tails = []
+	weights = []
+	for dr, dc, step in [(0,1,1.0), (1,0,1.0), (1,1,math.sqrt(2)), (1,-1,math.sqrt(2))]:
+		r0, r1 = 0, rows-dr
+		c0, c1 = max(0, -dc), cols-max(0, dc)
+		a = cost[r0:r1, c0:c1]
+		b = cost[r0+dr:r1+dr, c0+dc:c1+dc]
+		valid = np.isfinite(a) & np.isfinite(b)
+		heads.append(index[r0:r1, c0:c1][valid])
+		tails.append(index[r0+dr:r1+dr, c0+dc:c1+dc][valid])
+		weights.append(np.maximum((a[valid]+b[valid])*0.5*step*cellSize, 1e-12))
+	heads = np.concatenate(heads)
+	tails = np.concatenate(tails)
+	weights = np.concatenate(weights)
+	return csr_matrix((np.concatenate([weights, weights]), (np.concatenate([heads, tails]), np.concatenate([tails, heads]))), shape=(rows*cols, rows*cols))
+
+def CostDistance(cost, sources, cellSize, sourceCosts = None):
+	"""Accumulated cost distance from a list of (row, col) source cells over a cost array.
+	NaN cells are barriers. sourceCosts optionally holds the accumulated cost at each source,
+	0 by default. Returns the distance array of FloatType (infinity where unreachable) and
+	the int32 predecessor array, holding for each cell the flat index of the previous cell in its
+	least cost path (-1 for sources and unreachable cells)."""
+	floatType = FloatType()
+	rows, cols = cost.shape
+	if(sourceCosts == None):
+		sourceCosts = [0.0]*len(sources)
+	valid = [(r*cols+c, float(d)) for (r, c), d in zip(sources, sourceCosts) if r >= 0 and c >= 0 and r < rows and c < cols and np.isfinite(cost[r, c])]
+	sources = [i for i, d in valid]
+	if(len(sources) == 0):
+		return np.full((rows, cols), np.inf, dtype=floatType), np.full((rows, cols), -1, dtype=np.int32)
+	if(csgraph != None and max([d for i, d in valid]) > 0):
+		# Sources with a cost are reached from an extra node, through edges of their cost plus one
+		# (edges of cost 0 would be missing from the sparse graph)
+		graph = CostGraph(cost, cellSize).tocoo()
+		n = rows*cols
+		heads = np.concatenate([graph.row, np.full(len(valid), n)])
+		tails = np.concatenate([graph.col, sources])
+		weights = np.concatenate([graph.data, [d+1.0 for i, d in valid]])
+		distance, predecessors = csgraph.dijkstra(csr_matrix((weights, (heads, tails)), shape=(n+1, n+1)), indices=n, return_predecessors=True)
+		distance, predecessors = distance[:n]-1.0, predecessors[:n]
+		predecessors[predecessors >= n] = -1
+		predecessors[predecessors < 0] = -1
+		return distance.astype(floatType).reshape(rows, cols), predecessors.astype(np.int32).reshape(rows, cols)
+	if(csgraph != None):
+		distance, predecessors, nearest = csgraph.dijkstra(CostGraph(cost, cellSize), indices=sources, min_only=True, return_predecessors=True)
+		predecessors[predecessors < 0] = -1
+		return distance.astype(floatType).reshape(rows, cols), predecessors.astype(np.int32).reshape(rows, cols)
+
+	# Dijkstra on Python lists, which are faster than NumPy arrays for single cell access
+	values = cost.ravel().tolist()
+	distance = [float("inf")]*(rows*cols)
+	predecessors = [-1]*(rows*cols)
+	heap = []
+	for source, d in valid:
+		if(d < distance[source]):
+			distance[source] = d
+			heap.append((d, source))
+	heapq.heapify(heap)
+	while len(heap)>0:
+		d, i = heapq.heappop(heap)
+		if(d > distance[i]):
+			continue
+		r, c = divmod(i, cols)
+		ci = values[i]
+		for dr, dc, step in neighbours:
+			rr, cc = r+dr, c+dc
+			if(rr < 0 or cc < 0 or rr >= rows or cc >= cols):
+				continue
+			j = rr*cols+cc
+			cj = values[j]
+			if(cj != cj):
+				continue
+			dj = d+(ci+cj)*0.5*step*cellSize
+			if(dj < distance[j]):
+				distance[j] = dj
+				predecessors[j] = i
+				heapq.heappush(heap, (dj, j))
+	return np.array(distance, dtype=floatType).reshape(rows, cols), np.array(predecessors, dtype=np.int32).reshape(rows, cols)
+
+def LeastCostPath(predecessors, destination):
+	"""Returns the (row, col) cells of the least cost path from the source to the destination cell."""
+	cols = predecessors.shape[1]
+	flat = predecessors.ravel()
+	i = destination[0]*cols+destination[1]
+	path = [i]
+	while flat[i] >= 0:
+		i = flat[i]
+		path.append(i)
+	path.reverse()
+	return [divmod(int(i), cols) for i in path]
+
+def Perimeter(mask, cellSize):
+	"""Length of the boundary of the True zones of a boolean array."""
+	padded = np.pad(mask, 1, mode="constant")
+	edges = np.count_nonzero(padded[1:,:] != padded[:-1,:])+np.count_nonzero(padded[:,1:] != padded[:,:-1])
+	return edges*cellSize
+
+def PolylineLength(vertices):
+	return sum([math.hypot(x2-x1, y2-y1) for (x1, y1), (x2, y2) in zip(vertices[:-1], vertices[1:])])
+
+def Bearing(vertices):
+	"""Bearing in degrees clockwise from north from the first to the last vertex."""
+	return math.degrees(math.atan2(vertices[-1][0]-vertices[0][0], vertices[-1][1]-vertices[0][1])) % 360
+
+def LineWindow(raster, vertices, distance):
+	"""Cells of raster within distance of the polyline. Other cells of its extent are set to NaN,
+	as the tools clip the cost raster with the line buffer."""
+	window = raster.Clip(*LineExtent(vertices, distance))
+	array = window.array.astype(FloatType())
+	array[LineMask(window, vertices, distance) == False] = np.nan
+	return window.Like(array)
+
+def Aggregate(grid, factor, method = "mean"):
+	"""Coarse grid with cells of factor by factor cells of grid, holding the mean of their valid cells,
+	or their minimum with method "min", as Aggregate ignoring NoData. Coarse cells without valid
+	cells are NaN. Partial coarse cells on the right and bottom edges are kept."""
+	rows, cols = -(-grid.rows//factor), -(-grid.cols//factor)
+	padded = np.full((rows*factor, cols*factor), np.nan, dtype=FloatType())
+	padded[:grid.rows, :grid.cols] = grid.array
+	blocks = padded.reshape(rows, factor, cols, factor)
+	valid = np.isfinite(blocks)
+	count = valid.sum(axis=(1, 3))
+	if(method == "min"):
+		values = np.where(valid, blocks, np.inf).min(axis=(1, 3))
+	else:
+		values = np.where(valid, blocks, 0).sum(axis=(1, 3))/np.maximum(count, 1)
+	return Grid(np.where(count > 0, values, np.nan).astype(FloatType()), grid.xMin, grid.yMax, grid.cellSize*factor)
+
+def PyramidWindow(window, vertices, factor, band, method = "mean"):
+	"""Cells of a line window within band of the least cost path between the ends of the line found
+	on the window aggregated by factor (see Aggregate). Other cells are set to NaN, so the full
+	resolution search only visits a narrow band around the coarse path. The band is measured on the
+	coarse cells and is at least one coarse cell wide, which keeps both ends of the line in it.
+	Returns None if there is no coarse path."""
+	coarse = Aggregate(window, factor, method)
+	origin = coarse.CellOf(*vertices[0])
+	destination = coarse.CellOf(*vertices[-1])
+	if(coarse.Contains(*origin) == False or coarse.Contains(*destination) == False):
+		return None
+	distance, predecessors = CostDistance(coarse.array, [origin], coarse.cellSize)
+	if(np.isfinite(distance[destination]) == False):
+		return None
+	path = np.zeros(coarse.array.shape, dtype=bool)
+	for r, c in LeastCostPath(predecessors, destination):
+		path[r, c] = True
+	band = max(band, coarse.cellSize)
+	inside = EuclideanDistance(path, coarse.cellSize, band) <= band
+	inside = np.repeat(np.repeat(inside, factor, axis=0), factor, axis=1)[:window.rows, :window.cols]
+	return window.Like(np.where(inside, window.array, np.nan))
+
+def WindowPath(window, vertices):
+	"""Least cost path between the first and last vertex of a line over a window, or None if there is none."""
+	origin = window.CellOf(*vertices[0])
+	destination = window.CellOf(*vertices[-1])
+	if(window.Contains(*destination) == False):
+		return None
+	distance, predecessors = CostDistance(window.array, [origin], window.cellSize)
+	if(np.isfinite(distance[destination]) == False):
+		return None
+	return [window.CenterOf(r, c) for r, c in LeastCostPath(predecessors, destination)]
+
+def CenterLine(cost, vertices, searchDistance, startDistance = 0, growth = 2.0, factor = 1, band = 0, method = "mean"):
+	"""Least cost path between the first and last vertex of a line within searchDistance of the line,
+	as the Center Line tool. Returns the list of (x, y) vertices of the path, or None if there is none.
+	If factor is above 1 the path is searched at full resolution only within band of the path found
+	on the cost aggregated by factor (see PyramidWindow), and in the whole window if none is found there.
+	Otherwise, if startDistance is above 0 the path is searched within startDistance first (see AdaptivePath)."""
+	if(factor <= 1 and startDistance > 0 and startDistance < searchDistance):
+		return AdaptivePath(cost, vertices, searchDistance, startDistance, growth)
+	window = LineWindow(cost, vertices, searchDistance)
+	if(factor > 1):
+		banded = PyramidWindow(window, vertices, factor, band, method)
+		path = WindowPath(banded, vertices) if banded != None else None
+		if(path != None):
+			return path
+	return WindowPath(window, vertices)
+
+def AdaptivePath(cost, vertices, searchDistance, startDistance, growth):
+	"""Least cost path searched first within startDistance of the line. While the path runs along
+	the edge of the window (it could be shorter through cells outside), the window grows by the
+	factor growth, up to searchDistance, and the search resumes from the cells already settled.
+	Cells with an accumulated cost below the lowest cost on the edge of the window can not be
+	reached more cheaply from outside, so they keep their cost and path. The search continues
+	from the settled cells next to unsettled cells, and the other settled cells are left out.
+	Returns the list of (x, y) vertices of the path, or None if there is none."""
+	window = cost.Clip(*LineExtent(vertices, searchDistance))
+	origin = window.CellOf(*vertices[0])
+	destination = window.CellOf(*vertices[-1])
+	if(window.Contains(*destination) == False):
+		return None
+	values = window.array.astype(FloatType())
+	valid = np.isfinite(values)
+	distance = np.full(values.shape, np.inf, dtype=values.dtype)
+	predecessors = np.full(values.shape, -1, dtype=np.int32)
+	settled = np.zeros(values.shape, dtype=bool)
+	radius = startDistance
+	while True:
+		inside = LineMask(window, vertices, radius) & valid
+		# Settled cells next to cells still to search are the sources of the search
+		pending = inside & ~settled
+		sources = settled & Expand(pending, 1)
+		if(sources.any()):
+			rows, cols = np.nonzero(sources)
+			search = np.where(pending | sources, values, np.nan)
+			newDistance, newPredecessors = CostDistance(search, list(zip(rows, cols)), window.cellSize, distance[sources].tolist())
+			distance[pending] = newDistance[pending]
+			predecessors[pending] = newPredecessors[pending]
+		elif(settled.any() == False):
+			distance, predecessors = CostDistance(np.where(inside, values, np.nan), [origin], window.cellSize)
+		# Cells on the edge of the window, next to valid cells outside it
+		edge = inside & Expand(valid & ~inside, 1)
+		reached = np.isfinite(distance[destination])
+		if(radius >= searchDistance or edge.any() == False):
+			break
+		path = LeastCostPath(predecessors, destination) if reached else []
+		if(reached and not any([edge[r, c] for r, c in path])):
+			break
+		settled = inside & (distance < np.min(distance[edge]))
+		radius = min(radius*growth, searchDistance)
+	if(np.isfinite(distance[destination]) == False):
+		return None
+	return [window.CenterOf(r, c) for r, c in LeastCostPath(predecessors, destination)]
+
+def Corridor(cost, vertices, searchDistance, factor = 1, band = 0, method = "mean"):
+	"""Corridor raster of a line (sum of the cost distances from both ends), as in Line Footprint.
+	If factor is above 1 the corridor is computed only within band of the coarse path (see PyramidWindow),
+	and in the whole window if the ends of the line are not connected in the band."""
+	window = LineWindow(cost, vertices, searchDistance)
+	if(factor > 1):
+		banded = PyramidWindow(window, vertices, factor, band, method)
+		corridor = WindowCorridor(banded, vertices) if banded != None else None
+		if(corridor != None and np.isfinite(corridor.array).any()):
+			return corridor
+	return WindowCorridor(window, vertices)
+
+def WindowCorridor(window, vertices):
+	distanceA, predA = CostDistance(window.array, [window.CellOf(*vertices[0])], window.cellSize)
+	distanceB, predB = CostDistance(window.array, [window.CellOf(*vertices[-1])], window.cellSize)
+	return window.Like(distanceA+distanceB)
+
+def Footprint(corridor, canopy, threshold, expandShrink = 0):
+	"""Footprint cells of a corridor: cells within threshold of the corridor minimum that are
+	not canopy, closed with Expand and Shrink of the non footprint cells, as in Line Footprint."""
+	valid = np.isfinite(corridor.array)
+	if(valid.any() == False):
+		return corridor.Like(valid)
+	x0, y0, x1, y1 = corridor.Extent()
+	canopyWindow = canopy.Clip(x0+corridor.cellSize/2, y0+corridor.cellSize/2, x1-corridor.cellSize/2, y1-corridor.cellSize/2).array
+	footprint = valid & (corridor.array-np.min(corridor.array[valid]) <= threshold) & (canopyWindow < 1)
+	if(expandShrink > 0):
+		footprint = ~Shrink(Expand(~footprint, expandShrink), expandShrink) & valid
+	return corridor.Like(footprint)
+
+def LineFootprint(cost, canopy, vertices, searchDistance, threshold, expandShrink = 0, factor = 1, band = 0, method = "mean"):
+	return Footprint(Corridor(cost, vertices, searchDistance, factor, band, method), canopy, threshold, expandShrink)
+
+def ZonalThreshold(canopy, vertices, searchRadius, minValue, maxValue):
+	"""Corridor threshold of a line from the mean canopy closure around it, as the Zonal Threshold tool."""
+	window = canopy.Clip(*LineExtent(vertices, searchRadius))
+	values = window.array[LineMask(window, vertices, searchRadius) & Valid(window.array)]
+	if(len(values) == 0):
+		return None
+	mean = float(values.mean())
+	return minValue+(mean*mean)*(maxValue-minValue)
+
+def LineAttributes(vertices, footprint = None, chm = None, searchRadius = 0):
+	"""Attributes of a line, as the Forest Line Attributes tool. Area attributes use the footprint
+	cells within searchRadius of the line and height attributes the CHM cells in them."""
+	length = PolylineLength(vertices)
+	bearing = Bearing(vertices)
+	eucDistance = math.hypot(vertices[-1][0]-vertices[0][0], vertices[-1][1]-vertices[0][1])
+	attributes = {"Sinuosity": length/eucDistance if eucDistance > 0 else float("inf")}
+	ori = "N-S"
+	if ((bearing >= 22.5 and bearing < 67.5) or (bearing >= 202.5 and bearing < 247.5)):
+		ori = "NE-SW"
+	elif ((bearing >= 67.5 and bearing < 112.5) or (bearing >= 247.5 and bearing < 292.5)):
+		ori = "E-W"
+	elif ((bearing >= 112.5 and bearing < 157.5) or (bearing >= 292.5 and bearing < 337.5)):
+		ori = "NW-SE"
+	attributes["Direction"] = ori
+	if(footprint == None):
+		return attributes
+
+	window = footprint.Clip(*LineExtent(vertices, searchRadius))
+	cells = window.array.astype(bool) & LineMask(window, vertices, searchRadius)
+	cellArea = window.cellSize*window.cellSize
+	area = np.count_nonzero(cells)*cellArea
+	attributes["AvgWidth"] = float(area/length) if length > 0 else 0.0
+	attributes["Fragment"] = float(Perimeter(cells, window.cellSize)/area) if area > 0 else float("inf")
+	if(chm == None or area == 0):
+		return attributes
+
+	x0, y0, x1, y1 = window.Extent()
+	heights = chm.Clip(x0+window.cellSize/2, y0+window.cellSize/2, x1-window.cellSize/2, y1-window.cellSize/2).array[cells]
+	heights = heights[np.isfinite(heights)]
+	if(len(heights) == 0):
+		return attributes
+	mean = float(heights.mean())
+	attributes["AvgHeight"] = mean
+	attributes["Volume"] = float(heights.sum())*cellArea
+	attributes["Roughness"] = math.sqrt(mean*mean+float(heights.var()))
+	return attributes
@@ -27,50 +27,54 @@
 #
 # ---------------------------------------------------------------------------
 
-import multiprocessing
 import math
 import arcpy
-arcpy.CheckOutExtension("Spatial")
 from . import FLM_Common as flmc
+from . import FLM_LineTable as flmlt
+from . import FLM_RasterCache as flmrc
 from . import FLM_Attribute_Functions as flma
+from . import FLM_ZonalStats as flmz
+from . import FLM_GeoPackage as flmg
 
 # Setup script path and workspace folder
 workspaceName = "FLM_SLA_output"
 outWorkspace = flmc.GetWorkspace(workspaceName)
-arcpy.env.workspace = outWorkspace
-arcpy.env.overwriteOutput = True
 
-# Load arguments from file
-args = flmc.GetArgs("FLM_SLA_params.txt")
-
-# Tool arguments
-Input_Lines = args[0].rstrip()
-Input_Footprint = args[1].rstrip()
-Input_CHM = args[2].rstrip()
-SamplingType = args[3].rstrip()
-Segment_Length = float(args[4].rstrip())
-Tolerance_Radius = float(args[5].rstrip())
-LineSearchRadius = float(args[6].rstrip())
-Attributed_Segments = args[7].rstrip()
-
-areaAnalysis = arcpy.Exists(Input_Footprint)
-heightAnalysis = arcpy.Exists(Input_CHM)
-
-#Temporary layers
-fileBuffer = outWorkspace +"\\FLM_SLA_Buffer.shp"
-fileIdentity = outWorkspace+"\\FLM_SLA_Identity.shp"
-fileFootprints = outWorkspace+"\\FLM_SLA_Footprints.shp"
-
-footprintField = flmc.FileToField(fileBuffer)
+def LoadArgs():
+	"""Loads the tool arguments from the parameter file. Arguments are not loaded when the
+	module is imported, they are loaded when the tool runs and once in each worker process."""
+	global Input_Lines, Input_Footprint, Input_CHM, SamplingType, Segment_Length, Tolerance_Radius, LineSearchRadius, Attributed_Segments, areaAnalysis, heightAnalysis, fileBuffer, fileIdentity, fileFootprints, footprintField
+	arcpy.CheckOutExtension("Spatial")
+	arcpy.env.workspace = outWorkspace
+	arcpy.env.overwriteOutput = True
+
+	# Load arguments from file
+	args = flmc.GetArgs("FLM_FLA_params.txt")
+
+	# Tool arguments
+	Input_Lines = args[0].rstrip()
+	Input_Footprint = args[1].rstrip()
+	Input_CHM = flmrc.CachedRaster(args[2].rstrip())
+	SamplingType = args[3].rstrip()
+	Segment_Length = float(args[4].rstrip())
+	Tolerance_Radius = float(args[5].rstrip())
+	LineSearchRadius = float(args[6].rstrip())
+	Attributed_Segments = args[7].rstrip()
+
+	areaAnalysis = arcpy.Exists(Input_Footprint)
+	heightAnalysis = arcpy.Exists(Input_CHM)
+
+	#Temporary layers
+	fileBuffer = outWorkspace +"\\FLM_SLA_Buffer.shp"
+	fileIdentity = outWorkspace+"\\FLM_SLA_Identity.shp"
+	fileFootprints = outWorkspace+"\\FLM_SLA_Footprints.shp"
+
+	footprintField = flmc.FileToField(fileBuffer)
 
 def workLines(lineNo):
 	#Temporary files
 	lineSeg = outWorkspace +"\\FLM_SLA_Segment_" + str(lineNo) +".shp"
 	#fileFoot = outWorkspace +"\\FLM_SLA_Split_" + str(lineNo) +".shp"
-	lineBuffer = outWorkspace +"\\FLM_SLA_Buffer_" + str(lineNo) +".shp"
-	lineClip = outWorkspace+"\\FLM_SLA_Clip_" + str(lineNo) +".shp"
-	#fileFoot = outWorkspace+"\\FLM_SLA_Foot_" + str(lineNo) +".shp"
-	lineStats = outWorkspace+"\\FLM_SLA_Stats_" + str(lineNo) +".dbf"
 	
 	"""
 	arcpy.AddField_management(lineSeg,"Direction","TEXT")
@@ -85,22 +89,9 @@ def workLines(lineNo):
 			arcpy.AddField_management(lineSeg,"Roughness","DOUBLE")
 	"""
 	
-	if(areaAnalysis):
-
-		arcpy.Buffer_analysis(lineSeg, lineBuffer, LineSearchRadius, line_side="FULL", line_end_type="FLAT", dissolve_option="NONE", dissolve_field="", method="PLANAR")
-		arcpy.Clip_analysis(Input_Footprint, lineBuffer, lineClip)
-		arcpy.Delete_management(lineBuffer)
-		if (heightAnalysis and arcpy.Exists(lineClip)):
-			try:
-				arcpy.gp.ZonalStatisticsAsTable_sa(lineClip, arcpy.Describe(lineClip).OIDFieldName, Input_CHM, lineStats, "DATA", "ALL")
-			except:
-				lineStats = ""
-	
 	rows = arcpy.UpdateCursor(lineSeg)
-	shapeField = arcpy.Describe(lineSeg).ShapeFieldName
 	row = rows.next()
 
-	feat = row.getValue(shapeField)   #creates a geometry object
 	length = float(row.getValue("LENGTH"))   #creates a geometry object
 	
 	try:
@@ -108,16 +99,9 @@ def workLines(lineNo):
 	except:
 		bearing = 0
 		
-	segmentnum = 0
-	segment_list = []
-	for segment in feat: #loops through every segment in a line
-		#loops through every vertex of every segment
-		for pnt in feat.getPart(segmentnum):                 #get.PArt returns an array of points for a particular part in the geometry
-			if pnt:                  #adds all the vertices to segment_list, which creates an array
-				segment_list.append(arcpy.Point(float(pnt.X), float(pnt.Y)))
-	
-	#Sinuosity calculation			
-	eucDistance = arcpy.PointGeometry(feat.firstPoint).distanceTo(arcpy.PointGeometry(feat.lastPoint))
+	#Sinuosity calculation, from the first and last vertices in the line table written by SplitLines
+	vertices = flmlt.TaskVertices(outWorkspace, "SLA", lineNo)
+	eucDistance = math.hypot(*(vertices[-1]-vertices[0]))
 	try:
 		row.setValue("Sinuosity",length/eucDistance)
 	except:
@@ -145,33 +129,7 @@ def workLines(lineNo):
 		except:
 			row.setValue("Fragment",float("inf"))
 		
-		if(arcpy.Exists(lineStats)):
-
-			#Retrieve useful stats from table which are used to derive CHM attributes
-			ChmFootprintCursor = arcpy.SearchCursor(lineStats)
-			ChmFoot = ChmFootprintCursor.next()
-			chm_count = float(ChmFoot.getValue("COUNT"))
-			chm_area = float(ChmFoot.getValue("AREA"))
-			chm_mean = float(ChmFoot.getValue("MEAN"))
-			chm_std = float(ChmFoot.getValue("STD"))
-			chm_sum = float(ChmFoot.getValue("SUM"))
-			del ChmFootprintCursor
-			
-			#Average vegetation height directly obtained from CHM mean
-			row.setValue("AvgHeight",chm_mean)
-			#Cell area obtained via dividing the total area by the number of cells (this assumes that the projection is UTM to obtain a measure in square meters)
-			cellArea = chm_area/chm_count
-			#CHM volume (3D) is obtained via multiplying the sum of height (1D) of all cells within the footprint by the area of each cell (2D)
-			row.setValue("Volume",chm_sum*cellArea)
-			#The following math is performed to use available stats (fast) and avoid further raster sampling procedures (slow)
-			#RMSH is equal to the square root of the sum of the squared mean and the squared standard deviation (population)
-			#STD of population (n) is derived from the STD of sample (n-1). This number is not useful by itself, only to derive RMSH.
-			sqStdPop = math.pow(chm_std,2)*(chm_count-1)/chm_count
-			#Obtain RMSH from mean and STD
-			row.setValue("Roughness",math.sqrt(math.pow(chm_mean,2)+sqStdPop))
-				
-				
-			
+		# CHM attributes (AvgHeight, Volume and Roughness) are calculated for all lines at once by main (see HeightAttributes)
 		
 	rows.updateRow(row)
 
@@ -183,12 +141,27 @@ def workLines(lineNo):
 	if(arcpy.Exists(lineClip)):
 		arcpy.Delete_management(lineClip)
 	"""
-	if(arcpy.Exists(lineClip)):
-		arcpy.Delete_management(lineClip)
-	if(arcpy.Exists(lineStats)):
-		arcpy.Delete_management(lineStats)
+	return flmg.TakeOutput(lineSeg, Attributed_Segments, outWorkspace, "SLA")
+
+def HeightAttributes(fileFootprints):
+	"""CHM attributes of each line from the CHM cells of its footprint, calculated for all footprints
+	reading the CHM once (see FLM_ZonalStats). Returns a dictionary from the object ID of the line
+	to (AvgHeight, Volume, Roughness), without the lines whose footprint has no CHM cells."""
+	zones, ids = flmz.PolygonZones(fileFootprints, "ORIG_FID")
+	stats = flmz.ZonalStatistics(zones, [Input_CHM])[0]
+	attributes = {}
+	for lineId, zone in zip(ids, stats):
+		if(zone["count"] == 0):
+			continue
+		#Average vegetation height directly obtained from CHM mean
+		#CHM volume (3D) is obtained via multiplying the sum of height (1D) of all cells within the footprint by the area of each cell (2D)
+		#RMSH (roughness) is the square root of the mean of the squared heights
+		cellArea = zone["area"]/zone["count"]
+		attributes[int(lineId)] = (float(zone["mean"]), float(zone["sum"]*cellArea), math.sqrt(zone["sum2"]/zone["count"]))
+	return attributes
 
 def main():
+	LoadArgs()
 	global outWorkspace
 	outWorkspace = flmc.SetupWorkspace(workspaceName)
 	
@@ -214,6 +187,10 @@ def main():
 		arcpy.AddGeometryAttributes_management(fileFootprints, Geometry_Properties="AREA;PERIMETER_LENGTH", Length_Unit="METERS", Area_Unit="SQUARE_METERS", Coordinate_System="")
 		arcpy.JoinField_management(SLA_Segmented_Lines, arcpy.Describe(SLA_Segmented_Lines).OIDFieldName, fileFootprints, "ORIG_FID", fields="POLY_AREA;PERIMETER")
 		#flmc.SplitFeature(fileFootprints,footprintField,outWorkspace, "SLA")
+		if(heightAnalysis):
+			flmc.log("Calculating zonal statistics...")
+			heights = HeightAttributes(fileFootprints)
+			flmc.logStep("Zonal statistics")
 		
 		arcpy.Delete_management(fileBuffer)
 		arcpy.Delete_management(fileIdentity)
@@ -238,21 +215,31 @@ def main():
 			arcpy.AddField_management(SLA_Segmented_Lines,"Volume","DOUBLE")
 			arcpy.AddField_management(SLA_Segmented_Lines,"Roughness","DOUBLE")
 			keepFields += ["AvgHeight","Volume","Roughness"]
+			rows = arcpy.da.UpdateCursor(SLA_Segmented_Lines, ["OID@","AvgHeight","Volume","Roughness"])
+			for row in rows:
+				if(row[0] in heights):
+					rows.updateRow([row[0]]+list(heights[row[0]]))
+			del rows
 	
 	# Prepare input lines for multiprocessing
 	numLines = flmc.SplitLines(SLA_Segmented_Lines, outWorkspace, "SLA", False, keepFields ) #,"Direction","Sinuosity","Area","AvgWidth","Perimeter","Fragment","SLA_Unity","AvgHeight","Volume","Roughness"])
 	
 	arcpy.Delete_management(SLA_Segmented_Lines)
 	
-	pool = multiprocessing.Pool(processes=flmc.GetCores())
+	# Lines are written to a GeoPackage as they finish
+	writer = flmg.OpenOutput(outWorkspace, "SLA", Attributed_Segments) if flmg.UseGeoPackage(Attributed_Segments) else None
+	
 	flmc.log("Multiprocessing lines...")
-	pool.map(workLines, range(1,numLines+1))
-	pool.close()
-	pool.join()
+	flmc.MapTasks(workLines, range(1,numLines+1), None, writer.Add if writer != None else None)
 	
 	flmc.logStep("Line multiprocessing")
+	flmc.ReportFailures(Input_Lines, outWorkspace, "SLA", Attributed_Segments, ["Split"])
 	
 	flmc.log("Merging lines...")
+	if(writer != None):
+		flmg.CloseOutput(writer, outWorkspace, "SLA", Attributed_Segments)
+		flmc.logStep("Merging")
+		return
 	tempShapefiles = arcpy.ListFeatureClasses()
 	
 	arcpy.Merge_management(tempShapefiles,Attributed_Segments)
@@ -37,11 +37,13 @@ try:
 except ImportError:
     import tkinter.filedialog as tkFileDialog
 import os
+import time
 import importlib
 import webbrowser
 import multiprocessing
 from . import Tooltip as ttp
 from . import FLM_Common as flmc
+from . import FLM_Daemon as flmd
 
     
 # Initialize GUI
@@ -58,15 +60,34 @@ fontBold = 'Helvetica 10 bold'
 def RunTool():
 	currentTool.SaveParams()
 	master.destroy()
+	
+	# Run on the FLM service if it is running, it already has arcpy and workers loaded
+	if(flmd.IsRunning()):
+		flmc.logStart(currentTool)
+		reply = flmd.RunJob(currentTool.scriptFile)
+		if(reply["status"] == "ok" and reply["result"]):
+			flmc.logEnd(currentTool)
+		elif(reply["status"] != "ok"):
+			flmc.log(reply["error"])
+		return
+	
 	print("Initializing arcpy and other script dependencies...")
+	# Child processes load only this tool (see ForestLineMapper.py)
+	os.environ["FLM_TOOL"] = currentTool.scriptFile
+	timeImport = time.time()
 	scriptTool = importlib.import_module(currentTool.scriptFile)
+	timeImport = time.time()-timeImport
 	flmc.logStart(currentTool)
+	flmc.log("Tool loaded in "+"{:.2f}".format(timeImport)+" seconds", True)
+	flmc.StartTrace(currentTool.title)
 	try:
 		r = scriptTool.main()
 		if(r != False):
 			flmc.logEnd(currentTool)
 	except Exception as e: 
 		flmc.log("\n".join(e.args))
+	flmc.WriteTrace()
+	flmc.RemoveScratch()
 
 def ToolDefaults():
 	currentTool.SetDefaults()
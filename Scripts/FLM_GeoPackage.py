@@ -0,0 +1,405 @@
+#
+#    Copyright (C) 2020  Applied Geospatial Research Group
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, version 3.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <https://gnu.org/licenses/gpl-3.0>.
+#
+# ---------------------------------------------------------------------------
+#
+# FLM_GeoPackage.py
+# Script Author: Gustavo Lopes Queiroz
+# Date: 2020-Jan-22
+#
+# This script is part of the Forest Line Mapper (FLM) toolset
+# Webpage: https://github.com/appliedgrg/flm
+#
+# Purpose: GeoPackage (SQLite) output backend of the per-line tools, written
+# with the sqlite3 module. When the output of a tool is a .gpkg file, each
+# line task returns the features of its line to the parent process instead
+# of leaving one shapefile per line, and a single writer in the parent
+# appends them to the output in batches as the tasks finish. The output can
+# be viewed while the tool runs, there is no merge of thousands of files at
+# the end and no 2 GB or 10 character field name limit in the output.
+# Workers of the work queue, which may run on other computers, append their
+# features to their own scratch GeoPackage instead, copied to the output
+# when the tool finishes.
+# Settings used (see FLM_Common.GetSetting):
+#     scratch_format=gpkg  writes the features through a GeoPackage also when
+#                          the output is not a GeoPackage (e.g. a shapefile)
+#     stream_batch         features written to the output in each transaction
+#     stream_interval      seconds after which pending features are written
+#
+# ---------------------------------------------------------------------------
+
+import os, glob, time, socket, struct, sqlite3
+from . import FLM_Common as flmc
+
+scratchTable = "features"
+
+def IsGeoPackage(path):
+	return path.lower().endswith(".gpkg")
+
+def UseGeoPackage(output):
+	"""True if the per-line results of a tool writing to output are stored in scratch GeoPackages."""
+	return IsGeoPackage(output) or flmc.GetSetting("scratch_format", "shp") == "gpkg"
+
+def ArcpyTable(path, table):
+	"""Path of a GeoPackage table as used by arcpy tools."""
+	return os.path.join(path, "main."+table)
+
+def TableName(path):
+	"""Name of the output table: the GeoPackage file name, with characters other than letters, digits and _ replaced."""
+	name = os.path.splitext(os.path.basename(path))[0]
+	name = "".join([c if c.isalnum() or c == "_" else "_" for c in name])
+	return name if not name[0].isdigit() else "t_"+name
+
+def OutputTable(output):
+	"""Path to which arcpy tools write output: when output is a GeoPackage, the table named as the file
+	(see TableName) in a new empty GeoPackage, otherwise output itself."""
+	if(IsGeoPackage(output) == False):
+		return output
+	import arcpy
+	if(os.path.exists(output)):
+		os.remove(output)
+	arcpy.CreateSQLiteDatabase_management(output, "GEOPACKAGE")
+	return ArcpyTable(output, TableName(output))
+
+def ScratchPath(outWorkspace, toolCodename):
+	"""Scratch GeoPackage of this worker process. The host name avoids clashes between work queue workers."""
+	return os.path.join(outWorkspace, "FLM_"+toolCodename+"_Scratch_"+socket.gethostname()+"_"+str(os.getpid())+".gpkg")
+
+def ScratchFiles(outWorkspace, toolCodename):
+	return sorted(glob.glob(os.path.join(outWorkspace, "FLM_"+toolCodename+"_Scratch_*.gpkg")))
+
+def MultiWkb(wkb):
+	"""Returns the WKB of a geometry as a multi geometry, as the table geometry type must be the same for all rows,
+	with its geometry type code and envelope (minx, maxx, miny, maxy)."""
+	wkb = bytes(wkb)
+	order = "<" if wkb[0:1] == b"\x01" else ">"
+	code = struct.unpack(order+"I", wkb[1:5])[0]
+	base = (code & 0xffff) % 1000
+	if(base in [1, 2, 3]):
+		wkb = wkb[0:1]+struct.pack(order+"I", code+3)+struct.pack(order+"I", 1)+wkb
+		code += 3
+	return wkb, (code & 0xffff) % 1000, Envelope(wkb)
+
+def Envelope(wkb):
+	"""Envelope (minx, maxx, miny, maxy) of a WKB geometry, or None if it is empty."""
+	xs = []
+	ys = []
+	ReadWkb(wkb, 0, xs, ys)
+	if(len(xs) == 0):
+		return None
+	return (min(xs), max(xs), min(ys), max(ys))
+
+def ReadWkb(wkb, offset, xs, ys):
+	"""Reads the coordinates of the WKB geometry at offset into xs and ys and returns the offset after it."""
+	order = "<" if wkb[offset:offset+1] == b"\x01" else ">"
+	code = struct.unpack(order+"I", wkb[offset+1:offset+5])[0]
+	offset += 5
+	dims = 2
+	if(code & 0x80000000):
+		dims += 1
+	if(code & 0x40000000):
+		dims += 1
+	code = code & 0xffff
+	dims += {1:1, 2:1, 3:2}.get(code // 1000, 0)
+	base = code % 1000
+	point = struct.Struct(order+"d"*dims)
+	if(base == 1):
+		values = point.unpack_from(wkb, offset)
+		if(values[0] == values[0]):
+			xs.append(values[0])
+			ys.append(values[1])
+		return offset+point.size
+	count = struct.unpack_from(order+"I", wkb, offset)[0]
+	offset += 4
+	if(base == 2):
+		for i in range(0, count):
+			values = point.unpack_from(wkb, offset)
+			xs.append(values[0])
+			ys.append(values[1])
+			offset += point.size
+	elif(base == 3):
+		for r in range(0, count):
+			points = struct.unpack_from(order+"I", wkb, offset)[0]
+			offset += 4
+			for i in range(0, points):
+				values = point.unpack_from(wkb, offset)
+				xs.append(values[0])
+				ys.append(values[1])
+				offset += point.size
+	else:
+		for g in range(0, count):
+			offset = ReadWkb(wkb, offset, xs, ys)
+	return offset
+
+def GeometryBlob(wkb, srsId, envelope):
+	"""GeoPackage geometry: the GeoPackage binary header with the envelope, followed by the WKB."""
+	if(envelope == None):
+		return b"GP"+struct.pack("<BBi", 0, 0x11, srsId)+wkb
+	return b"GP"+struct.pack("<BBi4d", 0, 0x03, srsId, *envelope)+wkb
+
+def BlobEnvelope(blob, index):
+	"""Envelope value of a GeoPackage geometry, registered as the ST_MinX... functions used by the spatial index."""
+	if(blob == None):
+		return None
+	flags = bytearray(blob[3:4])[0]
+	if((flags >> 1) & 0x07 == 0):
+		envelope = Envelope(bytes(blob[8:]))
+		return None if envelope == None else envelope[index]
+	return struct.unpack_from("<d" if flags & 0x01 else ">d", blob, 8+8*index)[0]
+
+def BlobIsEmpty(blob):
+	return 1 if blob == None or (bytearray(blob[3:4])[0] >> 4) & 0x01 else 0
+
+geometryNames = {1:"POINT", 2:"LINESTRING", 3:"POLYGON", 4:"MULTIPOINT", 5:"MULTILINESTRING", 6:"MULTIPOLYGON", 7:"GEOMETRYCOLLECTION"}
+
+def Connect(path):
+	"""Opens a GeoPackage with the functions used by the spatial index triggers."""
+	conn = sqlite3.connect(path, timeout=120, isolation_level=None)
+	conn.create_function("ST_MinX", 1, lambda blob: BlobEnvelope(blob, 0))
+	conn.create_function("ST_MaxX", 1, lambda blob: BlobEnvelope(blob, 1))
+	conn.create_function("ST_MinY", 1, lambda blob: BlobEnvelope(blob, 2))
+	conn.create_function("ST_MaxY", 1, lambda blob: BlobEnvelope(blob, 3))
+	conn.create_function("ST_IsEmpty", 1, BlobIsEmpty)
+	return conn
+
+def CreateGeoPackage(conn, table, geometryType, columns, srs):
+	"""Creates the GeoPackage metadata tables and a feature table with columns [(name, SQL type)].
+	srs is (srs_id, organization, organization_coordsys_id, definition)."""
+	conn.execute("PRAGMA application_id = 1196444487")
+	conn.execute("PRAGMA user_version = 10200")
+	conn.execute("CREATE TABLE IF NOT EXISTS gpkg_spatial_ref_sys (srs_name TEXT NOT NULL, srs_id INTEGER PRIMARY KEY, organization TEXT NOT NULL, organization_coordsys_id INTEGER NOT NULL, definition TEXT NOT NULL, description TEXT)")
+	conn.execute("INSERT OR IGNORE INTO gpkg_spatial_ref_sys VALUES ('Undefined cartesian SRS', -1, 'NONE', -1, 'undefined', NULL)")
+	conn.execute("INSERT OR IGNORE INTO gpkg_spatial_ref_sys VALUES ('Undefined geographic SRS', 0, 'NONE', 0, 'undefined', NULL)")
+	conn.execute("INSERT OR IGNORE INTO gpkg_spatial_ref_sys VALUES (?, ?, ?, ?, ?, NULL)", (str(srs[0]), srs[0], srs[1], srs[2], srs[3]))
+	conn.execute("CREATE TABLE IF NOT EXISTS gpkg_contents (table_name TEXT NOT NULL PRIMARY KEY, data_type TEXT NOT NULL, identifier TEXT UNIQUE, description TEXT DEFAULT '', last_change DATETIME NOT NULL DEFAULT (strftime('%Y-%m-%dT%H:%M:%fZ','now')), min_x DOUBLE, min_y DOUBLE, max_x DOUBLE, max_y DOUBLE, srs_id INTEGER)")
+	conn.execute("CREATE TABLE IF NOT EXISTS gpkg_geometry_columns (table_name TEXT NOT NULL, column_name TEXT NOT NULL, geometry_type_name TEXT NOT NULL, srs_id INTEGER NOT NULL, z TINYINT NOT NULL, m TINYINT NOT NULL, CONSTRAINT pk_geom_cols PRIMARY KEY (table_name, column_name))")
+	conn.execute("CREATE TABLE IF NOT EXISTS gpkg_extensions (table_name TEXT, column_name TEXT, extension_name TEXT NOT NULL, definition TEXT NOT NULL, scope TEXT NOT NULL, CONSTRAINT ge_tce UNIQUE (table_name, column_name, extension_name))")
+	conn.execute("CREATE TABLE \""+table+"\" (fid INTEGER PRIMARY KEY AUTOINCREMENT, geom "+geometryType+""+"".join([", \""+name+"\" "+sqlType for name, sqlType in columns])+")")
+	conn.execute("INSERT INTO gpkg_contents (table_name, data_type, identifier, srs_id) VALUES (?, 'features', ?, ?)", (table, table, srs[0]))
+	conn.execute("INSERT INTO gpkg_geometry_columns VALUES (?, 'geom', ?, ?, 0, 0)", (table, geometryType, srs[0]))
+
+def BuildSpatialIndex(conn, table):
+	"""Builds the R-tree spatial index of a table in one statement, with the triggers of the GeoPackage RTree extension."""
+	rtree = "rtree_"+table+"_geom"
+	conn.execute("CREATE VIRTUAL TABLE \""+rtree+"\" USING rtree(id, minx, maxx, miny, maxy)")
+	conn.execute("INSERT INTO \""+rtree+"\" SELECT fid, ST_MinX(geom), ST_MaxX(geom), ST_MinY(geom), ST_MaxY(geom) FROM \""+table+"\" WHERE geom NOT NULL AND NOT ST_IsEmpty(geom)")
+	conn.execute("INSERT INTO gpkg_extensions VALUES (?, 'geom', 'gpkg_rtree_index', 'http://www.geopackage.org/spec120/#extension_rtree', 'write-only')", (table,))
+	t, r = "\""+table+"\"", "\""+rtree+"\""
+	conn.execute("CREATE TRIGGER \""+rtree+"_insert\" AFTER INSERT ON "+t+" WHEN (new.geom NOT NULL AND NOT ST_IsEmpty(NEW.geom)) BEGIN INSERT OR REPLACE INTO "+r+" VALUES (NEW.fid, ST_MinX(NEW.geom), ST_MaxX(NEW.geom), ST_MinY(NEW.geom), ST_MaxY(NEW.geom)); END")
+	conn.execute("CREATE TRIGGER \""+rtree+"_update1\" AFTER UPDATE OF geom ON "+t+" WHEN OLD.fid = NEW.fid AND (NEW.geom NOTNULL AND NOT ST_IsEmpty(NEW.geom)) BEGIN INSERT OR REPLACE INTO "+r+" VALUES (NEW.fid, ST_MinX(NEW.geom), ST_MaxX(NEW.geom), ST_MinY(NEW.geom), ST_MaxY(NEW.geom)); END")
+	conn.execute("CREATE TRIGGER \""+rtree+"_update2\" AFTER UPDATE OF geom ON "+t+" WHEN OLD.fid = NEW.fid AND (NEW.geom ISNULL OR ST_IsEmpty(NEW.geom)) BEGIN DELETE FROM "+r+" WHERE id = OLD.fid; END")
+	conn.execute("CREATE TRIGGER \""+rtree+"_update3\" AFTER UPDATE ON "+t+" WHEN OLD.fid != NEW.fid AND (NEW.geom NOTNULL AND NOT ST_IsEmpty(NEW.geom)) BEGIN DELETE FROM "+r+" WHERE id = OLD.fid; INSERT OR REPLACE INTO "+r+" VALUES (NEW.fid, ST_MinX(NEW.geom), ST_MaxX(NEW.geom), ST_MinY(NEW.geom), ST_MaxY(NEW.geom)); END")
+	conn.execute("CREATE TRIGGER \""+rtree+"_update4\" AFTER UPDATE ON "+t+" WHEN OLD.fid != NEW.fid AND (NEW.geom ISNULL OR ST_IsEmpty(NEW.geom)) BEGIN DELETE FROM "+r+" WHERE id IN (OLD.fid, NEW.fid); END")
+	conn.execute("CREATE TRIGGER \""+rtree+"_delete\" AFTER DELETE ON "+t+" WHEN old.geom NOT NULL BEGIN DELETE FROM "+r+" WHERE id = OLD.fid; END")
+
+	# Extent of the table
+	extent = conn.execute("SELECT MIN(minx), MIN(miny), MAX(maxx), MAX(maxy) FROM \""+rtree+"\"").fetchone()
+	conn.execute("UPDATE gpkg_contents SET min_x=?, min_y=?, max_x=?, max_y=? WHERE table_name=?", tuple(extent)+(table,))
+
+def ArcpySrs(spatialReference):
+	"""GeoPackage spatial reference record of an arcpy SpatialReference."""
+	if(spatialReference == None or spatialReference.name == "Unknown"):
+		return (-1, "NONE", -1, "undefined")
+	code = int(spatialReference.factoryCode)
+	if(code > 0):
+		return (code, "EPSG", code, spatialReference.exportToString().split(";")[0])
+	return (100000, "NONE", 100000, spatialReference.exportToString().split(";")[0])
+
+def ArcpyColumns(fc):
+	"""Columns [(name, SQL type)] of the attribute fields of an arcpy feature class."""
+	import arcpy
+	types = {"SmallInteger":"INTEGER", "Integer":"INTEGER", "Single":"REAL", "Double":"DOUBLE", "String":"TEXT", "Date":"DATETIME"}
+	return [(field.name, types[field.type]) for field in arcpy.ListFields(fc) if field.type in types]
+
+def ReadFeatures(fc):
+	"""Reads the features of an arcpy feature class (the output of one line) as a dict that can be sent
+	to the parent process: geometry type, columns [(name, SQL type)], spatial reference record, extent
+	(minx, maxx, miny, maxy) and rows of GeoPackage geometry followed by the attribute values.
+	Returns None if fc has no features."""
+	import arcpy
+	columns = ArcpyColumns(fc)
+	srs = ArcpySrs(arcpy.Describe(fc).spatialReference)
+	rows = []
+	geometryType = None
+	extent = None
+	cursor = arcpy.da.SearchCursor(fc, ["SHAPE@WKB"]+[name for name, sqlType in columns])
+	for row in cursor:
+		if(row[0] == None):
+			continue
+		wkb, code, envelope = MultiWkb(row[0])
+		if(geometryType == None):
+			geometryType = geometryNames.get(code, "GEOMETRY")
+		if(envelope != None):
+			extent = envelope if extent == None else (min(extent[0], envelope[0]), max(extent[1], envelope[1]), min(extent[2], envelope[2]), max(extent[3], envelope[3]))
+		rows.append((GeometryBlob(wkb, srs[0], envelope),)+tuple(row[1:]))
+	del cursor
+	if(len(rows) == 0):
+		return None
+	return {"geometry":geometryType, "columns":columns, "srs":srs, "extent":extent, "rows":rows}
+
+def StoreFeatures(features, scratchPath):
+	"""Appends features read by ReadFeatures to the scratch GeoPackage of the worker in a single
+	transaction. The scratch GeoPackage is created with the columns of the features."""
+	conn = Connect(scratchPath)
+	conn.execute("BEGIN IMMEDIATE")
+	if(conn.execute("SELECT COUNT(*) FROM sqlite_master WHERE name=?", (scratchTable,)).fetchone()[0] == 0):
+		CreateGeoPackage(conn, scratchTable, features["geometry"], features["columns"], features["srs"])
+	conn.executemany(InsertStatement(scratchTable, features["columns"]), features["rows"])
+	conn.execute("COMMIT")
+	conn.close()
+	return len(features["rows"])
+
+def InsertStatement(table, columns):
+	names = ",".join(["geom"]+["\""+name+"\"" for name, sqlType in columns])
+	return "INSERT INTO \""+table+"\" ("+names+") VALUES ("+",".join(["?"]*(len(columns)+1))+")"
+
+class ResultWriter:
+	"""Parent side: appends the features returned by the line tasks to a GeoPackage as the tasks
+	finish, passed to Add by FLM_Common.MapTasks. Features are written in batches of stream_batch
+	features, or after stream_interval seconds, each batch in one transaction, so the features of
+	the lines done so far can be viewed while the tool runs. The spatial index is built once when the
+	writer is closed, instead of being updated by triggers on each insert."""
+	def __init__(self, path, table = None):
+		self.path = path
+		self.table = table if table != None else TableName(path)
+		if(os.path.exists(path)):
+			os.remove(path)
+		self.conn = Connect(path)
+		self.conn.execute("PRAGMA synchronous = OFF")
+		self.columns = None
+		self.pending = []
+		self.pendingRows = 0
+		self.extent = None
+		self.count = 0
+		self.batch = flmc.GetSetting("stream_batch", 1000)
+		self.interval = flmc.GetSetting("stream_interval", 10.0)
+		self.flushed = time.time()
+
+	def Create(self, geometryType, columns, srs):
+		self.conn.execute("BEGIN")
+		CreateGeoPackage(self.conn, self.table, geometryType, columns, srs)
+		self.conn.execute("COMMIT")
+		self.columns = columns
+
+	def Add(self, features):
+		"""Adds the features of a line (see TakeOutput). Returns their number."""
+		if(features == None):
+			return 0
+		if(self.columns == None):
+			self.Create(features["geometry"], features["columns"], features["srs"])
+		self.pending.append((InsertStatement(self.table, features["columns"]), features["rows"]))
+		self.pendingRows += len(features["rows"])
+		extent = features["extent"]
+		if(extent != None):
+			self.extent = extent if self.extent == None else (min(self.extent[0], extent[0]), max(self.extent[1], extent[1]), min(self.extent[2], extent[2]), max(self.extent[3], extent[3]))
+		if(self.pendingRows >= self.batch or time.time()-self.flushed >= self.interval):
+			self.Flush()
+		return len(features["rows"])
+
+	def Flush(self):
+		self.flushed = time.time()
+		if(len(self.pending) == 0):
+			return
+		self.conn.execute("BEGIN")
+		for statement, rows in self.pending:
+			self.conn.executemany(statement, rows)
+		if(self.extent != None):
+			self.conn.execute("UPDATE gpkg_contents SET min_x=?, min_y=?, max_x=?, max_y=? WHERE table_name=?", (self.extent[0], self.extent[2], self.extent[1], self.extent[3], self.table))
+		self.conn.execute("COMMIT")
+		self.count += self.pendingRows
+		self.pending = []
+		self.pendingRows = 0
+
+	def Close(self, scratchFiles = []):
+		"""Writes the remaining features and copies the features of the scratch GeoPackages written by
+		work queue workers, which do not return their features, then deletes the scratch files and
+		builds the spatial index. Returns the number of features."""
+		self.Flush()
+		conn = self.conn
+		for scratch in scratchFiles:
+			conn.execute("ATTACH DATABASE ? AS scratch", (scratch,))
+			if(conn.execute("SELECT COUNT(*) FROM scratch.sqlite_master WHERE name=?", (scratchTable,)).fetchone()[0] > 0):
+				columns = [(row[1], row[2]) for row in conn.execute("PRAGMA scratch.table_info(\""+scratchTable+"\")") if row[1] not in ["fid", "geom"]]
+				if(self.columns == None):
+					# Output table with the fields and spatial reference of the first scratch GeoPackage
+					geometryType, srsId = conn.execute("SELECT geometry_type_name, srs_id FROM scratch.gpkg_geometry_columns WHERE table_name=?", (scratchTable,)).fetchone()
+					srs = conn.execute("SELECT srs_id, organization, organization_coordsys_id, definition FROM scratch.gpkg_spatial_ref_sys WHERE srs_id=?", (srsId,)).fetchone()
+					self.Create(geometryType, columns, srs)
+				names = ",".join(["geom"]+["\""+name+"\"" for name, sqlType in columns])
+				conn.execute("BEGIN")
+				conn.execute("INSERT INTO main.\""+self.table+"\" ("+names+") SELECT "+names+" FROM scratch.\""+scratchTable+"\"")
+				conn.execute("COMMIT")
+			conn.execute("DETACH DATABASE scratch")
+		if(self.columns != None):
+			self.count = conn.execute("SELECT COUNT(*) FROM \""+self.table+"\"").fetchone()[0]
+			conn.execute("BEGIN")
+			BuildSpatialIndex(conn, self.table)
+			conn.execute("COMMIT")
+		conn.close()
+		for scratch in scratchFiles:
+			os.remove(scratch)
+		return self.count
+
+def TakeOutput(fc, output, outWorkspace, toolCodename):
+	"""Worker side: returns the features of the result of one line (fc) when the tool uses GeoPackages
+	and deletes fc. The work function returns them to the parent, which writes them with a ResultWriter.
+	Work queue workers store them in their scratch GeoPackage instead and return None.
+	Returns None if the tool does not use GeoPackages or the line produced no result."""
+	import arcpy
+	if(UseGeoPackage(output) == False or arcpy.Exists(fc) == False):
+		return None
+	features = ReadFeatures(fc)
+	arcpy.Delete_management(fc)
+	if(features != None and flmc.GetSetting("executor", "pool") == "queue"):
+		StoreFeatures(features, ScratchPath(outWorkspace, toolCodename))
+		return None
+	return features
+
+def OpenOutput(outWorkspace, toolCodename, output):
+	"""Parent side: ResultWriter of the features of a tool, writing directly to output when it is a
+	GeoPackage, otherwise to a merge GeoPackage copied to the output by CloseOutput."""
+	if(IsGeoPackage(output)):
+		return ResultWriter(output)
+	return ResultWriter(os.path.join(outWorkspace, "FLM_"+toolCodename+"_Merge.gpkg"), "merge")
+
+def CloseOutput(writer, outWorkspace, toolCodename, output):
+	"""Parent side: closes the ResultWriter opened by OpenOutput and copies its features to the output
+	if the output is not a GeoPackage."""
+	count = writer.Close(ScratchFiles(outWorkspace, toolCodename))
+	if(writer.path != output):
+		import arcpy
+		if(writer.columns != None):
+			arcpy.CopyFeatures_management(ArcpyTable(writer.path, writer.table), output)
+		os.remove(writer.path)
+	flmc.log(str(count)+" features written to "+output+".")
+	return count
+
+def AddColumn(path, name, sqlType, value = None, table = None):
+	"""Adds a column to the table of a GeoPackage, with the same value in all rows."""
+	if(table == None):
+		table = TableName(path)
+	conn = Connect(path)
+	conn.execute("ALTER TABLE \""+table+"\" ADD COLUMN \""+name+"\" "+sqlType)
+	if(value != None):
+		conn.execute("UPDATE \""+table+"\" SET \""+name+"\"=?", (value,))
+	conn.close()
+
+def HasColumn(path, name, table = None):
+	if(table == None):
+		table = TableName(path)
+	conn = Connect(path)
+	names = [row[1] for row in conn.execute("PRAGMA table_info(\""+table+"\")")]
+	conn.close()
+	return name in names
@@ -27,30 +27,38 @@
 #
 # ---------------------------------------------------------------------------
 
-import multiprocessing
 import arcpy
 from arcpy.sa import *
-arcpy.CheckOutExtension("Spatial")
 from . import FLM_Common as flmc
+from . import FLM_LineTable as flmlt
+from . import FLM_RasterCache as flmrc
+from . import FLM_GeoPackage as flmg
 
 # Setup script path and workspace folder
 workspaceName = "FLM_LFP_output"
 outWorkspace = flmc.GetWorkspace(workspaceName)
-arcpy.env.workspace = outWorkspace
-arcpy.env.overwriteOutput = True
-
-# Load arguments from file
-args = flmc.GetArgs("FLM_LFP_params.txt")
-
-# Tool arguments
-Centerline_Feature_Class = args[0].rstrip()
-Canopy_Raster = args[1].rstrip()
-Cost_Raster = args[2].rstrip()
-Corridor_Threshold_Field = args[3].rstrip()
-Maximum_distance_from_centerline = float(args[4].rstrip())  / 2.0
-Expand_And_Shrink_Cell_Range = args[5].rstrip()
-ProcessSegments = args[6].rstrip()=="True"
-Output_Footprint = args[7].rstrip()
+
+def LoadArgs():
+	"""Loads the tool arguments from the parameter file. Arguments are not loaded when the
+	module is imported, they are loaded when the tool runs and once in each worker process."""
+	global Centerline_Feature_Class, Canopy_Raster, Cost_Raster, Corridor_Threshold_Field, Maximum_distance_from_centerline, Expand_And_Shrink_Cell_Range, ProcessSegments, ShareVertexCostDistance, Output_Footprint
+	arcpy.CheckOutExtension("Spatial")
+	arcpy.env.workspace = outWorkspace
+	arcpy.env.overwriteOutput = True
+
+	# Load arguments from file
+	args = flmc.GetArgs("FLM_LFP_params.txt")
+
+	# Tool arguments
+	Centerline_Feature_Class = args[0].rstrip()
+	Canopy_Raster = flmrc.CachedRaster(args[1].rstrip())
+	Cost_Raster = flmrc.CachedRaster(args[2].rstrip())
+	Corridor_Threshold_Field = args[3].rstrip()
+	Maximum_distance_from_centerline = float(args[4].rstrip())  / 2.0
+	Expand_And_Shrink_Cell_Range = args[5].rstrip()
+	ProcessSegments = args[6].rstrip()=="True"
+	ShareVertexCostDistance = args[7].rstrip()=="True"
+	Output_Footprint = args[8].rstrip()
 
 def PathFile(path):
 	return path[path.rfind("\\")+1:]
@@ -73,28 +81,15 @@ def workLines(lineNo):
 	fileNull = outWorkspace+"\\FLM_LFP_Null_" + str(lineNo) +".tif"
 	fileFootprint = outWorkspace +"\\FLM_LFP_Footprint_" + str(lineNo) +".shp"
 	
-	# Load segment list
-	segment_list = []
-	rows = arcpy.SearchCursor(fileSeg)
-	shapeField = arcpy.Describe(fileSeg).ShapeFieldName
-	for row in rows:
-		feat = row.getValue(shapeField)   #creates a geometry object
-		Corridor_Threshold = float(row.getValue(Corridor_Threshold_Field))
-		segmentnum = 0
-		for segment in feat: #loops through every segment in a line
-			#loops through every vertex of every segment
-			for pnt in feat.getPart(segmentnum):                 #get.PArt returns an array of points for a particular part in the geometry
-				if pnt:                  #adds all the vertices to segment_list, which creates an array
-					segment_list.append(arcpy.Point(float(pnt.X), float(pnt.Y)))
-
-			segmentnum += 1
-	del rows
+	# Vertices of the line, from the line table written by SplitLines
+	vertices = flmlt.TaskVertices(outWorkspace, "LFP", lineNo)
+	Corridor_Threshold = float(flmlt.TaskValue(outWorkspace, "LFP", lineNo, Corridor_Threshold_Field))
 
 	# Find origin and destination coordinates
-	x1 = segment_list[0].X
-	y1 = segment_list[0].Y
-	x2 = segment_list[-1].X
-	y2 = segment_list[-1].Y
+	x1 = vertices[0][0]
+	y1 = vertices[0][1]
+	x2 = vertices[-1][0]
+	y2 = vertices[-1][1]
 
 	# Create origin feature class
 	arcpy.CreateFeatureclass_management(outWorkspace,PathFile(fileOrigin),"POINT",Centerline_Feature_Class,"DISABLED","DISABLED",Centerline_Feature_Class)
@@ -111,32 +106,153 @@ def workLines(lineNo):
 	del cursor
 	
 	# Buffer around line
-	arcpy.Buffer_analysis(fileSeg, fileBuffer, Maximum_distance_from_centerline, "FULL", "ROUND", "NONE", "", "PLANAR")
+	arcpy.Buffer_analysis(fileSeg, fileBuffer, flmc.RetryDistance(Maximum_distance_from_centerline), "FULL", "ROUND", "NONE", "", "PLANAR")
 
 	# Clip cost raster using buffer
 	DescBuffer = arcpy.Describe(fileBuffer)
 	SearchBox = str(DescBuffer.extent.XMin)+" "+str(DescBuffer.extent.YMin)+" "+str(DescBuffer.extent.XMax)+" "+str(DescBuffer.extent.YMax)
-	arcpy.Clip_management(Cost_Raster, SearchBox, fileClip, fileBuffer, "", "ClippingGeometry", "NO_MAINTAIN_EXTENT")
+	arcpy.Clip_management(flmc.TileSource(Cost_Raster, outWorkspace, "LFP", lineNo, Maximum_distance_from_centerline), SearchBox, fileClip, fileBuffer, "", "ClippingGeometry", "NO_MAINTAIN_EXTENT")
 
-	# Process: Cost Distance
-	arcpy.gp.CostDistance_sa(fileOrigin, fileClip, fileCostDa, "", "", "", "", "", "", "TO_SOURCE")
-	arcpy.gp.CostDistance_sa(fileDestination, fileClip, fileCostDb, "", "", "", "", "", "", "TO_SOURCE")
-	
-	# Process: Corridor
-	arcpy.gp.Corridor_sa(fileCostDa, fileCostDb, fileCorridor)
-	
-	# Calculate minimum value of corridor raster
-	RasterCorridor = arcpy.Raster(fileCorridor)
+	# In pyramid mode the band around the coarse path is searched first, then the whole clip if the ends are not connected in it
+	rasters = flmc.PyramidRasters(fileClip, fileOrigin, fileDestination, outWorkspace, "LFP", lineNo)
+	for fileSearch in rasters:
+		# Process: Cost Distance
+		arcpy.gp.CostDistance_sa(fileOrigin, fileSearch, fileCostDa, "", "", "", "", "", "", "TO_SOURCE")
+		arcpy.gp.CostDistance_sa(fileDestination, fileSearch, fileCostDb, "", "", "", "", "", "", "TO_SOURCE")
+		
+		# Process: Corridor
+		arcpy.gp.Corridor_sa(fileCostDa, fileCostDb, fileCorridor)
+		
+		# Calculate minimum value of corridor raster
+		RasterCorridor = arcpy.Raster(fileCorridor)
+		if(RasterCorridor.minimum != None):
+			break
 	CorrMin = float(RasterCorridor.minimum)
+	for fileSearch in rasters[:-1]:
+		arcpy.Delete_management(fileSearch)
 	
 	# Set minimum as zero and save minimum file
 	RasterCorridor = ( (RasterCorridor-CorrMin) > Corridor_Threshold)
 	RasterCorridor.save(fileCorridorMin)
+	del RasterCorridor
+	
+	# Process: Footprint polygons from corridor
+	features = workFootprint(lineNo)
+	
+	#Clean temporary files
+	arcpy.Delete_management(fileSeg)
+	arcpy.Delete_management(fileOrigin)
+	arcpy.Delete_management(fileDestination)
+	arcpy.Delete_management(fileBuffer)
+	arcpy.Delete_management(fileClip)
+	arcpy.Delete_management(fileCostDa)
+	arcpy.Delete_management(fileCostDb)
+	arcpy.Delete_management(fileCorridor)
+	arcpy.Delete_management(fileCorridorMin)
+	return features
+
+def workLinesShared(lineNo):
+	"""Processes every segment of a line in a single task. The cost distance from each
+	vertex is calculated once over the area of the whole line and reused by the corridors
+	of both segments that share the vertex."""
+	#Temporary files
+	fileSeg = outWorkspace +"\\FLM_LFP_Segment_" + str(lineNo) +".shp"
+	fileBuffer = outWorkspace +"\\FLM_LFP_Buffer_" + str(lineNo) +".shp"
+	fileClip = outWorkspace+"\\FLM_LFP_Clip_" + str(lineNo) +".tif"
+	fileCorridorMin = outWorkspace+"\\FLM_LFP_CorridorMin_" + str(lineNo) +".tif"
+	tempFiles = [fileSeg, fileBuffer, fileClip]
+	
+	# Vertices of the line, from the line table written by SplitLines
+	vertices = flmlt.TaskVertices(outWorkspace, "LFP", lineNo)
+	Corridor_Threshold = float(flmlt.TaskValue(outWorkspace, "LFP", lineNo, Corridor_Threshold_Field))
+	spatialReference = arcpy.Describe(fileSeg).spatialReference
+	
+	# Buffer around the whole line, which is the union of the areas of its segments
+	arcpy.Buffer_analysis(fileSeg, fileBuffer, flmc.RetryDistance(Maximum_distance_from_centerline), "FULL", "ROUND", "NONE", "", "PLANAR")
+
+	# Clip cost raster using buffer
+	DescBuffer = arcpy.Describe(fileBuffer)
+	SearchBox = str(DescBuffer.extent.XMin)+" "+str(DescBuffer.extent.YMin)+" "+str(DescBuffer.extent.XMax)+" "+str(DescBuffer.extent.YMax)
+	arcpy.Clip_management(flmc.TileSource(Cost_Raster, outWorkspace, "LFP", lineNo, Maximum_distance_from_centerline), SearchBox, fileClip, fileBuffer, "", "ClippingGeometry", "NO_MAINTAIN_EXTENT")
+	
+	# Process: Cost Distance, once for each vertex
+	fileCostD = []
+	for vertexID in range(0, len(vertices)):
+		fileVertex = outWorkspace +"\\FLM_LFP_Vertex_" + str(lineNo) +"_"+ str(vertexID) +".shp"
+		fileCostD.append(outWorkspace+"\\FLM_LFP_CostD_" + str(lineNo) +"_"+ str(vertexID) +".tif")
+		arcpy.CreateFeatureclass_management(outWorkspace,PathFile(fileVertex),"POINT",Centerline_Feature_Class,"DISABLED","DISABLED",Centerline_Feature_Class)
+		cursor = arcpy.da.InsertCursor(fileVertex, ["SHAPE@XY"])
+		xy = (float(vertices[vertexID][0]),float(vertices[vertexID][1]))
+		cursor.insertRow([xy])
+		del cursor
+		arcpy.gp.CostDistance_sa(fileVertex, fileClip, fileCostD[-1], "", "", "", "", "", "", "TO_SOURCE")
+		tempFiles += [fileVertex, fileCostD[-1]]
+	
+	# Process: Corridor of each segment, from the cost distances of its two vertices
+	fileSegmentCorridors = []
+	for vertexID in range(0, len(vertices)-1):
+		suffix = str(lineNo) +"_"+ str(vertexID)
+		fileLeg = outWorkspace +"\\FLM_LFP_Leg_" + suffix +".shp"
+		fileLegBuffer = outWorkspace +"\\FLM_LFP_LegBuffer_" + suffix +".shp"
+		fileLegCorridor = outWorkspace+"\\FLM_LFP_LegCorridor_" + suffix +".tif"
+		fileLegMask = outWorkspace+"\\FLM_LFP_LegMask_" + suffix +".tif"
+		fileLegMin = outWorkspace+"\\FLM_LFP_LegMin_" + suffix +".tif"
+		tempFiles += [fileLeg, fileLegBuffer, fileLegCorridor, fileLegMask, fileLegMin]
+		
+		# Buffer around segment, so each corridor keeps the extent it has when processed on its own
+		arcpy.CreateFeatureclass_management(outWorkspace,PathFile(fileLeg),"POLYLINE","","DISABLED","DISABLED",Centerline_Feature_Class)
+		cursor = arcpy.da.InsertCursor(fileLeg, ["SHAPE@"])
+		cursor.insertRow([flmlt.Polyline([vertices[vertexID:vertexID+2]], spatialReference)])
+		del cursor
+		arcpy.Buffer_analysis(fileLeg, fileLegBuffer, flmc.RetryDistance(Maximum_distance_from_centerline), "FULL", "ROUND", "NONE", "", "PLANAR")
+		
+		arcpy.gp.Corridor_sa(fileCostD[vertexID], fileCostD[vertexID+1], fileLegCorridor)
+		RasterCorridor = ExtractByMask(fileLegCorridor, fileLegBuffer)
+		RasterCorridor.save(fileLegMask)
+		
+		# Calculate minimum value of corridor raster
+		RasterCorridor = arcpy.Raster(fileLegMask)
+		CorrMin = float(RasterCorridor.minimum)
+		
+		# Set minimum as zero and save minimum file
+		RasterCorridor = ( (RasterCorridor-CorrMin) > Corridor_Threshold)
+		RasterCorridor.save(fileLegMin)
+		del RasterCorridor
+		fileSegmentCorridors.append(fileLegMin)
+	
+	# Line corridor is the union of the segment corridors (zero is inside a corridor)
+	# The union extent is set only for this step, later steps and tasks of the worker use the default
+	saved = arcpy.env.extent
+	arcpy.env.extent = "MAXOF"
+	try:
+		arcpy.gp.CellStatistics_sa(fileSegmentCorridors, fileCorridorMin, "MINIMUM", "DATA")
+	finally:
+		arcpy.env.extent = saved
+	tempFiles.append(fileCorridorMin)
+	
+	# Process: Footprint polygons from corridor
+	features = workFootprint(lineNo)
+	
+	#Clean temporary files
+	for tempFile in tempFiles:
+		arcpy.Delete_management(tempFile)
+	return features
+
+def workFootprint(lineNo):
+	"""Creates footprint polygons from the thresholded corridor raster of a line."""
+	#Temporary files
+	fileCorridorMin = outWorkspace+"\\FLM_LFP_CorridorMin_" + str(lineNo) +".tif"
+	fileThreshold = outWorkspace+"\\FLM_LFP_Threshold_" + str(lineNo) +".tif"
+	fileExpand = outWorkspace+"\\FLM_LFP_Expand_" + str(lineNo) +".tif"
+	fileShrink = outWorkspace+"\\FLM_LFP_Shrink_" + str(lineNo) +".tif"
+	fileClean = outWorkspace+"\\FLM_LFP_Clean_" + str(lineNo) +".tif"
+	fileNull = outWorkspace+"\\FLM_LFP_Null_" + str(lineNo) +".tif"
+	fileFootprint = outWorkspace +"\\FLM_LFP_Footprint_" + str(lineNo) +".shp"
 	
 	# Process: Stamp CC and Max Line Width
-	RasterClass = SetNull(IsNull(Raster(fileCorridorMin)),(Raster(fileCorridorMin)+(Raster(Canopy_Raster)>=1))>0)
+	RasterClass = SetNull(IsNull(Raster(fileCorridorMin)),(Raster(fileCorridorMin)+(flmc.OpenTileSource(Canopy_Raster, outWorkspace, "LFP", lineNo, Maximum_distance_from_centerline)>=1))>0)
 	RasterClass.save(fileThreshold)
-	del RasterCorridor, RasterClass
+	del RasterClass
 	
 	if(int(Expand_And_Shrink_Cell_Range)>0):
 		# Process: Expand
@@ -155,22 +271,15 @@ def workLines(lineNo):
 	
 	# Process: Raster to Polygon
 	arcpy.RasterToPolygon_conversion(fileNull, fileFootprint, "SIMPLIFY", "VALUE", "SINGLE_OUTER_PART", "")
+	features = flmg.TakeOutput(fileFootprint, Output_Footprint, outWorkspace, "LFP")
 	
 	#Clean temporary files
-	arcpy.Delete_management(fileSeg)
-	arcpy.Delete_management(fileOrigin)
-	arcpy.Delete_management(fileDestination)
-	arcpy.Delete_management(fileBuffer)
-	arcpy.Delete_management(fileClip)
-	arcpy.Delete_management(fileCostDa)
-	arcpy.Delete_management(fileCostDb)
 	arcpy.Delete_management(fileThreshold)
-	arcpy.Delete_management(fileCorridor)
-	arcpy.Delete_management(fileCorridorMin)
 	arcpy.Delete_management(fileExpand)
 	arcpy.Delete_management(fileShrink)
 	arcpy.Delete_management(fileClean)
 	arcpy.Delete_management(fileNull)
+	return features
 
 def HasField(fc, fi):
   fieldnames = [field.name for field in arcpy.ListFields(fc)]
@@ -180,6 +289,7 @@ def HasField(fc, fi):
     return False
 	
 def main():
+	LoadArgs()
 	global outWorkspace
 	outWorkspace = flmc.SetupWorkspace(workspaceName)
 
@@ -188,23 +298,41 @@ def main():
 		return False
 
 	# Prepare input lines for multiprocessing
-	numLines = flmc.SplitLines(Centerline_Feature_Class, outWorkspace, "LFP", ProcessSegments, Corridor_Threshold_Field)
+	if(ProcessSegments and ShareVertexCostDistance):
+		# One task per line, segments are processed inside the task sharing vertex cost distances
+		numLines = flmc.SplitLines(Centerline_Feature_Class, outWorkspace, "LFP", False, Corridor_Threshold_Field)
+		workFunction = workLinesShared
+	else:
+		numLines = flmc.SplitLines(Centerline_Feature_Class, outWorkspace, "LFP", ProcessSegments, Corridor_Threshold_Field)
+		workFunction = workLines
+	
+	# Footprints are written to a GeoPackage as the lines finish
+	writer = flmg.ResultWriter(outWorkspace +"\\FLM_LFP_Merge.gpkg", "merge") if flmg.UseGeoPackage(Output_Footprint) else None
 	
-	pool = multiprocessing.Pool(processes=flmc.GetCores())
 	flmc.log("Multiprocessing line corridors...")
-	pool.map(workLines, range(1,numLines+1))
-	pool.close()
-	pool.join()
+	flmc.MapTasks(workFunction, range(1,numLines+1), flmc.LineTaskMemory(numLines, Maximum_distance_from_centerline, Cost_Raster), writer.Add if writer != None else None, flmc.LineTiles(outWorkspace, "LFP"))
+	flmc.RemoveTiles(outWorkspace, "LFP")
 	flmc.logStep("Corridor multiprocessing")
+	flmc.ReportFailures(Centerline_Feature_Class, outWorkspace, "LFP", Output_Footprint, ["Origin", "Destination", "Buffer", "Clip", "CostDa", "CostDb", "Corridor", "CorridorMin", "Threshold", "Expand", "Shrink", "Clean", "Null", "Footprint"])
 	
 	flmc.log("Merging footprint layers...")
-	tempShapefiles = arcpy.ListFeatureClasses()
-	fileMerge = outWorkspace +"\\FLM_LFP_Merge.shp"
-	arcpy.Merge_management(tempShapefiles,fileMerge)
-	arcpy.Dissolve_management(fileMerge,Output_Footprint)
-	for shp in tempShapefiles:
-		arcpy.Delete_management(shp)
-	arcpy.Delete_management(fileMerge)
+	if(writer != None):
+		# Footprints were written to one GeoPackage as the lines finished and are dissolved from there
+		with flmc.Span("Merge"):
+			writer.Close(flmg.ScratchFiles(outWorkspace, "LFP"))
+		with flmc.Span("Dissolve"):
+			arcpy.Dissolve_management(flmg.ArcpyTable(writer.path, writer.table),flmg.OutputTable(Output_Footprint))
+		arcpy.Delete_management(writer.path)
+	else:
+		tempShapefiles = arcpy.ListFeatureClasses()
+		fileMerge = outWorkspace +"\\FLM_LFP_Merge.shp"
+		with flmc.Span("Merge"):
+			arcpy.Merge_management(tempShapefiles,fileMerge)
+		with flmc.Span("Dissolve"):
+			arcpy.Dissolve_management(fileMerge,Output_Footprint)
+		for shp in tempShapefiles:
+			arcpy.Delete_management(shp)
+		arcpy.Delete_management(fileMerge)
 	flmc.logStep("Merging")
 	
 if __name__ == '__main__':
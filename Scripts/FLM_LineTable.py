@@ -0,0 +1,245 @@
+#
+#    Copyright (C) 2020  Applied Geospatial Research Group
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, version 3.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <https://gnu.org/licenses/gpl-3.0>.
+#
+# ---------------------------------------------------------------------------
+#
+# FLM_LineTable.py
+# Script Author: Gustavo Lopes Queiroz
+# Date: 2020-Jan-22
+#
+# This script is part of the Forest Line Mapper (FLM) toolset
+# Webpage: https://github.com/appliedgrg/flm
+#
+# Purpose: Columnar table of polylines used by the FLM tools instead of lists
+# of arcpy.Point objects. The vertices of all lines are held in one float64
+# array of x, y coordinates, with arrays of offsets giving the first vertex
+# of each part and the first part of each line, the bounding box of each
+# line and one typed array for each attribute field. Lines are read from
+# feature classes through their WKB, without one Python object per vertex.
+# SplitLines saves the table of the line tasks to the scratch workspace and
+# worker processes memory map it, so the vertices of a task are a slice of
+# the arrays shared through the operating system page cache.
+#
+# ---------------------------------------------------------------------------
+
+import os, struct
+import numpy as np
+
+class LineTable:
+	"""Polylines in columns. coords: (vertices, 2) float64 array. partOffsets: index in coords of
+	the first vertex of each part, followed by the number of vertices. lineOffsets: index in
+	partOffsets of the first part of each line, followed by the number of parts. columns: dict
+	of attribute arrays with one value for each line."""
+	def __init__(self, coords, partOffsets, lineOffsets, columns = None, bounds = None):
+		self.coords = coords
+		self.partOffsets = partOffsets
+		self.lineOffsets = lineOffsets
+		self.columns = columns if columns != None else {}
+		self.bounds = bounds if bounds is not None else Bounds(coords, partOffsets, lineOffsets)
+
+	def __len__(self):
+		return len(self.lineOffsets)-1
+
+	def Vertices(self, line):
+		"""Vertices of all parts of a line, as a view of the coordinate array."""
+		return self.coords[self.partOffsets[self.lineOffsets[line]]:self.partOffsets[self.lineOffsets[line+1]]]
+
+	def Parts(self, line):
+		return [self.coords[self.partOffsets[p]:self.partOffsets[p+1]] for p in range(self.lineOffsets[line], self.lineOffsets[line+1])]
+
+	def Value(self, line, field):
+		"""Attribute value of a line as a Python value, None for missing numbers."""
+		value = self.columns[field][line].item()
+		return None if value != value else value
+
+	def Values(self, line, fields):
+		return [self.Value(line, field) for field in fields]
+
+	def Save(self, folder):
+		"""Saves the table as one .npy file for each array, which Load can memory map."""
+		if(os.path.isdir(folder) == False):
+			os.makedirs(folder)
+		for name in os.listdir(folder):
+			os.remove(os.path.join(folder, name))
+		np.save(os.path.join(folder, "coords.npy"), self.coords)
+		np.save(os.path.join(folder, "parts.npy"), self.partOffsets)
+		np.save(os.path.join(folder, "lines.npy"), self.lineOffsets)
+		np.save(os.path.join(folder, "bounds.npy"), self.bounds)
+		for i, field in enumerate(self.columns):
+			np.save(os.path.join(folder, "column_"+str(i)+".npy"), self.columns[field])
+		with open(os.path.join(folder, "columns.txt"), "w") as names:
+			names.write("\n".join(self.columns))
+
+def Load(folder, mmap = True):
+	"""Loads a table saved with LineTable.Save, memory mapped in read only mode by default."""
+	mode = "r" if mmap else None
+	arrays = [np.load(os.path.join(folder, name+".npy"), mmap_mode=mode) for name in ["coords", "parts", "lines", "bounds"]]
+	with open(os.path.join(folder, "columns.txt")) as names:
+		fields = [name for name in names.read().split("\n") if name != ""]
+	columns = dict([(field, np.load(os.path.join(folder, "column_"+str(i)+".npy"), mmap_mode=mode)) for i, field in enumerate(fields)])
+	return LineTable(arrays[0], arrays[1], arrays[2], columns, arrays[3])
+
+def Bounds(coords, partOffsets, lineOffsets):
+	"""Bounding box (xMin, yMin, xMax, yMax) of each line."""
+	lines = len(lineOffsets)-1
+	bounds = np.full((lines, 4), np.nan)
+	starts = partOffsets[lineOffsets[:-1]]
+	ends = partOffsets[lineOffsets[1:]]
+	valid = ends > starts
+	if(valid.any()):
+		# Lines without vertices add no range, so each range of reduceat is the range of a line
+		bounds[valid, 0:2] = np.minimum.reduceat(coords, starts[valid], axis=0)
+		bounds[valid, 2:4] = np.maximum.reduceat(coords, starts[valid], axis=0)
+	return bounds
+
+def ReadWkbParts(wkb, offset, parts):
+	"""Appends the (vertices, 2) coordinate arrays of the line parts of a WKB geometry to parts
+	and returns the offset after the geometry. Z and M values are dropped."""
+	order = "<" if wkb[offset:offset+1] == b"\x01" else ">"
+	code = struct.unpack_from(order+"I", wkb, offset+1)[0]
+	offset += 5
+	dims = 2+(1 if code & 0x80000000 else 0)+(1 if code & 0x40000000 else 0)
+	code = code & 0xffff
+	dims += {1:1, 2:1, 3:2}.get(code // 1000, 0)
+	base = code % 1000
+	count = struct.unpack_from(order+"I", wkb, offset)[0]
+	offset += 4
+	if(base == 2):
+		values = np.frombuffer(wkb, dtype=order+"f8", count=count*dims, offset=offset)
+		parts.append(values.reshape(count, dims)[:, 0:2])
+		return offset+8*count*dims
+	for g in range(0, count):
+		offset = ReadWkbParts(wkb, offset, parts)
+	return offset
+
+def FromParts(lineParts, columns = None):
+	"""Builds a table from a list with the list of (vertices, 2) part arrays of each line."""
+	partSizes = [len(part) for parts in lineParts for part in parts]
+	partOffsets = np.zeros(len(partSizes)+1, dtype=np.int64)
+	np.cumsum(partSizes, out=partOffsets[1:])
+	lineOffsets = np.zeros(len(lineParts)+1, dtype=np.int64)
+	np.cumsum([len(parts) for parts in lineParts], out=lineOffsets[1:])
+	allParts = [part for parts in lineParts for part in parts]
+	coords = np.ascontiguousarray(np.concatenate(allParts).astype(np.float64)) if len(allParts) > 0 else np.zeros((0, 2))
+	return LineTable(coords, partOffsets, lineOffsets, columns)
+
+def Column(values, fieldType):
+	"""Typed array of the values of an arcpy field. Missing numbers are NaN, missing text is empty."""
+	if(fieldType in ["SmallInteger", "Integer", "OID"] and None not in values):
+		return np.array(values, dtype=np.int64)
+	if(fieldType in ["SmallInteger", "Integer", "Single", "Double", "OID"]):
+		return np.array([np.nan if value == None else value for value in values], dtype=np.float64)
+	return np.array(["" if value == None else str(value) for value in values])
+
+def FromFeatureClass(fc, fields = []):
+	"""Reads the lines of a feature class and the given attribute fields."""
+	import arcpy
+	fieldTypes = dict([(field.name, field.type) for field in arcpy.ListFields(fc)])
+	lineParts = []
+	values = [[] for field in fields]
+	cursor = arcpy.da.SearchCursor(fc, ["SHAPE@WKB"]+list(fields))
+	for row in cursor:
+		parts = []
+		if(row[0] != None):
+			ReadWkbParts(bytes(row[0]), 0, parts)
+		lineParts.append(parts)
+		for i in range(0, len(fields)):
+			values[i].append(row[i+1])
+	del cursor
+	columns = dict([(field, Column(values[i], fieldTypes.get(field))) for i, field in enumerate(fields)])
+	return FromParts(lineParts, columns)
+
+def FromPolyline(feature):
+	"""(vertices, 2) array with the vertices of all parts of an arcpy geometry."""
+	parts = []
+	ReadWkbParts(bytes(feature.WKB), 0, parts)
+	if(len(parts) == 0):
+		return np.zeros((0, 2))
+	return np.concatenate(parts)
+
+def Split(table, segments):
+	"""Returns the table of line tasks: one line for each part of the input lines or, if segments is
+	True, one line for each pair of consecutive vertices. Attributes are copied from the input lines."""
+	parts = np.arange(len(table.partOffsets)-1)
+	partLine = np.repeat(np.arange(len(table)), np.diff(table.lineOffsets))
+	partSizes = np.diff(table.partOffsets)
+	# Parts with a single vertex do not make a line
+	parts, partLine, partSizes = parts[partSizes > 1], partLine[partSizes > 1], partSizes[partSizes > 1]
+	if(segments == False):
+		starts = table.partOffsets[parts]
+		index = np.concatenate([np.arange(s, s+n) for s, n in zip(starts, partSizes)]) if len(parts) > 0 else np.zeros(0, dtype=np.int64)
+		coords = table.coords[index]
+		partOffsets = np.zeros(len(parts)+1, dtype=np.int64)
+		np.cumsum(partSizes, out=partOffsets[1:])
+		taskLine = partLine
+	else:
+		segmentSizes = partSizes-1
+		firsts = np.concatenate([np.arange(s, s+n) for s, n in zip(table.partOffsets[parts], segmentSizes)]) if len(parts) > 0 else np.zeros(0, dtype=np.int64)
+		coords = np.empty((len(firsts)*2, 2))
+		coords[0::2] = table.coords[firsts]
+		coords[1::2] = table.coords[firsts+1]
+		partOffsets = np.arange(0, len(coords)+1, 2, dtype=np.int64)
+		taskLine = np.repeat(partLine, segmentSizes)
+	lineOffsets = np.arange(0, len(partOffsets), dtype=np.int64)
+	columns = dict([(field, table.columns[field][taskLine]) for field in table.columns])
+	return LineTable(coords, partOffsets, lineOffsets, columns)
+
+def LineWkb(parts):
+	"""WKB multi line string of a list of (vertices, 2) arrays."""
+	wkb = [b"\x01"+struct.pack("<II", 5, len(parts))]
+	for part in parts:
+		wkb.append(b"\x01"+struct.pack("<II", 2, len(part)))
+		wkb.append(np.ascontiguousarray(part, dtype="<f8").tobytes())
+	return b"".join(wkb)
+
+def Polyline(parts, spatialReference):
+	"""arcpy Polyline of a list of (vertices, 2) arrays."""
+	import arcpy
+	return arcpy.FromWKB(bytearray(LineWkb(parts)), spatialReference)
+
+def ReadFeatures(fc):
+	"""Vertices of all features of an arcpy feature class, as one (vertices, 2) array."""
+	import arcpy
+	parts = []
+	cursor = arcpy.da.SearchCursor(fc, ["SHAPE@WKB"])
+	for row in cursor:
+		if(row[0] != None):
+			ReadWkbParts(bytes(row[0]), 0, parts)
+	del cursor
+	if(len(parts) == 0):
+		return np.zeros((0, 2))
+	return np.concatenate(parts)
+
+# Tables of line tasks opened by this process
+taskTables = {}
+
+def TaskFolder(outWorkspace, toolCodename):
+	return os.path.join(outWorkspace, "FLM_"+toolCodename+"_Lines")
+
+def Tasks(outWorkspace, toolCodename):
+	"""Memory mapped table of the line tasks written by FLM_Common.SplitLines, opened once per process
+	and again when SplitLines wrote a new table."""
+	folder = TaskFolder(outWorkspace, toolCodename)
+	mtime = os.path.getmtime(os.path.join(folder, "lines.npy"))
+	if(taskTables.get(folder, (None, None))[0] != mtime):
+		taskTables[folder] = (mtime, Load(folder))
+	return taskTables[folder][1]
+
+def TaskVertices(outWorkspace, toolCodename, lineNo):
+	"""Vertices of a line task, numbered from 1 as the segment files of SplitLines."""
+	return Tasks(outWorkspace, toolCodename).Vertices(lineNo-1)
+
+def TaskValue(outWorkspace, toolCodename, lineNo, field):
+	return Tasks(outWorkspace, toolCodename).Value(lineNo-1, field)
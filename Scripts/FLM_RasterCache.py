@@ -0,0 +1,256 @@
+#
+#    Copyright (C) 2020  Applied Geospatial Research Group
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, version 3.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <https://gnu.org/licenses/gpl-3.0>.
+#
+# ---------------------------------------------------------------------------
+#
+# FLM_RasterCache.py
+# Script Author: Gustavo Lopes Queiroz
+# Date: 2020-Jan-22
+#
+# This script is part of the Forest Line Mapper (FLM) toolset
+# Webpage: https://github.com/appliedgrg/flm
+#
+# Purpose: Disk cache of the input rasters of the per-line tools. Input CHM,
+# canopy and cost rasters are often striped and LZW compressed GeoTIFFs,
+# which are slow to read by small windows. The first time a raster is used
+# it is converted once into the cache: a tiled uncompressed GeoTIFF for the
+# arcpy tools, or a NumPy array file with a JSON geotransform sidecar that
+# the raster engine memory maps. Later window reads are slices of tiles
+# kept in the operating system page cache.
+# Entries are keyed by the source path, modification time and size, so a
+# changed source is converted again. The least recently used entries are
+# deleted when the cache exceeds its size.
+# Each process also keeps the decoded blocks of the windows read by the raster
+# engine in memory (see BlockCache), so the windows of neighbouring lines do
+# not read and decode the same blocks of the canopy, cost and corridor rasters
+# again. Workers keep their own block cache; the memory mapped cache entries
+# are shared by all workers through the page cache.
+# Settings used (see FLM_Common.GetSetting):
+#     raster_cache              set to True to enable the cache
+#     raster_cache_path         cache folder, default FLM_raster_cache in the work folder
+#     raster_cache_size         maximum size of the cache in GB
+#     raster_cache_tile         tile size in cells of the cached GeoTIFFs
+#     raster_cache_compression  compression of the cached GeoTIFFs (arcpy.env.compression)
+#     block_cache_size          size of the block cache of each process in MB (default 256, 0 disables it)
+#     block_cache_cells         side of the blocks in cells (default 256)
+#
+# ---------------------------------------------------------------------------
+
+import os, json, shutil, hashlib, collections
+from . import FLM_Common as flmc
+
+# Memory mapped arrays opened by this process
+arrays = {}
+# Block cache of this process (see Blocks)
+blockCache = None
+
+def Enabled():
+	return flmc.GetSetting("raster_cache", False)
+
+def CachePath():
+	return flmc.GetSetting("raster_cache_path", os.path.join(flmc.workPath, "FLM_raster_cache"))
+
+def SourceKey(path, kind):
+	"""Cache key of a raster file: hash of its full path, modification time and size.
+	Returns None for rasters that are not files (e.g. rasters in a geodatabase)."""
+	try:
+		stat = os.stat(path)
+	except OSError:
+		return None
+	source = os.path.normcase(os.path.realpath(path))+"|"+str(stat.st_mtime)+"|"+str(stat.st_size)
+	return hashlib.sha1(source.encode("utf-8")).hexdigest()[:20]+"_"+kind
+
+def EntrySize(entry):
+	size = 0
+	for root, dirs, files in os.walk(entry):
+		for name in files:
+			try:
+				size += os.path.getsize(os.path.join(root, name))
+			except OSError:
+				pass
+	return size
+
+def Evict(keep):
+	"""Deletes the least recently used entries until the cache fits in raster_cache_size.
+	The entry keep, which was just used, is never deleted."""
+	cachePath = CachePath()
+	limit = flmc.GetSetting("raster_cache_size", 20.0)*1024**3
+	entries = []
+	for name in os.listdir(cachePath):
+		entry = os.path.join(cachePath, name)
+		if(os.path.isdir(entry) and name.count(".") == 0):
+			entries.append((os.path.getmtime(entry), entry, EntrySize(entry)))
+	total = sum([size for used, entry, size in entries])
+	for used, entry, size in sorted(entries):
+		if(total <= limit):
+			break
+		if(entry == keep):
+			continue
+		shutil.rmtree(entry, True)
+		total -= size
+		flmc.log("Raster cache entry "+entry+" deleted ("+"{:.1f}".format(size/1024.0**2)+" MB).", True)
+
+def Entry(path, kind, create):
+	"""Returns the cache folder of a raster, calling create(path, folder) to fill it the first time.
+	The entry is built in a temporary folder and renamed, so processes converting the same raster
+	at the same time do not read incomplete entries."""
+	key = SourceKey(path, kind)
+	if(key == None):
+		return None
+	cachePath = CachePath()
+	entry = os.path.join(cachePath, key)
+	if(os.path.isdir(entry) == False):
+		if(os.path.isdir(cachePath) == False):
+			try:
+				os.makedirs(cachePath)
+			except OSError:
+				pass
+		building = entry+"."+str(os.getpid())
+		shutil.rmtree(building, True)
+		os.mkdir(building)
+		with flmc.Span("Raster cache", source=path):
+			create(path, building)
+		try:
+			os.rename(building, entry)
+			flmc.log("Raster "+path+" cached in "+entry+".")
+		except OSError:
+			# Another process cached the same raster first
+			shutil.rmtree(building, True)
+		Evict(entry)
+	# The folder time records the last use of the entry
+	os.utime(entry, None)
+	return entry
+
+def CreateTiled(path, folder):
+	import arcpy
+	tileSize = flmc.GetSetting("raster_cache_tile", 256)
+	saved = (arcpy.env.tileSize, arcpy.env.compression, arcpy.env.pyramid, arcpy.env.rasterStatistics)
+	arcpy.env.tileSize = str(tileSize)+" "+str(tileSize)
+	arcpy.env.compression = flmc.GetSetting("raster_cache_compression", "NONE")
+	arcpy.env.pyramid = "NONE"
+	arcpy.env.rasterStatistics = "STATISTICS"
+	try:
+		arcpy.CopyRaster_management(path, os.path.join(folder, "raster.tif"))
+	finally:
+		arcpy.env.tileSize, arcpy.env.compression, arcpy.env.pyramid, arcpy.env.rasterStatistics = saved
+
+def CachedRaster(path):
+	"""Returns the path of the tiled GeoTIFF copy of a raster for the arcpy tools,
+	or path itself if the cache is disabled or the raster can not be cached."""
+	if(Enabled() == False or path == ""):
+		return path
+	entry = Entry(path, "tif", CreateTiled)
+	if(entry == None):
+		return path
+	return os.path.join(entry, "raster.tif")
+
+def CachedArray(path, read):
+	"""Returns (array, meta) with the raster as a read only memory mapped float32 array and its
+	geotransform (xMin, yMax, cellSize), or None if the cache is disabled or the raster can not be
+	cached. read(path) returns the whole raster as an FLM_Engine Grid, used to fill the cache."""
+	if(Enabled() == False):
+		return None
+	import numpy as np
+	def CreateArray(path, folder):
+		grid = read(path)
+		np.save(os.path.join(folder, "array.npy"), grid.array.astype(np.float32))
+		with open(os.path.join(folder, "meta.json"), "w") as meta:
+			json.dump({"source":path, "xMin":grid.xMin, "yMax":grid.yMax, "cellSize":grid.cellSize}, meta)
+	entry = Entry(path, "npy", CreateArray)
+	if(entry == None):
+		return None
+	if(entry not in arrays):
+		with open(os.path.join(entry, "meta.json")) as meta:
+			arrays[entry] = (np.load(os.path.join(entry, "array.npy"), mmap_mode="r"), json.load(meta))
+	return arrays[entry]
+
+class BlockCache:
+	"""Decoded raster blocks in least recently used order, keyed by (raster, band, block row, block column).
+	Blocks are evicted when their total size exceeds size bytes. The blocks found in the cache (hits),
+	read from their source (misses) and evicted, and the size of the blocks read, are counted."""
+	def __init__(self, size):
+		self.size = size
+		self.used = 0
+		self.blocks = collections.OrderedDict()
+		self.hits = 0
+		self.misses = 0
+		self.evictions = 0
+		self.readBytes = 0
+
+	def Get(self, key, read):
+		"""Returns the block of key, calling read() to read it when it is not in the cache."""
+		block = self.blocks.get(key)
+		if(block is not None):
+			# Moved to the end of the order, OrderedDict.move_to_end does not exist on Python 2.7
+			del self.blocks[key]
+			self.blocks[key] = block
+			self.hits += 1
+			return block
+		self.misses += 1
+		block = read()
+		self.readBytes += block.nbytes
+		# Blocks are shared by the windows that read them
+		block.flags.writeable = False
+		if(block.nbytes > self.size):
+			return block
+		self.blocks[key] = block
+		self.used += block.nbytes
+		while self.used > self.size:
+			oldKey, oldBlock = self.blocks.popitem(last=False)
+			self.used -= oldBlock.nbytes
+			self.evictions += 1
+		return block
+
+	def Counters(self):
+		return {"hits":self.hits, "misses":self.misses, "evictions":self.evictions, "read_mb":self.readBytes/1048576.0,
+			"blocks":len(self.blocks), "mb":self.used/1048576.0}
+
+	def Clear(self):
+		self.blocks.clear()
+		self.used = 0
+
+def Blocks():
+	"""Returns the block cache of this process, or None when the block_cache_size setting is 0."""
+	global blockCache
+	size = flmc.GetSetting("block_cache_size", 256.0)*1048576
+	if(size <= 0):
+		return None
+	if(blockCache == None or blockCache.size != size):
+		blockCache = BlockCache(size)
+	return blockCache
+
+def ReadWindow(raster, band, row0, col0, row1, col1, readBlock, shape = None):
+	"""Returns the cells [row0:row1, col0:col1] of a raster band assembled from blocks of block_cache_cells
+	cells kept in the block cache, or None when the cache is disabled or the window is empty. raster is a
+	key of the raster, which changes when the raster does. readBlock(row0, col0, row1, col1) reads the cells
+	of a block from the source. Blocks at the edges are cut to shape (rows, columns) when it is given."""
+	cache = Blocks()
+	if(cache == None or row1 <= row0 or col1 <= col0):
+		return None
+	import numpy as np
+	cells = flmc.GetSetting("block_cache_cells", 256)
+	window = None
+	for blockRow in range(row0//cells, (row1-1)//cells+1):
+		for blockCol in range(col0//cells, (col1-1)//cells+1):
+			r0, c0 = blockRow*cells, blockCol*cells
+			r1, c1 = r0+cells, c0+cells
+			if(shape != None):
+				r1, c1 = min(r1, shape[0]), min(c1, shape[1])
+			block = cache.Get((raster, band, blockRow, blockCol), lambda: readBlock(r0, c0, r1, c1))
+			if(window is None):
+				window = np.empty((row1-row0, col1-col0), dtype=block.dtype)
+			a0, a1, b0, b1 = max(row0, r0), min(row1, r1), max(col0, c0), min(col1, c1)
+			window[a0-row0:a1-row0, b0-col0:b1-col0] = block[a0-r0:a1-r0, b0-c0:b1-c0]
+	return window
@@ -0,0 +1,252 @@
+#
+#    Copyright (C) 2020  Applied Geospatial Research Group
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, version 3.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <https://gnu.org/licenses/gpl-3.0>.
+#
+# ---------------------------------------------------------------------------
+#
+# FLM_WorkQueue.py
+# Script Author: Gustavo Lopes Queiroz
+# Date: 2020-Jan-22
+#
+# This script is part of the Forest Line Mapper (FLM) toolset
+# Webpage: https://github.com/appliedgrg/flm
+#
+# Purpose: Distributes the tasks of the per-line tools through a SQLite work
+# queue placed on shared storage, so that workers running on several
+# computers can process the lines of a single tool run. No broker is needed:
+# workers claim tasks with a time limited lease, renew the lease while they
+# work and mark the task as done when finished. Tasks whose lease expires
+# (e.g. the worker or its computer stopped) are claimed again by another
+# worker, up to a maximum number of attempts.
+#
+# The coordinator (the computer running the tool) creates the queue and
+# starts its own local workers. Additional workers can be started on other
+# computers that share the FLM folder with:
+#     python -m Scripts.FLM_WorkQueue [queue file] [number of workers]
+# Settings used (see FLM_Common.GetSetting):
+#     executor=queue       enables the work queue in all per-line tools
+#     queue_path           queue file, default FLM_queue.db in the script folder
+#     queue_workers        local workers started by the coordinator
+#     queue_lease          lease duration in seconds
+#     queue_attempts       maximum number of attempts for each task
+#     task_timeout         seconds after which the lease of a task is no longer renewed
+#
+# ---------------------------------------------------------------------------
+
+import os, sys, time, json, socket, sqlite3, threading, multiprocessing
+from . import FLM_Common as flmc
+
+pollInterval = 2.0
+
+def GetQueuePath():
+	return flmc.GetSetting("queue_path", os.path.join(flmc.scriptPath,"FLM_queue.db"))
+
+def Connect(queuePath):
+	# Journal in DELETE mode, as WAL is not supported on network file systems
+	conn = sqlite3.connect(queuePath, timeout=120, isolation_level=None)
+	conn.execute("PRAGMA journal_mode=DELETE")
+	return conn
+
+def CreateQueue(queuePath, module, function, tasks):
+	"""Creates or resets the queue file and enqueues one task descriptor for each item in tasks.
+	The queue is reset instead of deleted so that workers already connected keep a valid file."""
+	conn = Connect(queuePath)
+	conn.execute("BEGIN IMMEDIATE")
+	conn.execute("DROP TABLE IF EXISTS tasks")
+	conn.execute("CREATE TABLE tasks (id INTEGER PRIMARY KEY, module TEXT, function TEXT, arg TEXT, state TEXT, attempts INTEGER, worker TEXT, lease REAL, error TEXT, spans TEXT)")
+	conn.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+	for task in tasks:
+		conn.execute("INSERT INTO tasks (module, function, arg, state, attempts, lease) VALUES (?,?,?,'pending',0,0)", (module, function, json.dumps(task)))
+	conn.execute("INSERT OR REPLACE INTO meta VALUES ('run', ?)", (str(time.time()),))
+	conn.execute("INSERT OR REPLACE INTO meta VALUES ('state', 'open')")
+	conn.execute("COMMIT")
+	conn.close()
+
+def GetMeta(conn, key):
+	try:
+		row = conn.execute("SELECT value FROM meta WHERE key=?", (key,)).fetchone()
+	except sqlite3.OperationalError:
+		return None
+	if(row == None):
+		return None
+	return row[0]
+
+def Claim(conn, worker, lease, attempts):
+	"""Claims a pending task, or a running task whose lease has expired.
+	Returns (id, module, function, arg, attempts before this one) or None if no task is available."""
+	now = time.time()
+	conn.execute("BEGIN IMMEDIATE")
+	try:
+		row = conn.execute("SELECT id, module, function, arg, attempts FROM tasks WHERE (state='pending' OR (state='running' AND lease<?)) AND attempts<? ORDER BY id LIMIT 1", (now, attempts)).fetchone()
+		if(row != None):
+			conn.execute("UPDATE tasks SET state='running', worker=?, lease=?, attempts=attempts+1 WHERE id=?", (worker, now+lease, row[0]))
+		conn.execute("COMMIT")
+	except:
+		conn.execute("ROLLBACK")
+		raise
+	return row
+
+def Renew(conn, taskId, worker, lease):
+	conn.execute("UPDATE tasks SET lease=? WHERE id=? AND worker=? AND state='running'", (time.time()+lease, taskId, worker))
+
+def Complete(conn, taskId, worker, spans = []):
+	"""Marks a task as done, unless its lease expired and it was claimed again by another worker."""
+	conn.execute("UPDATE tasks SET state='done', error=NULL, spans=? WHERE id=? AND worker=?", (json.dumps(spans), taskId, worker))
+
+def Release(conn, taskId, worker, error, attempts):
+	"""Returns a failed task to the queue, or marks it as failed after the maximum number of attempts."""
+	conn.execute("UPDATE tasks SET state=CASE WHEN attempts<? THEN 'pending' ELSE 'failed' END, lease=0, error=? WHERE id=? AND worker=?", (attempts, error, taskId, worker))
+
+def CountStates(conn):
+	counts = {"pending":0, "running":0, "done":0, "failed":0}
+	for state, count in conn.execute("SELECT state, COUNT(*) FROM tasks GROUP BY state"):
+		counts[state] = count
+	# Running tasks that can not be claimed again are counted as failed
+	row = conn.execute("SELECT COUNT(*) FROM tasks WHERE state='running' AND lease<? AND attempts>=?", (time.time(), flmc.GetSetting("queue_attempts", 3))).fetchone()
+	counts["running"] -= row[0]
+	counts["failed"] += row[0]
+	return counts
+
+class LeaseRenewer(threading.Thread):
+	"""Keeps renewing the lease of a task while the worker processes it, for at most timeout seconds
+	if timeout is above 0, so that a task that hangs is claimed again by another worker."""
+	def __init__(self, queuePath, taskId, worker, lease, timeout = 0):
+		threading.Thread.__init__(self)
+		self.daemon = True
+		self.queuePath = queuePath
+		self.taskId = taskId
+		self.worker = worker
+		self.lease = lease
+		self.timeout = timeout
+		self.stopped = threading.Event()
+	def run(self):
+		conn = Connect(self.queuePath)
+		start = time.time()
+		while not self.stopped.wait(self.lease/3.0):
+			if(self.timeout > 0 and time.time()-start >= self.timeout):
+				break
+			try:
+				Renew(conn, self.taskId, self.worker, self.lease)
+			except sqlite3.OperationalError:
+				pass
+		conn.close()
+	def stop(self):
+		self.stopped.set()
+		self.join()
+
+def Worker(queuePath = None, keepAlive = False, workerLog = None):
+	"""Claims and processes tasks until the coordinator closes the queue.
+	If keepAlive is True the worker waits for the next run instead of exiting.
+	Local workers send their log records to the coordinator through workerLog."""
+	flmc.SetLogQueue(workerLog)
+	if(queuePath == None):
+		queuePath = GetQueuePath()
+	worker = socket.gethostname()+":"+str(os.getpid())
+	flmc.TakeSpans()
+	lease = flmc.GetSetting("queue_lease", 300.0)
+	attempts = flmc.GetSetting("queue_attempts", 3)
+	timeout = flmc.GetSetting("task_timeout", 0.0)
+
+	# Wait for the queue to be created by the coordinator
+	while not os.path.exists(queuePath):
+		time.sleep(pollInterval)
+	conn = Connect(queuePath)
+	run = GetMeta(conn, "run")
+
+	while True:
+		task = Claim(conn, worker, lease, attempts)
+		if(task == None):
+			if(GetMeta(conn, "state") != "closed"):
+				time.sleep(pollInterval)
+				continue
+			if(keepAlive == False):
+				break
+			# Wait for a new run
+			while GetMeta(conn, "run") == run:
+				time.sleep(pollInterval)
+			run = GetMeta(conn, "run")
+			continue
+
+		taskId, module, function, arg, attempt = task
+		renewer = LeaseRenewer(queuePath, taskId, worker, lease, timeout)
+		renewer.start()
+		try:
+			# Tool arguments are loaded again when a new run starts
+			result, spans, peak = flmc.RunTracedTask((module, function, GetMeta(conn, "run"), json.loads(arg), attempt))
+			renewer.stop()
+			Complete(conn, taskId, worker, spans)
+		except Exception as e:
+			renewer.stop()
+			Release(conn, taskId, worker, flmc.TaskError(e), attempts)
+	conn.close()
+	flmc.FlushLog()
+
+def RunQueue(workFunction, tasks):
+	"""Coordinator: enqueues the tasks, starts local workers and waits until every task is done or failed.
+	Returns the list of tasks that failed after all attempts, which are also recorded in FLM_Common.failedTasks."""
+	queuePath = GetQueuePath()
+	nWorkers = flmc.GetSetting("queue_workers", flmc.GetCores())
+	CreateQueue(queuePath, workFunction.__module__, workFunction.__name__, tasks)
+	flmc.log("Work queue created at "+queuePath+" with "+str(len(tasks))+" tasks. Starting "+str(nWorkers)+" local workers...")
+
+	workerLog = multiprocessing.Queue()
+	logListener = flmc.LogListener(workerLog)
+	logListener.start()
+	workers = []
+	for i in range(0, nWorkers):
+		process = multiprocessing.Process(target=Worker, args=(queuePath, False, workerLog))
+		process.start()
+		workers.append(process)
+
+	conn = Connect(queuePath)
+	lastDone = -1
+	while True:
+		counts = CountStates(conn)
+		if(counts["done"] != lastDone):
+			lastDone = counts["done"]
+			flmc.log("Work queue: "+str(counts["done"])+" done, "+str(counts["running"])+" running, "+str(counts["pending"])+" pending, "+str(counts["failed"])+" failed.", True)
+		if(counts["pending"]+counts["running"] == 0):
+			break
+		time.sleep(pollInterval)
+	conn.execute("INSERT OR REPLACE INTO meta VALUES ('state', 'closed')")
+
+	# Keep the profiling spans recorded by the workers
+	for spans, in conn.execute("SELECT spans FROM tasks WHERE spans IS NOT NULL"):
+		flmc.traceSpans.extend(json.loads(spans))
+
+	failed = []
+	for arg, attempts, error in conn.execute("SELECT arg, attempts, error FROM tasks WHERE state!='done'"):
+		failed.append(json.loads(arg))
+		flmc.failedTasks.append((json.loads(arg), attempts, str(error) if error != None else "lease expired"))
+		flmc.log("Task "+arg+" failed: "+str(error))
+	conn.close()
+	for process in workers:
+		process.join()
+	logListener.stop()
+	return failed
+
+if __name__ == '__main__':
+	queuePath = None
+	nWorkers = flmc.GetCores()
+	if(len(sys.argv)>1):
+		queuePath = sys.argv[1]
+	if(len(sys.argv)>2):
+		nWorkers = int(sys.argv[2])
+	workers = []
+	for i in range(0, nWorkers):
+		process = multiprocessing.Process(target=Worker, args=(queuePath, True))
+		process.start()
+		workers.append(process)
+	for process in workers:
+		process.join()
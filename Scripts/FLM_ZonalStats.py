@@ -0,0 +1,205 @@
+#
+#    Copyright (C) 2020  Applied Geospatial Research Group
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, version 3.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <https://gnu.org/licenses/gpl-3.0>.
+#
+# ---------------------------------------------------------------------------
+#
+# FLM_ZonalStats.py
+# Script Author: Gustavo Lopes Queiroz
+# Date: 2020-Jan-22
+#
+# This script is part of the Forest Line Mapper (FLM) toolset
+# Webpage: https://github.com/appliedgrg/flm
+#
+# Purpose: Zonal statistics of many zones over one or more rasters, used by
+# the Zonal Threshold and Forest Line Attributes tools instead of one
+# ZonalStatisticsAsTable per line. Rasters are read once, tile by tile (see
+# FLM_Engine.ReadRaster), and the count, area, sum, sum of squares, minimum
+# and maximum of the valid cells of every zone over the tile are added to a
+# NumPy table. Zones are line buffers or polygons and may overlap, as the
+# buffers of neighbouring lines do. A cell is in a zone when its centre is,
+# as in the rasterization of zones by ZonalStatisticsAsTable.
+# Settings used (see FLM_Common.GetSetting):
+#     zonal_tile  size of the tiles read from the rasters, in cells (default 1024)
+#
+# ---------------------------------------------------------------------------
+
+import math, struct
+import numpy as np
+from . import FLM_Common as flmc
+from . import FLM_Engine as flme
+
+# Fields of the tables returned by ZonalStatistics
+tableType = np.dtype([("count", np.int64), ("area", np.float64), ("sum", np.float64), ("sum2", np.float64),
+	("min", np.float64), ("max", np.float64), ("mean", np.float64), ("std", np.float64)])
+
+class LineZone:
+	"""Cells within distance of a polyline, given as a list of (x, y) vertices (round ends, as Buffer)."""
+	def __init__(self, vertices, distance):
+		self.vertices = [(float(x), float(y)) for x, y in vertices]
+		self.distance = float(distance)
+
+	def Extent(self):
+		return flme.LineExtent(self.vertices, self.distance)
+
+	def Mask(self, grid):
+		return flme.LineMask(grid, self.vertices, self.distance)
+
+class PolygonZone:
+	"""Cells inside a polygon, given as a list of (vertices, 2) rings. Holes and parts follow the
+	even-odd rule, so the rings of any polygon or multipart polygon can be listed in any order."""
+	def __init__(self, rings):
+		self.rings = [np.asarray(ring, dtype=np.float64) for ring in rings if len(ring) > 2]
+		if(len(self.rings) > 0):
+			coords = np.concatenate(self.rings)
+			self.extent = (coords[:,0].min(), coords[:,1].min(), coords[:,0].max(), coords[:,1].max())
+		else:
+			self.extent = None
+		# Edges of all rings, from each vertex to the next
+		self.edges = (np.concatenate(self.rings), np.concatenate([np.roll(ring, -1, axis=0) for ring in self.rings])) if len(self.rings) > 0 else None
+
+	def Extent(self):
+		return self.extent
+
+	def Mask(self, grid):
+		"""Cells of grid whose centre is inside the polygon, filled row by row between the crossings of the edges."""
+		mask = np.zeros((grid.rows, grid.cols), dtype=bool)
+		if(self.edges == None):
+			return mask
+		(x1, y1), (x2, y2) = self.edges[0].T, self.edges[1].T
+		xs = grid.xMin+(np.arange(grid.cols)+0.5)*grid.cellSize
+		for row in range(0, grid.rows):
+			y = grid.yMax-(row+0.5)*grid.cellSize
+			crossing = (y1 > y) != (y2 > y)
+			if(crossing.any() == False):
+				continue
+			cx = np.sort(x1[crossing]+(y-y1[crossing])*(x2[crossing]-x1[crossing])/(y2[crossing]-y1[crossing]))
+			mask[row] = np.searchsorted(cx, xs, side="right") % 2 == 1
+		return mask
+
+def ReadWkbRings(wkb, offset, rings):
+	"""Appends the (vertices, 2) coordinate arrays of the rings of a WKB polygon or multipolygon
+	to rings and returns the offset after the geometry. Z and M values are dropped."""
+	order = "<" if wkb[offset:offset+1] == b"\x01" else ">"
+	code = struct.unpack_from(order+"I", wkb, offset+1)[0]
+	offset += 5
+	dims = 2+(1 if code & 0x80000000 else 0)+(1 if code & 0x40000000 else 0)
+	code = code & 0xffff
+	dims += {1:1, 2:1, 3:2}.get(code // 1000, 0)
+	base = code % 1000
+	count = struct.unpack_from(order+"I", wkb, offset)[0]
+	offset += 4
+	if(base == 3):
+		for r in range(0, count):
+			points = struct.unpack_from(order+"I", wkb, offset)[0]
+			offset += 4
+			values = np.frombuffer(wkb, dtype=order+"f8", count=points*dims, offset=offset)
+			rings.append(values.reshape(points, dims)[:, 0:2])
+			offset += 8*points*dims
+		return offset
+	for g in range(0, count):
+		offset = ReadWkbRings(wkb, offset, rings)
+	return offset
+
+def PolygonZones(fc, idField = None):
+	"""Polygon zones of the features of a feature class, with the value of idField of each feature
+	(its object ID by default). Returns (zones, ids)."""
+	import arcpy
+	zones = []
+	ids = []
+	cursor = arcpy.da.SearchCursor(fc, ["SHAPE@WKB", idField if idField != None else "OID@"])
+	for row in cursor:
+		rings = []
+		if(row[0] != None):
+			ReadWkbRings(bytes(row[0]), 0, rings)
+		zones.append(PolygonZone(rings))
+		ids.append(row[1])
+	del cursor
+	return zones, ids
+
+def EmptyTable(zones, rasters):
+	table = np.zeros((len(rasters), len(zones)), dtype=tableType)
+	table["min"] = np.inf
+	table["max"] = -np.inf
+	return table
+
+def Tiles(extent, size):
+	"""Tiles of size map units covering extent, as (xMin, yMin, xMax, yMax)."""
+	xMin, yMin, xMax, yMax = extent
+	columns = max(1, int(math.ceil((xMax-xMin)/size)))
+	rows = max(1, int(math.ceil((yMax-yMin)/size)))
+	return [(xMin+i*size, yMax-(j+1)*size, xMin+(i+1)*size, yMax-j*size) for j in range(0, rows) for i in range(0, columns)]
+
+def TileZones(bounds, tile):
+	"""Indices of the zones whose bounds intersect tile. Zones without bounds (NaN) are not included."""
+	xMin, yMin, xMax, yMax = tile
+	return np.nonzero((bounds[:,0] <= xMax) & (bounds[:,2] >= xMin) & (bounds[:,1] <= yMax) & (bounds[:,3] >= yMin))[0]
+
+def AddTile(table, zones, bounds, grid, tile):
+	"""Adds the cells of grid whose centre is in tile (left and top edges included) to the zones
+	whose bounds intersect it. Each cell of the raster is in exactly one tile."""
+	xMin, yMin, xMax, yMax = tile
+	near = TileZones(bounds, tile)
+	cellArea = grid.cellSize*grid.cellSize
+	for z in near:
+		window = grid.Clip(*bounds[z])
+		if(window.rows == 0 or window.cols == 0):
+			continue
+		cx = window.xMin+(np.arange(window.cols)+0.5)*window.cellSize
+		cy = window.yMax-(np.arange(window.rows)+0.5)*window.cellSize
+		inTile = ((cy > yMin) & (cy <= yMax))[:,None] & ((cx >= xMin) & (cx < xMax))[None,:]
+		values = window.array[zones[z].Mask(window) & inTile & flme.Valid(window.array)].astype(np.float64)
+		if(len(values) == 0):
+			continue
+		row = table[z]
+		row["count"] += len(values)
+		row["area"] += len(values)*cellArea
+		row["sum"] += values.sum()
+		row["sum2"] += (values*values).sum()
+		row["min"] = min(row["min"], values.min())
+		row["max"] = max(row["max"], values.max())
+
+def Finish(table):
+	"""Mean and population standard deviation of each zone from its sums. Zones without cells get NaN statistics."""
+	empty = table["count"] == 0
+	count = np.maximum(table["count"], 1)
+	table["mean"] = table["sum"]/count
+	table["std"] = np.sqrt(np.maximum(table["sum2"]/count-table["mean"]**2, 0))
+	for field in ["mean", "std", "min", "max"]:
+		table[field][empty] = np.nan
+	return table
+
+def ZonalStatistics(zones, rasters):
+	"""Statistics of the valid cells of each zone on each raster. Each raster is read once, by tiles
+	of zonal_tile cells covering the zones. Returns a table of tableType with one row for each
+	raster and one column for each zone: table[r]["mean"] holds the means of all zones on raster r."""
+	table = EmptyTable(zones, rasters)
+	bounds = np.array([zone.Extent() if zone.Extent() != None else (np.nan,)*4 for zone in zones], dtype=np.float64).reshape(-1, 4)
+	known = np.isfinite(bounds).all(axis=1)
+	if(known.any() == False):
+		return Finish(table)
+	extent = (bounds[known,0].min(), bounds[known,1].min(), bounds[known,2].max(), bounds[known,3].max())
+	tileCells = flmc.GetSetting("zonal_tile", 1024)
+	for r, raster in enumerate(rasters):
+		cellSize = flme.SourceInfo(raster).cellSize
+		tiles = Tiles(extent, tileCells*cellSize)
+		with flmc.Span("Zonal statistics", raster=raster, zones=len(zones), tiles=len(tiles)):
+			for tile in tiles:
+				# Tiles in gaps between the zones are not read
+				if(len(TileZones(bounds, tile)) == 0):
+					continue
+				grid = flme.ReadRaster(raster, tile)
+				if(grid.rows > 0 and grid.cols > 0):
+					AddTile(table[r], zones, bounds, grid, tile)
+	return Finish(table)
@@ -27,89 +27,96 @@
 #
 # ---------------------------------------------------------------------------
 
-import multiprocessing
+import numpy as np
 import arcpy
-from arcpy.sa import *
-arcpy.CheckOutExtension("Spatial")
 from . import FLM_Common as flmc
+from . import FLM_LineTable as flmlt
+from . import FLM_ZonalStats as flmz
+from . import FLM_RasterCache as flmrc
+from . import FLM_GeoPackage as flmg
 
 # Setup script path and workspace folder
 workspaceName = "FLM_ZT_output"
 outWorkspace = flmc.GetWorkspace(workspaceName)
-arcpy.env.workspace = outWorkspace
-arcpy.env.overwriteOutput = True
 
-# Load arguments from file
-args = flmc.GetArgs("FLM_ZT_params.txt")
+def LoadArgs():
+	"""Loads the tool arguments from the parameter file. Arguments are not loaded when the
+	module is imported, they are loaded when the tool runs and once in each worker process."""
+	global Input_Feature_Class, ThresholdField, Canopy_Raster, Canopy_Search_Radius, MinValue, MaxValue, OutputLines, zonalMeans
+	arcpy.CheckOutExtension("Spatial")
+	arcpy.env.workspace = outWorkspace
+	arcpy.env.overwriteOutput = True
 
-# Tool arguments
-Input_Feature_Class = args[0].rstrip()
-#ID_Field = args[1].rstrip()
-ThresholdField = args[1].rstrip()
-Canopy_Raster = args[2].rstrip()
-Canopy_Search_Radius = float(args[3].rstrip())
-MinValue = float(args[4].rstrip())
-MaxValue = float(args[5].rstrip())
-OutputLines = args[6].rstrip()
+	# Load arguments from file
+	args = flmc.GetArgs("FLM_ZT_params.txt")
 
+	# Tool arguments
+	Input_Feature_Class = args[0].rstrip()
+	#ID_Field = args[1].rstrip()
+	ThresholdField = args[1].rstrip()
+	Canopy_Raster = flmrc.CachedRaster(args[2].rstrip())
+	Canopy_Search_Radius = float(args[3].rstrip())
+	MinValue = float(args[4].rstrip())
+	MaxValue = float(args[5].rstrip())
+	OutputLines = args[6].rstrip()
+
+	# Mean canopy around each line, loaded by the first task of the process (see ZonalMeans)
+	zonalMeans = None
+
+def ZonalMeans():
+	"""Mean canopy closure within the search radius of each line, computed for all lines at once by main."""
+	global zonalMeans
+	if(zonalMeans is None):
+		zonalMeans = np.load(outWorkspace +"\\FLM_ZT_Zonal.npy")
+	return zonalMeans
 
 def workLines(lineNo):
 	#Temporary files
 	fileSeg = outWorkspace +"\\FLM_ZT_Segment_" + str(lineNo) +".shp"
-	fileBuffer = outWorkspace +"\\FLM_ZT_Buffer_" + str(lineNo) +".shp"
-	fileZonal = outWorkspace +"\\FLM_ZT_Zonal_" + str(lineNo) +".dbf"
 
-	arcpy.Buffer_analysis(fileSeg, fileBuffer, Canopy_Search_Radius, "FULL", "ROUND", "NONE", "", "PLANAR")	
+	mean = float(ZonalMeans()[lineNo-1])
+	if(np.isnan(mean)):
+		flmc.log("Line "+str(lineNo)+" has no canopy cells within the search radius, its threshold is not changed.", True)
+		return flmg.TakeOutput(fileSeg, OutputLines, outWorkspace, "ZT")
 
-	ZonalStatisticsAsTable(fileBuffer,"ORIG_FID",Canopy_Raster,fileZonal,"DATA","MEAN")
-
-	"""
-	difCount = int(arcpy.GetCount_management(Input_Feature_Class).getOutput(0))-int(arcpy.GetCount_management(fileZonal).getOutput(0))
-	if (difCount!= 0):
-		arcpy.AddWarning("Warning! "+str(difCount)+" records from your input lines are missing from the zonal analysis.")
-		arcpy.AddMessage("This is ikely due to small lines being overlapped by bigger lines.")
-		arcpy.AddMessage("The original value (default of 8.0) will be retained for those records.")
-	"""
-	
-	zonal = []
-	zoTable = arcpy.SearchCursor(fileZonal)
-	for row in zoTable:
-		zonal.append([int(row.getValue("ORIG_FID")),float(row.getValue("MEAN"))])
-	del zoTable
-	
-	line = 0
 	cursor = arcpy.UpdateCursor(fileSeg)
 	for row in cursor:
-		"""
-		if ((zonal[line][0]) != int(row.getValue(ID_Field))):
-			arcpy.AddWarning("Missing record FID "+str(int(row.getValue(ID_Field))))
-			continue
-		"""
-		threshold = MinValue + (zonal[line][1]*zonal[line][1]) * (MaxValue - MinValue)
+		threshold = MinValue + (mean*mean) * (MaxValue - MinValue)
 		row.setValue(ThresholdField, threshold)
 		cursor.updateRow(row)
-		line += 1
 	del cursor
 	
-	arcpy.Delete_management(fileBuffer)
-	arcpy.Delete_management(fileZonal)
+	return flmg.TakeOutput(fileSeg, OutputLines, outWorkspace, "ZT")
 
-def main():	
+def main():
+	LoadArgs()
 	global outWorkspace
 	outWorkspace = flmc.SetupWorkspace(workspaceName)
 
 	# Prepare input lines for multiprocessing
 	numLines = flmc.SplitLines(Input_Feature_Class, outWorkspace, "ZT", False, ThresholdField)
 	
-	pool = multiprocessing.Pool(processes=flmc.GetCores())
+	# Mean canopy around all lines, reading the canopy raster once
+	flmc.log("Calculating zonal statistics...")
+	lines = flmlt.Tasks(outWorkspace, "ZT")
+	zones = [flmz.LineZone(lines.Vertices(line), Canopy_Search_Radius) for line in range(0, numLines)]
+	np.save(outWorkspace +"\\FLM_ZT_Zonal.npy", flmz.ZonalStatistics(zones, [Canopy_Raster])[0]["mean"])
+	flmc.logStep("Zonal statistics")
+	
+	# Lines are written to a GeoPackage as they finish
+	writer = flmg.OpenOutput(outWorkspace, "ZT", OutputLines) if flmg.UseGeoPackage(OutputLines) else None
+	
 	flmc.log("Multiprocessing line zonal thresholds...")
-	pool.map(workLines, range(1,numLines+1))
-	pool.close()
-	pool.join()
+	flmc.MapTasks(workLines, range(1,numLines+1), None, writer.Add if writer != None else None)
 	
 	flmc.logStep("Line multiprocessing")
+	flmc.ReportFailures(Input_Feature_Class, outWorkspace, "ZT", OutputLines)
 	
 	flmc.log("Merging layers...")
+	if(writer != None):
+		flmg.CloseOutput(writer, outWorkspace, "ZT", OutputLines)
+		flmc.logStep("Merge")
+		return
 	tempShapefiles = arcpy.ListFeatureClasses()
 	
 	arcpy.Merge_management(tempShapefiles,OutputLines)
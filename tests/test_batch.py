@@ -0,0 +1,22 @@
+import unittest
+from Scripts import FLM_Batch as flmb
+
+class JobNameTest(unittest.TestCase):
+	def testValid(self):
+		names = set()
+		for name in ["tile_001", "tile-002", "AOI 3.v2"]:
+			flmb.CheckJobName(name, names)
+		self.assertEqual(names, set(["tile_001", "tile-002", "aoi 3.v2"]))
+
+	def testDuplicate(self):
+		names = set()
+		flmb.CheckJobName("tile_001", names)
+		# Folders on Windows do not differ by case
+		self.assertRaises(ValueError, flmb.CheckJobName, "Tile_001", names)
+
+	def testPathLike(self):
+		for name in ["", ".", "..", "../tile", "a/b", "a\\b", "C:tile", ".hidden", "tile ", None, 7]:
+			self.assertRaises(ValueError, flmb.CheckJobName, name, set())
+
+if __name__ == '__main__':
+	unittest.main()
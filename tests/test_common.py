@@ -0,0 +1,126 @@
+import os, shutil, tempfile, unittest
+from Scripts import FLM_Common as flmc
+
+class SearchRadiiTest(unittest.TestCase):
+	def setUp(self):
+		self.environ = dict(os.environ)
+		flmc.taskAttempt = 0
+
+	def tearDown(self):
+		os.environ.clear()
+		os.environ.update(self.environ)
+		flmc.taskAttempt = 0
+
+	def testDefault(self):
+		os.environ["FLM_ADAPTIVE_WINDOW_START"] = "0"
+		self.assertEqual(flmc.SearchRadii("35"), [35.0])
+
+	def testAdaptive(self):
+		# Tool arguments are strings, the radii grow from the start up to the Line Processing Radius
+		os.environ["FLM_ADAPTIVE_WINDOW_START"] = "5"
+		os.environ["FLM_ADAPTIVE_WINDOW_GROWTH"] = "2"
+		self.assertEqual(flmc.SearchRadii("35"), [5.0, 10.0, 20.0, 35.0])
+
+	def testAdaptiveRetry(self):
+		os.environ["FLM_ADAPTIVE_WINDOW_START"] = "5"
+		os.environ["FLM_ADAPTIVE_WINDOW_GROWTH"] = "2"
+		os.environ["FLM_RETRY_WINDOW_SCALE"] = "0.5"
+		flmc.taskAttempt = 1
+		self.assertEqual(flmc.SearchRadii("35"), [2.5, 5.0, 10.0, 17.5])
+
+class SegmentFieldTest(unittest.TestCase):
+	def testTemplateField(self):
+		# Id and LENGTH are already in the segment, copied from the template, before the added field
+		fieldNames = ["FID", "Shape", "Id", "LENGTH", "CorridorTh"]
+		self.assertEqual([flmc.SegmentField(name, fieldNames) for name in ["LENGTH", "Id", "CorridorThreshold"]], ["LENGTH", "Id", "CorridorTh"])
+
+	def testCase(self):
+		self.assertEqual(flmc.SegmentField("length", ["FID", "Shape", "LENGTH"]), "LENGTH")
+
+	def testMissing(self):
+		self.assertEqual(flmc.SegmentField("Width", ["FID", "Shape", "Id"]), None)
+
+class CurveTest(unittest.TestCase):
+	def Order(self, curve):
+		cells = [(x, y) for x in range(0, 4) for y in range(0, 4)]
+		keys = flmc.CurveKeys([x for x, y in cells], [y for x, y in cells], curve, 2)
+		return [cell for key, cell in sorted(zip(keys.tolist(), cells))]
+
+	def testHilbert(self):
+		# Order of xy2d on a 4 x 4 grid, each cell is next to the previous one
+		self.assertEqual(self.Order("hilbert"), [(0, 0), (1, 0), (1, 1), (0, 1), (0, 2), (0, 3), (1, 3), (1, 2),
+			(2, 2), (2, 3), (3, 3), (3, 2), (3, 1), (2, 1), (2, 0), (3, 0)])
+
+	def testZOrder(self):
+		self.assertEqual(self.Order("zorder")[0:8], [(0, 0), (1, 0), (0, 1), (1, 1), (2, 0), (3, 0), (2, 1), (3, 1)])
+
+	def testSpatialOrder(self):
+		points = [(3.0, 0.0), (float("nan"), 1.0), (0.0, 0.0), (0.0, 3.0), (3.0, 3.0)]
+		self.assertEqual(flmc.SpatialOrder(points), [2, 3, 4, 0, 1])
+
+class TaskOrderTest(unittest.TestCase):
+	def setUp(self):
+		self.environ = dict(os.environ)
+		flmc.lineExtents.clear()
+		# Lines along a row, listed from both ends towards the middle
+		for task, x in enumerate([0, 90, 10, 80, 20, 70], 1):
+			flmc.lineExtents[task] = (x, 0.0, x+5.0, 5.0)
+
+	def tearDown(self):
+		os.environ.clear()
+		os.environ.update(self.environ)
+		flmc.lineExtents.clear()
+
+	def testHilbert(self):
+		os.environ["FLM_TASK_ORDER"] = "hilbert"
+		self.assertEqual(flmc.TaskOrder(list(range(1, 7))), [0, 2, 4, 5, 3, 1])
+
+	def testInput(self):
+		os.environ["FLM_TASK_ORDER"] = "input"
+		self.assertEqual(flmc.TaskOrder(list(range(1, 7))), [0, 1, 2, 3, 4, 5])
+
+	def testOtherTasks(self):
+		# Tasks that are not split lines keep their order
+		os.environ["FLM_TASK_ORDER"] = "hilbert"
+		self.assertEqual(flmc.TaskOrder(["a", "b", "c"]), [0, 1, 2])
+		self.assertEqual(flmc.TaskOrder([1, 2, 7]), [0, 1, 2])
+
+class SettingsTest(unittest.TestCase):
+	def setUp(self):
+		self.environ = dict(os.environ)
+		self.scriptPath = flmc.scriptPath
+		flmc.scriptPath = tempfile.mkdtemp()
+		flmc.settingsCache = None
+		os.environ.pop("FLM_TASK_RETRIES", None)
+
+	def tearDown(self):
+		shutil.rmtree(flmc.scriptPath)
+		flmc.scriptPath = self.scriptPath
+		flmc.settingsCache = None
+		os.environ.clear()
+		os.environ.update(self.environ)
+
+	def testFile(self):
+		self.assertEqual(flmc.GetSetting("task_retries", 1), 1)
+		flmc.SetSetting("task_retries", 3)
+		self.assertEqual(flmc.GetSetting("task_retries", 1), 3)
+		flmc.SetSetting("task_retries", 4)
+		self.assertEqual(flmc.GetSetting("task_retries", 1), 4)
+		# Environment variables take precedence over the file
+		os.environ["FLM_TASK_RETRIES"] = "0"
+		self.assertEqual(flmc.GetSetting("task_retries", 1), 0)
+
+	def testCache(self):
+		flmc.SetSetting("task_retries", 3)
+		self.assertEqual(flmc.GetSetting("task_retries", 1), 3)
+		settings = flmc.settingsCache
+		flmc.GetSetting("task_chunk", 1)
+		self.assertIs(flmc.settingsCache, settings)
+		# A file changed by another process is parsed again
+		path = os.path.join(flmc.scriptPath, flmc.settingsFile)
+		with open(path, "a") as sfile:
+			sfile.write("task_chunk=8\n")
+		self.assertEqual(flmc.GetSetting("task_chunk", 1), 8)
+
+if __name__ == '__main__':
+	unittest.main()
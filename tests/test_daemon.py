@@ -0,0 +1,34 @@
+import os, stat, shutil, tempfile, unittest
+from Scripts import FLM_Common as flmc
+from Scripts import FLM_Daemon as flmd
+
+class KeyTest(unittest.TestCase):
+	def setUp(self):
+		self.environ = dict(os.environ)
+		self.scriptPath = flmc.scriptPath
+		flmc.scriptPath = tempfile.mkdtemp()
+		os.environ.pop("FLM_DAEMON_KEY", None)
+
+	def tearDown(self):
+		shutil.rmtree(flmc.scriptPath)
+		flmc.scriptPath = self.scriptPath
+		os.environ.clear()
+		os.environ.update(self.environ)
+
+	def testRandomKey(self):
+		key = flmd.GetKey()
+		self.assertEqual(len(key), 64)
+		self.assertNotEqual(key, b"flm")
+		# The key is kept for the next runs and can only be read by the user
+		self.assertEqual(flmd.GetKey(), key)
+		if(os.name == "posix"):
+			mode = os.stat(os.path.join(flmc.scriptPath, flmd.keyFile)).st_mode
+			self.assertEqual(stat.S_IMODE(mode), 0o600)
+
+	def testSetting(self):
+		os.environ["FLM_DAEMON_KEY"] = "secret"
+		self.assertEqual(flmd.GetKey(), b"secret")
+		self.assertFalse(os.path.exists(os.path.join(flmc.scriptPath, flmd.keyFile)))
+
+if __name__ == '__main__':
+	unittest.main()
@@ -0,0 +1,30 @@
+import unittest
+import numpy as np
+from Scripts import FLM_Engine as flme
+
+class ClipTest(unittest.TestCase):
+	def setUp(self):
+		self.grid = flme.Grid(np.arange(100, dtype=np.float32).reshape(10, 10), 0.0, 10.0, 1.0)
+
+	def testInside(self):
+		window = self.grid.Clip(2.5, 2.5, 4.5, 4.5)
+		self.assertEqual(window.array.shape, (3, 3))
+		self.assertEqual((window.xMin, window.yMax), (2.0, 5.0))
+		self.assertTrue((window.array == self.grid.array[5:8, 2:5]).all())
+
+	def testPartlyOutside(self):
+		window = self.grid.Clip(-3.0, 8.5, 1.5, 15.0)
+		self.assertEqual(window.array.shape, (2, 2))
+		self.assertEqual((window.xMin, window.yMax), (0.0, 10.0))
+
+	def testOutside(self):
+		# Extents above, left, below and right of the grid give empty windows
+		for extent in [(-5, 12, -2, 15), (2, 12, 5, 15), (-5, 2, -2, 5), (12, -5, 15, -2), (2, -5, 5, -2), (12, 2, 15, 5)]:
+			window = self.grid.Clip(*extent)
+			self.assertEqual(window.array.size, 0, extent)
+
+	def testCovering(self):
+		self.assertEqual(self.grid.Clip(-3, -3, 20, 20).array.shape, (10, 10))
+
+if __name__ == '__main__':
+	unittest.main()
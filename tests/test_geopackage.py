@@ -0,0 +1,46 @@
+import os, struct, shutil, sqlite3, tempfile, unittest
+from Scripts import FLM_GeoPackage as flmg
+
+srs = (-1, "NONE", -1, "undefined")
+
+def Line(points):
+	"""Features of one line as returned by TakeOutput, with a LineString WKB geometry."""
+	wkb = struct.pack("<BII", 1, 2, len(points))+b"".join([struct.pack("<2d", x, y) for x, y in points])
+	wkb, code, envelope = flmg.MultiWkb(wkb)
+	return {"geometry":flmg.geometryNames[code], "columns":[("LineNo", "INTEGER")], "srs":srs, "extent":envelope, "rows":[(flmg.GeometryBlob(wkb, srs[0], envelope), len(points))]}
+
+class ResultWriterTest(unittest.TestCase):
+	def setUp(self):
+		self.folder = tempfile.mkdtemp()
+		self.path = os.path.join(self.folder, "lines.gpkg")
+
+	def tearDown(self):
+		shutil.rmtree(self.folder)
+
+	def testWriter(self):
+		writer = flmg.ResultWriter(self.path)
+		self.assertEqual(writer.Add(Line([(0, 0), (10, 5)])), 1)
+		self.assertEqual(writer.Add(None), 0)
+		writer.Add(Line([(20, -5), (30, 0), (40, 15)]))
+		writer.Flush()
+		# The spatial index is built when the writer is closed, not updated on each insert
+		conn = sqlite3.connect(self.path)
+		self.assertEqual(conn.execute("SELECT COUNT(*) FROM sqlite_master WHERE name LIKE 'rtree_%'").fetchone()[0], 0)
+		conn.close()
+		self.assertEqual(writer.Close(), 2)
+
+		conn = sqlite3.connect(self.path)
+		self.assertEqual(conn.execute("SELECT table_name, data_type, min_x, min_y, max_x, max_y FROM gpkg_contents").fetchall(), [("lines", "features", 0, -5, 40, 15)])
+		self.assertEqual(conn.execute("SELECT table_name, column_name, geometry_type_name FROM gpkg_geometry_columns").fetchall(), [("lines", "geom", "MULTILINESTRING")])
+		self.assertEqual(conn.execute("SELECT LineNo FROM lines ORDER BY fid").fetchall(), [(2,), (3,)])
+		self.assertEqual(conn.execute("SELECT id, minx, maxx, miny, maxy FROM rtree_lines_geom ORDER BY id").fetchall(), [(1, 0, 10, 0, 5), (2, 20, 40, -5, 15)])
+		self.assertEqual(conn.execute("SELECT extension_name FROM gpkg_extensions WHERE table_name='lines'").fetchall(), [("gpkg_rtree_index",)])
+		conn.close()
+
+	def testEmpty(self):
+		writer = flmg.ResultWriter(self.path)
+		self.assertEqual(writer.Close(), 0)
+		self.assertEqual(writer.columns, None)
+
+if __name__ == '__main__':
+	unittest.main()
@@ -0,0 +1,109 @@
+import struct, tempfile, unittest
+import numpy as np
+from Scripts import FLM_LineTable as flmlt
+
+def LineStringWkb(vertices, order = "<", z = False):
+	"""WKB line string, little or big endian, with Z values when z is True (ISO code 1002)."""
+	dims = 3 if z else 2
+	values = [value for vertex in vertices for value in (tuple(vertex)+((9.0,) if z else ()))]
+	return (b"\x01" if order == "<" else b"\x00")+struct.pack(order+"II", 1002 if z else 2, len(vertices))+struct.pack(order+str(len(values))+"d", *values)
+
+def MultiWkb(parts):
+	return b"\x01"+struct.pack("<II", 5, len(parts))+b"".join(parts)
+
+def ReadParts(wkb):
+	parts = []
+	end = flmlt.ReadWkbParts(wkb, 0, parts)
+	return parts, end
+
+class WkbTest(unittest.TestCase):
+	def testLineString(self):
+		vertices = [(0.0, 0.0), (1.0, 2.0), (3.0, 1.0)]
+		for order in ["<", ">"]:
+			wkb = LineStringWkb(vertices, order)
+			parts, end = ReadParts(wkb)
+			self.assertEqual(end, len(wkb))
+			self.assertEqual(len(parts), 1)
+			np.testing.assert_array_equal(parts[0], vertices)
+
+	def testZDropped(self):
+		parts, end = ReadParts(LineStringWkb([(0.0, 0.0), (1.0, 1.0)], z=True))
+		np.testing.assert_array_equal(parts[0], [(0.0, 0.0), (1.0, 1.0)])
+
+	def testMultipart(self):
+		wkb = MultiWkb([LineStringWkb([(0, 0), (1, 0)]), LineStringWkb([(5, 5), (6, 6), (7, 5)], ">")])
+		parts, end = ReadParts(wkb)
+		self.assertEqual(end, len(wkb))
+		self.assertEqual([len(part) for part in parts], [2, 3])
+
+	def testEmpty(self):
+		parts, end = ReadParts(MultiWkb([]))
+		self.assertEqual(parts, [])
+		self.assertEqual(end, 9)
+
+	def testRoundTrip(self):
+		lineParts = [[np.array([(0.0, 0.0), (1.0, 2.0)]), np.array([(4.0, 4.0), (5.0, 4.5), (6.0, 3.0)])]]
+		parts, end = ReadParts(flmlt.LineWkb(lineParts[0]))
+		self.assertEqual(len(parts), 2)
+		for part, expected in zip(parts, lineParts[0]):
+			np.testing.assert_array_equal(part, expected)
+
+class TableTest(unittest.TestCase):
+	def setUp(self):
+		wkbs = [
+			LineStringWkb([(0, 0), (10, 0), (10, 10)]),
+			# Empty geometry
+			MultiWkb([]),
+			MultiWkb([LineStringWkb([(20, 20), (21, 22)]), LineStringWkb([(30, 30)]), LineStringWkb([(40, 41), (42, 43), (44, 40)])]),
+		]
+		lineParts = []
+		for wkb in wkbs:
+			parts, end = ReadParts(wkb)
+			lineParts.append(parts)
+		self.table = flmlt.FromParts(lineParts, {"Id":np.array([1, 2, 3]), "Name":np.array(["a", "b", "c"])})
+
+	def testBounds(self):
+		np.testing.assert_array_equal(self.table.bounds[0], (0, 0, 10, 10))
+		self.assertTrue(np.isnan(self.table.bounds[1]).all())
+		np.testing.assert_array_equal(self.table.bounds[2], (20, 20, 44, 43))
+
+	def testVertices(self):
+		self.assertEqual(len(self.table), 3)
+		self.assertEqual(len(self.table.Vertices(1)), 0)
+		self.assertEqual([len(part) for part in self.table.Parts(2)], [2, 1, 3])
+
+	def testSplitParts(self):
+		tasks = flmlt.Split(self.table, False)
+		# The part with a single vertex and the empty line make no task
+		self.assertEqual(len(tasks), 3)
+		self.assertEqual([tasks.Value(line, "Id") for line in range(0, 3)], [1, 3, 3])
+		self.assertEqual(tasks.Value(2, "Name"), "c")
+		np.testing.assert_array_equal(tasks.Vertices(2), [(40, 41), (42, 43), (44, 40)])
+		np.testing.assert_array_equal(tasks.bounds[1], (20, 20, 21, 22))
+		for line in range(0, len(tasks)):
+			parts, end = ReadParts(flmlt.LineWkb(tasks.Parts(line)))
+			np.testing.assert_array_equal(np.concatenate(parts), tasks.Vertices(line))
+
+	def testSplitSegments(self):
+		tasks = flmlt.Split(self.table, True)
+		self.assertEqual(len(tasks), 2+1+2)
+		self.assertEqual([tasks.Value(line, "Id") for line in range(0, len(tasks))], [1, 1, 3, 3, 3])
+		np.testing.assert_array_equal(tasks.Vertices(1), [(10, 0), (10, 10)])
+		np.testing.assert_array_equal(tasks.Vertices(4), [(42, 43), (44, 40)])
+		for line in range(0, len(tasks)):
+			self.assertEqual(len(tasks.Vertices(line)), 2)
+			parts, end = ReadParts(flmlt.LineWkb(tasks.Parts(line)))
+			np.testing.assert_array_equal(parts[0], tasks.Vertices(line))
+
+	def testSaveLoad(self):
+		tasks = flmlt.Split(self.table, False)
+		with tempfile.TemporaryDirectory() as folder:
+			tasks.Save(folder)
+			loaded = flmlt.Load(folder, False)
+			self.assertEqual(len(loaded), len(tasks))
+			np.testing.assert_array_equal(loaded.coords, tasks.coords)
+			np.testing.assert_array_equal(loaded.bounds, tasks.bounds)
+			self.assertEqual(loaded.Values(1, ["Id", "Name"]), [3, "c"])
+
+if __name__ == '__main__':
+	unittest.main()
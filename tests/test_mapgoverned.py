@@ -0,0 +1,52 @@
+import os, shutil, tempfile, unittest, multiprocessing
+from Scripts import FLM_Common as flmc
+
+def Square(task):
+	"""Task of the tests: odd tasks fail on their first attempt, negative tasks always fail."""
+	if(task < 0):
+		raise ValueError("negative task "+str(task))
+	if(task % 2 == 1 and flmc.taskAttempt == 0):
+		raise RuntimeError("first attempt")
+	return task*task
+
+class MapGovernedTest(unittest.TestCase):
+	def setUp(self):
+		self.environ = dict(os.environ)
+		self.folder = tempfile.mkdtemp()
+		self.logFile = flmc.logFile
+		flmc.logFile = os.path.join(self.folder, "log.txt")
+		del flmc.failedTasks[:]
+		self.pool = multiprocessing.Pool(2)
+
+	def tearDown(self):
+		self.pool.close()
+		self.pool.join()
+		flmc.FlushLog()
+		flmc.logFile = self.logFile
+		del flmc.failedTasks[:]
+		shutil.rmtree(self.folder)
+		os.environ.clear()
+		os.environ.update(self.environ)
+
+	def Map(self, tasks, chunk = 1):
+		moduleTasks = [(__name__, "Square", 0, task) for task in tasks]
+		return [result[0] if result != None else None for result in flmc.MapGoverned(self.pool, 2, moduleTasks, chunk = chunk)]
+
+	def testRetry(self):
+		# Odd tasks succeed on their second attempt
+		os.environ["FLM_TASK_RETRIES"] = "1"
+		self.assertEqual(self.Map([1, 2, 3, 4, 5], 2), [1, 4, 9, 16, 25])
+		self.assertEqual(flmc.failedTasks, [])
+
+	def testFailure(self):
+		os.environ["FLM_TASK_RETRIES"] = "2"
+		self.assertEqual(self.Map([2, -1, 3]), [4, None, 9])
+		self.assertEqual(flmc.failedTasks, [(-1, 3, "ValueError: negative task -1")])
+
+	def testNoRetry(self):
+		os.environ["FLM_TASK_RETRIES"] = "0"
+		self.assertEqual(self.Map([2, 3]), [4, None])
+		self.assertEqual(flmc.failedTasks, [(3, 1, "RuntimeError: first attempt")])
+
+if __name__ == '__main__':
+	unittest.main()
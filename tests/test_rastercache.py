@@ -0,0 +1,75 @@
+import os, unittest
+import numpy as np
+from Scripts import FLM_RasterCache as flmrc
+
+class BlockCacheTest(unittest.TestCase):
+	def setUp(self):
+		# Room for three blocks of 4 x 4 float64 cells
+		self.cache = flmrc.BlockCache(3*128)
+		self.reads = []
+
+	def Get(self, key):
+		def Read():
+			self.reads.append(key)
+			return np.full((4, 4), float(key))
+		return self.cache.Get(key, Read)
+
+	def testHitMiss(self):
+		self.assertEqual(self.Get(1)[0, 0], 1.0)
+		self.assertEqual(self.Get(1)[0, 0], 1.0)
+		self.assertEqual(self.reads, [1])
+		counters = self.cache.Counters()
+		self.assertEqual((counters["hits"], counters["misses"], counters["evictions"], counters["blocks"]), (1, 1, 0, 1))
+		# Cached blocks are shared and can not be changed
+		self.assertFalse(self.Get(1).flags.writeable)
+
+	def testEvictionOrder(self):
+		for key in [1, 2, 3]:
+			self.Get(key)
+		# A hit makes 1 the most recently used block, so 2 is evicted first
+		self.Get(1)
+		self.Get(4)
+		self.assertEqual(list(self.cache.blocks.keys()), [3, 1, 4])
+		self.Get(5)
+		self.assertEqual(list(self.cache.blocks.keys()), [1, 4, 5])
+		self.Get(2)
+		self.assertEqual(self.reads, [1, 2, 3, 4, 5, 2])
+		counters = self.cache.Counters()
+		self.assertEqual((counters["hits"], counters["misses"], counters["evictions"]), (1, 6, 3))
+		self.assertEqual(self.cache.used, 3*128)
+
+class ReadWindowTest(unittest.TestCase):
+	def setUp(self):
+		self.environ = dict(os.environ)
+		os.environ["FLM_BLOCK_CACHE_SIZE"] = "1"
+		os.environ["FLM_BLOCK_CACHE_CELLS"] = "4"
+		flmrc.blockCache = None
+		self.array = np.arange(10*9, dtype=np.float64).reshape(10, 9)
+		self.reads = []
+
+	def tearDown(self):
+		os.environ.clear()
+		os.environ.update(self.environ)
+		flmrc.blockCache = None
+
+	def ReadBlock(self, row0, col0, row1, col1):
+		self.reads.append((row0, col0, row1, col1))
+		return self.array[row0:row1, col0:col1].copy()
+
+	def testWindow(self):
+		window = flmrc.ReadWindow("raster", 1, 3, 2, 9, 8, self.ReadBlock, self.array.shape)
+		np.testing.assert_array_equal(window, self.array[3:9, 2:8])
+		# Blocks at the edges are cut to the raster
+		self.assertIn((8, 4, 10, 8), self.reads)
+		reads = len(self.reads)
+		# Only the blocks of the last column are not cached yet
+		window = flmrc.ReadWindow("raster", 1, 0, 0, 5, 9, self.ReadBlock, self.array.shape)
+		np.testing.assert_array_equal(window, self.array[0:5, 0:9])
+		self.assertEqual(self.reads[reads:], [(0, 8, 4, 9), (4, 8, 8, 9)])
+
+	def testDisabled(self):
+		os.environ["FLM_BLOCK_CACHE_SIZE"] = "0"
+		self.assertEqual(flmrc.ReadWindow("raster", 1, 0, 0, 5, 5, self.ReadBlock), None)
+
+if __name__ == '__main__':
+	unittest.main()
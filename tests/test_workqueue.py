@@ -0,0 +1,73 @@
+import os, time, shutil, tempfile, unittest
+from Scripts import FLM_WorkQueue as flmq
+
+class LeaseTest(unittest.TestCase):
+	def setUp(self):
+		self.folder = tempfile.mkdtemp()
+		self.queuePath = os.path.join(self.folder, "queue.db")
+		flmq.CreateQueue(self.queuePath, "module", "function", [1])
+		self.connA = flmq.Connect(self.queuePath)
+		self.connB = flmq.Connect(self.queuePath)
+
+	def tearDown(self):
+		self.connA.close()
+		self.connB.close()
+		shutil.rmtree(self.folder)
+
+	def State(self):
+		return self.connA.execute("SELECT state, worker, attempts FROM tasks").fetchone()
+
+	def testExpiry(self):
+		task = flmq.Claim(self.connA, "A", 0.2, 3)
+		self.assertEqual(task[0], 1)
+		self.assertEqual(task[4], 0)
+		# The task can not be claimed while the lease of A is valid
+		self.assertEqual(flmq.Claim(self.connB, "B", 0.2, 3), None)
+		time.sleep(0.3)
+		task = flmq.Claim(self.connB, "B", 60, 3)
+		self.assertEqual(task[0], 1)
+		self.assertEqual(task[4], 1)
+		self.assertEqual(self.State(), ("running", "B", 2))
+
+	def testOwnership(self):
+		flmq.Claim(self.connA, "A", 0.1, 3)
+		time.sleep(0.2)
+		flmq.Claim(self.connB, "B", 60, 3)
+		# A lost the task, its completion and its failure are ignored
+		flmq.Complete(self.connA, 1, "A")
+		self.assertEqual(self.State(), ("running", "B", 2))
+		flmq.Release(self.connA, 1, "A", "error", 3)
+		self.assertEqual(self.State(), ("running", "B", 2))
+		flmq.Complete(self.connB, 1, "B")
+		self.assertEqual(self.State(), ("done", "B", 2))
+
+	def testRelease(self):
+		flmq.Claim(self.connA, "A", 60, 2)
+		flmq.Release(self.connA, 1, "A", "error", 2)
+		self.assertEqual(self.State(), ("pending", "A", 1))
+		flmq.Claim(self.connB, "B", 60, 2)
+		flmq.Release(self.connB, 1, "B", "error", 2)
+		self.assertEqual(self.State(), ("failed", "B", 2))
+		self.assertEqual(flmq.Claim(self.connA, "A", 60, 2), None)
+
+	def testRenewTimeout(self):
+		flmq.Claim(self.connA, "A", 0.3, 3)
+		renewer = flmq.LeaseRenewer(self.queuePath, 1, "A", 0.3, 0.15)
+		renewer.start()
+		# The lease is no longer renewed after the timeout, so B claims the task
+		time.sleep(0.9)
+		task = flmq.Claim(self.connB, "B", 60, 3)
+		renewer.stop()
+		self.assertEqual(task[0], 1)
+
+	def testRenew(self):
+		flmq.Claim(self.connA, "A", 0.3, 3)
+		renewer = flmq.LeaseRenewer(self.queuePath, 1, "A", 0.3)
+		renewer.start()
+		time.sleep(0.9)
+		task = flmq.Claim(self.connB, "B", 60, 3)
+		renewer.stop()
+		self.assertEqual(task, None)
+
+if __name__ == '__main__':
+	unittest.main()
@@ -0,0 +1,79 @@
+import unittest
+import numpy as np
+from Scripts import FLM_Engine as flme
+from Scripts import FLM_ZonalStats as flmzs
+
+def BruteForce(grid, zones):
+	"""Mean of the valid cells of each zone, from the mask of the zone over the whole grid."""
+	means = []
+	for zone in zones:
+		values = grid.array[zone.Mask(grid) & np.isfinite(grid.array)]
+		means.append(values.mean() if len(values) > 0 else np.nan)
+	return np.array(means)
+
+class TilesTest(unittest.TestCase):
+	def testCover(self):
+		tiles = flmzs.Tiles((0.0, 0.0, 25.0, 12.0), 10.0)
+		self.assertEqual(len(tiles), 6)
+		self.assertEqual(tiles[0], (0.0, 2.0, 10.0, 12.0))
+		self.assertEqual(tiles[-1], (20.0, -8.0, 30.0, 2.0))
+
+	def testSmallExtent(self):
+		self.assertEqual(flmzs.Tiles((5.0, 5.0, 5.0, 5.0), 10.0), [(5.0, -5.0, 15.0, 5.0)])
+
+	def testTileZones(self):
+		bounds = np.array([(0.0, 0.0, 5.0, 5.0), (30.0, 30.0, 35.0, 35.0), (np.nan,)*4])
+		self.assertEqual(list(flmzs.TileZones(bounds, (4.0, 4.0, 14.0, 14.0))), [0])
+		# Tile in the gap between the zones
+		self.assertEqual(list(flmzs.TileZones(bounds, (10.0, 10.0, 20.0, 20.0))), [])
+
+class ZonalTest(unittest.TestCase):
+	def setUp(self):
+		rng = np.random.RandomState(1)
+		array = rng.uniform(0, 20, (60, 80))
+		array[rng.uniform(size=array.shape) < 0.1] = np.nan
+		self.grid = flme.Grid(array, 100.0, 300.0, 1.0)
+		self.zones = [
+			flmzs.LineZone([(110, 280), (150, 260), (170, 250)], 4.0),
+			flmzs.LineZone([(120, 250), (125, 255)], 3.0),
+			# Reaches out of the grid
+			flmzs.LineZone([(95, 245), (130, 235)], 6.0),
+			flmzs.PolygonZone([[(140, 250), (170, 250), (170, 270), (140, 270)], [(150, 255), (160, 255), (160, 265), (150, 265)]]),
+			# Outside the grid
+			flmzs.LineZone([(10, 10), (20, 20)], 2.0),
+			flmzs.PolygonZone([]),
+		]
+
+	def Table(self, tileSize):
+		table = flmzs.EmptyTable(self.zones, [None])
+		bounds = np.array([zone.Extent() if zone.Extent() != None else (np.nan,)*4 for zone in self.zones], dtype=np.float64)
+		for tile in flmzs.Tiles(self.grid.Extent(), tileSize):
+			window = self.grid.Clip(*tile)
+			if(window.rows > 0 and window.cols > 0):
+				flmzs.AddTile(table[0], self.zones, bounds, window, tile)
+		return flmzs.Finish(table)[0]
+
+	def testMeans(self):
+		expected = BruteForce(self.grid, self.zones)
+		for tileSize in [7.0, 16.0, 100.0]:
+			table = self.Table(tileSize)
+			np.testing.assert_allclose(table["mean"], expected, rtol=1e-9, equal_nan=True)
+
+	def testStatistics(self):
+		table = self.Table(9.0)
+		values = self.grid.array[self.zones[0].Mask(self.grid) & np.isfinite(self.grid.array)]
+		self.assertEqual(table["count"][0], len(values))
+		self.assertAlmostEqual(table["area"][0], len(values))
+		self.assertAlmostEqual(table["min"][0], values.min())
+		self.assertAlmostEqual(table["max"][0], values.max())
+		self.assertAlmostEqual(table["std"][0], values.std())
+
+	def testEmptyZones(self):
+		table = self.Table(10.0)
+		for z in [4, 5]:
+			self.assertEqual(table["count"][z], 0)
+			self.assertTrue(np.isnan(table["mean"][z]))
+			self.assertTrue(np.isnan(table["min"][z]))
+
+if __name__ == '__main__':
+	unittest.main()